@@ -0,0 +1,196 @@
+# This file has an approximate nearest neighbour index, for finding similar users or similar movies
+# without comparing with every one of them (at ML-25M size that is 160k users / 60k movies per request).
+# It is an IVF index: k-means splits the vectors (the user or movie factors of matrix_factorization.py)
+# into num_lists groups around a centre each; a search compares the query with the centres, and then only
+# with the vectors of the nprobe closest groups. More probes find more of the true neighbours but take
+# longer (see the recall benchmark). The index is saved in data/cache next to the factors.
+# Check recall and speed with: python ann_index.py [--sizes 160000,60000] [--nprobes 1,4,16,64]
+
+import os
+import time
+import numpy as np
+import data_cache
+from topk import StreamingTopK, top_k
+
+class IVFIndex:
+    def __init__(self, ids, vectors, centroids, offsets, metric):
+        self.ids = ids  # id of every vector, in list order
+        self.vectors = vectors  # (n x dims) float32, the vectors of list l are rows offsets[l]:offsets[l + 1]
+        self.centroids = centroids  # (num_lists x dims) float32
+        self.offsets = offsets
+        self.metric = metric  # "cosine" (vectors are stored normalized) or "dot"
+
+    @classmethod
+    def build(cls, ids, vectors, num_lists=None, metric="cosine", iterations=10, sample_size=None, seed=0):
+        # Group the vectors with k-means on the directions of the vectors (a sample of sample_size of them,
+        # default 50 per list) and store every group's vectors next to each other.
+        # num_lists defaults to about the square root of the number of vectors
+        if metric not in ("cosine", "dot"):
+            raise ValueError(f"Unknown metric: {metric}")
+        ids = np.asarray(ids, dtype=np.int64)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if metric == "cosine":
+            vectors = normalize(vectors)
+        if num_lists is None:
+            num_lists = int(np.sqrt(len(vectors)))
+        num_lists = max(1, min(num_lists, len(vectors)))
+
+        rng = np.random.default_rng(seed)
+        sample_size = min(len(vectors), sample_size or 50 * num_lists)
+        sample = normalize(vectors[rng.choice(len(vectors), sample_size, replace=False)])
+        centroids = kmeans(sample, num_lists, iterations, rng)
+
+        lists = nearest_centroids(normalize(vectors), centroids)
+        order = np.argsort(lists, kind='stable')
+        offsets = np.zeros(num_lists + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(lists, minlength=num_lists))
+        return cls(ids[order], vectors[order], centroids, offsets, metric)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, vector, k=10, nprobe=8, exclude=None):
+        # The ids of (about) the k most similar vectors and their scores (cosine similarity or dot
+        # product), best first. Only the nprobe closest lists are searched. exclude is an optional list
+        # of ids to leave out (e.g. the query's own id)
+        vector = np.asarray(vector, dtype=np.float32)
+        direction = normalize(vector[None, :])[0]
+        if self.metric == "cosine":
+            vector = direction
+        probes = top_k(self.centroids @ direction, np.arange(len(self.centroids)), nprobe)
+        # Every list is one block of rows, so the blocks are scored where they are, without copying them,
+        # and only the best of the lists searched so far are kept. The excluded ids are left out at the
+        # end, so enough extra ones are kept to make up for them
+        exclude = np.zeros(0, dtype=self.ids.dtype) if exclude is None else np.asarray(exclude)
+        best = StreamingTopK(k + len(exclude))
+        for l in probes:
+            start, end = self.offsets[l], self.offsets[l + 1]
+            best.push(self.vectors[start:end] @ vector, self.ids[start:end])
+        ids, scores = best.result()
+        keep = ~np.isin(ids, exclude)
+        return ids[keep][:k], scores[keep][:k].astype(np.float32)
+
+    def save(self, index_dir, source_path):
+        # Save as .npy files so they can be memory-mapped
+        os.makedirs(index_dir, exist_ok=True)
+        for name in ("ids", "vectors", "centroids", "offsets"):
+            data_cache.save_array(os.path.join(index_dir, f"{name}.npy"), getattr(self, name))
+        data_cache.write_meta(index_dir, dict(data_cache.source_signature(source_path), metric=self.metric))
+
+    @classmethod
+    def load(cls, index_dir, source_path):
+        # Load a saved index, or return None if there isn't one or the ratings file changed since
+        meta = data_cache.read_meta(index_dir, source_path)
+        if meta is None:
+            return None
+        arrays = [np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode='r')
+                  for name in ("ids", "vectors", "centroids", "offsets")]
+        return cls(*arrays, meta['metric'])
+
+def normalize(vectors):
+    # Vectors scaled to length 1 (all-zero vectors stay zero)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return (vectors / np.where(norms > 0, norms, 1)).astype(np.float32)
+
+def nearest_centroids(vectors, centroids, chunk_size=20000):
+    # The centroid with the highest dot product for every (normalized) vector, chunk_size vectors at a time
+    lists = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), chunk_size):
+        lists[start:start + chunk_size] = np.argmax(vectors[start:start + chunk_size] @ centroids.T, axis=1)
+    return lists
+
+def kmeans(vectors, num_lists, iterations, rng):
+    # Spherical k-means: centres are normalized means of the vectors closest to them. Centres that end
+    # up with no vectors are moved to a random vector
+    centroids = vectors[rng.choice(len(vectors), num_lists, replace=False)].copy()
+    for _ in range(iterations):
+        lists = nearest_centroids(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, lists, vectors)
+        empty = np.bincount(lists, minlength=num_lists) == 0
+        sums[empty] = vectors[rng.choice(len(vectors), empty.sum())]
+        centroids = normalize(sums)
+    return centroids
+
+def exact_search(ids, vectors, queries, k, metric="cosine"):
+    # The true top k ids for every query (rows of queries), comparing with every vector
+    vectors = np.asarray(vectors, dtype=np.float32)
+    queries = np.asarray(queries, dtype=np.float32)
+    if metric == "cosine":
+        vectors, queries = normalize(vectors), normalize(queries)
+    scores = queries @ vectors.T
+    return [ids[top_k(row, ids, k)] for row in scores]
+
+def index_dir_for(data_dir, kind):
+    return os.path.join(data_dir, "cache", f"ann_{kind}")
+
+def load_or_build(dataset, factor_model, kind):
+    # The index over the user ("users") or movie ("movies") factors: the saved one if it is up to date and
+    # has the same ids as the model, otherwise a new one (saved for next time)
+    ids, vectors = (factor_model.user_ids, factor_model.user_factors) if kind == "users" else \
+        (factor_model.movie_ids, factor_model.item_factors)
+    index_dir = index_dir_for(dataset.data_dir, kind)
+    source_path = dataset.file_path('ratings')
+    index = IVFIndex.load(index_dir, source_path)
+    if index is None or len(index) != len(ids) or not np.array_equal(np.sort(index.ids), np.sort(ids)):
+        index = IVFIndex.build(ids, vectors)
+        try:
+            index.save(index_dir, source_path)
+        except OSError as e:
+            print("Couldn't save nearest neighbour index:", e)
+    return index
+
+def clustered_vectors(count, dims, rng, clusters=1000):
+    # Made-up vectors for the scale-up benchmark: loose groups of similar vectors, like real factors
+    centres = rng.standard_normal((clusters, dims)).astype(np.float32)
+    return centres[rng.integers(0, clusters, count)] + rng.standard_normal((count, dims)).astype(np.float32)
+
+def benchmark_recall(name, ids, vectors, k=10, nprobes=(1, 4, 16, 64), num_queries=200, seed=0):
+    # recall@k against exact search (share of the true top k the index finds) and the query time for
+    # every nprobe, with num_queries of the vectors themselves as queries (their own id left out)
+    rng = np.random.default_rng(seed)
+    ids = np.asarray(ids, dtype=np.int64)
+    start = time.perf_counter()
+    index = IVFIndex.build(ids, vectors)
+    build_seconds = time.perf_counter() - start
+    query_rows = rng.choice(len(ids), min(num_queries, len(ids)), replace=False)
+
+    unit_vectors = normalize(vectors)  # normalized once, like the index does, so the timing is fair
+    start = time.perf_counter()
+    exact = [exact_search(ids, unit_vectors, unit_vectors[row:row + 1], k + 1, "dot")[0] for row in query_rows]
+    exact_ms = (time.perf_counter() - start) * 1000 / len(query_rows)
+    exact = [truth[truth != ids[row]][:k] for truth, row in zip(exact, query_rows)]
+
+    rows = []
+    for nprobe in nprobes:
+        found = 0
+        start = time.perf_counter()
+        for row, truth in zip(query_rows, exact):
+            approx, _ = index.search(vectors[row], k, nprobe, exclude=[ids[row]])
+            found += len(np.intersect1d(approx, truth))
+        query_ms = (time.perf_counter() - start) * 1000 / len(query_rows)
+        rows.append({'data': name, 'vectors': len(ids), 'lists': len(index.centroids), 'nprobe': nprobe,
+                     f'recall@{k}': round(found / (k * len(query_rows)), 4), 'query_ms': round(query_ms, 3),
+                     'exact_ms': round(exact_ms, 3), 'build_s': round(build_seconds, 2)})
+    return rows
+
+if __name__ == "__main__":
+    import argparse
+    import pandas as pd
+    from recommender import get_factor_model
+
+    parser = argparse.ArgumentParser(description="Recall and speed of the nearest neighbour index")
+    parser.add_argument("--sizes", default="160000,60000", help="sizes of the made-up vector sets")
+    parser.add_argument("--nprobes", default="1,4,16,64")
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+    nprobes = [int(value) for value in args.nprobes.split(",")]
+
+    model = get_factor_model()
+    results = benchmark_recall("users", model.user_ids, np.asarray(model.user_factors), args.k, nprobes)
+    results += benchmark_recall("movies", model.movie_ids, np.asarray(model.item_factors), args.k, nprobes)
+    rng = np.random.default_rng(0)
+    for size in [int(value) for value in args.sizes.split(",") if value]:
+        vectors = clustered_vectors(size, model.user_factors.shape[1], rng)
+        results += benchmark_recall(f"synthetic {size:,}", np.arange(size), vectors, args.k, nprobes)
+    print(pd.DataFrame(results).to_string(index=False))
@@ -1,11 +1,15 @@
 # Main application file for Movie Recommendation System
 
+# pandas, the movie data and the recommenders are imported in main_application, so the login page
+# doesn't wait for them (warmup.py gets them ready in the background while it is shown)
 import streamlit as st
-import pandas as pd
-from recommender import recommend_movies_for_user
 from auth import auth
+from password_hasher import HasherBusy
 from profile_manager import profile_manager
+import metrics
+import warmup
 import os
+import time
 
 # Set up the page configuration
 st.set_page_config(
@@ -67,14 +71,23 @@ def show_login_page():
                 login_button = st.form_submit_button("Sign In", type="primary", use_container_width=True)
                 
                 if login_button:
+                    try:
+                        signed_in = bool(username and password) and auth.authenticate_user(username, password)
+                    except HasherBusy as e:
+                        # Too many sign-ins at once (see password_hasher.py)
+                        signed_in = None
+                        st.warning(str(e))
+                    
                     if not username or not password:
                         st.error("Please enter both username and password!")
-                    elif auth.authenticate_user(username, password):
+                    elif signed_in is None:
+                        pass
+                    elif signed_in:
                         # Login successful
                         st.session_state.logged_in = True
                         st.session_state.username = username
                         # Get user's theme preference
-                        user_info = auth.get_user_info(username)
+                        user_info = auth.get_profile(username)
                         if user_info:
                             st.session_state.theme = user_info.get('theme_preference', 'light')
                         st.success("Welcome back!")
@@ -116,28 +129,56 @@ def show_login_page():
                         else:
                             st.error(message)
 
+def show_debug_panel():
+    # Timings of the last queries and of every step so far (only shown when METRICS is set, see metrics.py)
+    import pandas as pd
+    with st.expander("Debug: recent queries"):
+        traces = list(metrics.recent_traces)[::-1]
+        if not traces:
+            st.caption("No queries yet")
+            return
+        st.dataframe(pd.DataFrame([{
+            'time': time.strftime('%H:%M:%S', time.localtime(trace.started_at)),
+            'query': trace.name,
+            'details': ", ".join(f"{key}={value}" for key, value in trace.info.items()),
+            'total ms': round(trace.total_ms, 2),
+            'steps (ms)': ", ".join(f"{name} {ms:.2f}" for name, ms in trace.spans if name != trace.name),
+            'error': trace.error or ""
+        } for trace in traces]), use_container_width=True)
+
+        histograms = metrics.sink_of_type(metrics.HistogramSink)
+        if histograms is not None:
+            st.markdown("**All steps so far**")
+            st.dataframe(pd.DataFrame(histograms.summary()).round(3), use_container_width=True)
+
 def main_application():
     # This is the main app that shows after user logs in
     load_styling()
+
+    import pandas as pd
+    from recommender import get_rating_aggregates, recommend_movies_for_user, recommend_popular_movies
+    from dataset import GENRE_NAMES, dataset
+    from movie_catalog import get_movie_catalog
+    from title_search import get_title_index
+    import rating_stream
     
-    # Load the movie datasets
+    # Get the movie datasets (loaded once per process, only re-read when a file changes)
     try:
-        users = pd.read_csv("data/users.csv", sep="|", encoding="latin1",
-                           names=["user_id", "age", "gender", "occupation", "zip_code"])
-        movies = pd.read_csv("data/movies.csv", sep="|", encoding="latin1",
-                            names=["movie_id", "title", "release_date", "video_release_date", "imdb_url"] + 
-                                  [f"genre_{i}" for i in range(19)])
-        ratings = pd.read_csv("data/ratings.csv", sep="\t", encoding="latin1",
-                             names=["user_id", "movie_id", "rating", "timestamp"])
+        dataset.reload_if_changed()
+        # Follow a file of new ratings if RATINGS_STREAM_FILE is set (see rating_stream.py)
+        rating_stream.start_from_env(dataset)
+        users = dataset.users
+        movies = dataset.movies
+        # Number and average of the ratings come from counts made a chunk at a time (see rating_loader.py)
+        rating_aggregates = get_rating_aggregates()
+        catalog = get_movie_catalog()
     except FileNotFoundError as e:
         st.error(f"Can't find data files: {e}")
         st.info("Make sure the data files are in the 'data' folder.")
         st.stop()
 
-    # List of movie genres
-    genre_names = ["Action", "Adventure", "Animation", "Children's", "Comedy", "Crime",
-                   "Documentary", "Drama", "Fantasy", "Film-Noir", "Horror", "Musical",
-                   "Mystery", "Romance", "Sci-Fi", "Thriller", "War", "Western", "Unknown"]
+    # List of movie genres (in the same order as the genre columns)
+    genre_names = GENRE_NAMES
 
     # Main page header
     st.title("🎬 Movie Recommendation System")
@@ -156,12 +197,16 @@ def main_application():
     st.sidebar.subheader("Search Movies")
     movie_search = st.sidebar.text_input("Type movie name:")
     if movie_search:
-        # Search for movies 
-        search_results = movies[movies['title'].str.contains(movie_search, case=False, na=False)]
-        if not search_results.empty:
-            st.sidebar.success(f"Found {len(search_results)} movies!")
-            with st.expander(f"Movies with '{movie_search}' ({len(search_results)} found)"):
-                st.dataframe(search_results[['movie_id', 'title']], use_container_width=True)
+        # Search for movies with the prebuilt title index (best matches first, see title_search.py)
+        with metrics.trace("search", query=movie_search):
+            found_ids, total_found = get_title_index().search(movie_search, limit=100)
+        if total_found:
+            st.sidebar.success(f"Found {total_found} movies!")
+            with st.expander(f"Movies with '{movie_search}' ({total_found} found)"):
+                if total_found > len(found_ids):
+                    st.caption(f"Showing the best {len(found_ids)}")
+                search_results = pd.DataFrame({'movie_id': found_ids, 'title': catalog.titles_for(found_ids)})
+                st.dataframe(search_results, use_container_width=True)
         else:
             st.sidebar.warning(f"No movies found with name'{movie_search}'")
     
@@ -203,29 +248,19 @@ def main_application():
                 try:
                     if user_id:
                         # Get personalized recommendations
-                        recommendations = recommend_movies_for_user(user_id, min_rating=min_rating, top_n=num_recommendations)
+                        recommendations = recommend_movies_for_user(user_id, min_rating=min_rating, top_n=num_recommendations,
+                                                                    genres=selected_genres)
                     else:
                         # Get popular movies instead
-                        popular_movies = ratings[ratings['rating'] >= min_rating].groupby('movie_id').agg({
-                            'rating': ['mean', 'count']
-                        }).reset_index()
-                        popular_movies.columns = ['movie_id', 'avg_rating', 'rating_count']
-                        popular_movies = popular_movies[popular_movies['rating_count'] >= 10]
-                        popular_movies = popular_movies.sort_values('avg_rating', ascending=False).head(num_recommendations)
-                        popular_movies['title'] = popular_movies['movie_id'].apply(
-                            lambda x: movies[movies['movie_id'] == x]['title'].values[0] if len(movies[movies['movie_id'] == x]) > 0 else "Unknown"
-                        )
-                        popular_movies.rename(columns={'avg_rating': 'predicted_rating'}, inplace=True)
-                        recommendations = popular_movies[['movie_id', 'title', 'predicted_rating', 'rating_count']]
+                        recommendations = recommend_popular_movies(min_rating=min_rating, top_n=num_recommendations,
+                                                                   genres=selected_genres)
                     
                     # Show the recommendations
                     if not recommendations.empty:
                         recommendations['movie_id'] = recommendations['movie_id'].astype(int)
                         
                         # Add IMDb links
-                        recommendations['IMDb Link'] = recommendations['movie_id'].apply(
-                            lambda x: movies[movies['movie_id'] == x]['imdb_url'].values[0] if len(movies[movies['movie_id'] == x]['imdb_url'].values) > 0 else ""
-                        )
+                        recommendations['IMDb Link'] = catalog.imdb_urls_for(recommendations['movie_id'])
                         recommendations['IMDb Link'] = recommendations['IMDb Link'].apply(
                             lambda url: f'<a href="{url}" target="_blank">View on IMDb</a>' if url else "No link"
                         )
@@ -266,8 +301,8 @@ def main_application():
             st.metric("Movies", f"{len(movies):,}")
             st.metric("Users", f"{len(users):,}")
         with stats_col2:
-            st.metric("Ratings", f"{len(ratings):,}")
-            avg_rating = ratings['rating'].mean()
+            st.metric("Ratings", f"{rating_aggregates.num_ratings:,}")
+            avg_rating = rating_aggregates.average_rating()
             st.metric("Avg Rating", f"{avg_rating:.1f}")
         
         # Show popular genres
@@ -284,9 +319,14 @@ def main_application():
         age_distribution = users['age'].value_counts().head(10)
         st.bar_chart(age_distribution)
 
+        if metrics.enabled:
+            show_debug_panel()
+
 # Main app logic 
 if __name__ == "__main__":
     if not st.session_state.logged_in:
         show_login_page()
+        # Load the movie data in the background while the user signs in (APP_WARMUP=0 turns it off)
+        warmup.start()
     else:
         main_application()
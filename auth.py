@@ -2,68 +2,81 @@
 # I am using SQLite database to store user information
 
 import sqlite3
-import bcrypt  # for password security
 import streamlit as st
 from datetime import datetime
 import os
+import threading
+from db_pool import SQLitePool
+import metrics
+from password_hasher import HasherBusy, PasswordHasher  # bcrypt runs in worker processes
 
 class UserAuth:
     def __init__(self, db_path="users.db"):
         self.db_path = db_path
-        self.setup_database()
+        # Open connections are kept and reused instead of connecting on every call (see db_pool.py)
+        self.pool = SQLitePool(db_path)
+        self.hasher = PasswordHasher()
+        # Bumped every time a user's row changes, so the profiles kept in each session know when to reload
+        self.profile_versions = {}
+        self.versions_lock = threading.Lock()
+        # The users table is created the first time the database is used, not when this file is imported
+        self.database_ready = False
+        self.setup_lock = threading.Lock()
+    
+    def connection(self):
+        # A connection from the pool, making sure the users table exists first
+        if not self.database_ready:
+            with self.setup_lock:
+                if not self.database_ready:
+                    self.setup_database()
+                    self.database_ready = True
+        return self.pool.connection()
     
     def setup_database(self):
 
         # Create the database table if it doesn't exist already
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # This creates the users table with all the required columns 
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                email TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                full_name TEXT,
-                age INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                theme_preference TEXT DEFAULT 'light'
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
+        with self.pool.connection() as conn:
+            # This creates the users table with all the required columns 
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    username TEXT UNIQUE NOT NULL,
+                    email TEXT UNIQUE NOT NULL,
+                    password_hash TEXT NOT NULL,
+                    full_name TEXT,
+                    age INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    theme_preference TEXT DEFAULT 'light'
+                )
+            ''')
     
+    @metrics.timed("auth.hash_password")
     def make_password_secure(self, password):
         # Hash the password so we don't store plain text passwords
-        return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+        return self.hasher.hash_password(password)
     
+    @metrics.timed("auth.check_password")
     def check_password(self, password, stored_hash):
         # Check if the entered password matches the stored hash
-        return bcrypt.checkpw(password.encode('utf-8'), stored_hash)
+        return self.hasher.check_password(password, stored_hash)
     
+    @metrics.timed("auth.create_user")
     def create_user(self, username, email, password, full_name="", age=None):
         # Add a new user to the database
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
         try:
             # Make password secure before storing
             secure_password = self.make_password_secure(password)
             
-            # Insert new user into database
-            cursor.execute('''
-                INSERT INTO users (username, email, password_hash, full_name, age)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (username, email, secure_password, full_name, age))
+            # Insert new user into database (committed when the with block ends)
+            with self.connection() as conn:
+                conn.execute('''
+                    INSERT INTO users (username, email, password_hash, full_name, age)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (username, email, secure_password, full_name, age))
             
-            conn.commit()
-            conn.close()
             return True, "Account created successfully!"
         
         except sqlite3.IntegrityError as e:
-            conn.close()
             # Check what went wrong
             if "username" in str(e):
                 return False, "This username is already taken!"
@@ -72,36 +85,43 @@ class UserAuth:
             else:
                 return False, "Something went wrong while creating the account!"
         except Exception as e:
-            conn.close()
             return False, f"Error: {str(e)}"
     
+    @metrics.timed("auth.authenticate_user")
     def authenticate_user(self, username, password):
         # Check if username and password are correct
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
         # Get the stored password hash for this username
-        cursor.execute('SELECT password_hash FROM users WHERE username = ?', (username,))
-        result = cursor.fetchone()
-        conn.close()
+        with self.connection() as conn:
+            result = conn.execute('SELECT password_hash FROM users WHERE username = ?', (username,)).fetchone()
         
         # If user exists and password matches, return True
         if result and self.check_password(password, result[0]):
+            self.upgrade_password_hash(username, password, result[0])
             return True
         return False
     
+    def upgrade_password_hash(self, username, password, stored_hash):
+        # Old hashes made with a lower bcrypt cost are re-hashed with the current cost after a
+        # successful login (the only time we have the plain password)
+        if not self.hasher.needs_rehash(stored_hash):
+            return
+        try:
+            new_hash = self.make_password_secure(password)
+            with self.connection() as conn:
+                conn.execute('UPDATE users SET password_hash = ? WHERE username = ? AND password_hash = ?',
+                             (new_hash, username, stored_hash))
+        except (HasherBusy, sqlite3.Error) as e:
+            # Not a problem, we will try again on the next login
+            print("Couldn't upgrade password hash:", e)
+    
+    @metrics.timed("auth.get_user_info")
     def get_user_info(self, username):
         # Get all info about a user
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT username, email, full_name, age, created_at, theme_preference 
-            FROM users WHERE username = ?
-        ''', (username,))
-        
-        result = cursor.fetchone()
-        conn.close()
+        with self.connection() as conn:
+            result = conn.execute('''
+                SELECT username, email, full_name, age, created_at, theme_preference 
+                FROM users WHERE username = ?
+            ''', (username,)).fetchone()
         
         if result:
             # Return user info as a dictionary
@@ -115,11 +135,31 @@ class UserAuth:
             }
         return None
     
+    def profile_version(self, username):
+        with self.versions_lock:
+            return self.profile_versions.get(username, 0)
+    
+    def profile_changed(self, username):
+        # Called after every write to a user's row (write-through invalidation of the session caches)
+        with self.versions_lock:
+            self.profile_versions[username] = self.profile_versions.get(username, 0) + 1
+    
+    @metrics.timed("auth.get_profile")
+    def get_profile(self, username):
+        # Same as get_user_info, but the result is kept in the Streamlit session, so reruns
+        # don't read the database again until the profile is changed
+        version = self.profile_version(username)
+        cached = st.session_state.get('profile_cache')
+        if cached and cached[0] == username and cached[1] == version:
+            return dict(cached[2]) if cached[2] else None
+        
+        user_info = self.get_user_info(username)
+        st.session_state.profile_cache = (username, version, user_info)
+        return dict(user_info) if user_info else None
+    
+    @metrics.timed("auth.update_user_info")
     def update_user_info(self, username, email=None, full_name=None, age=None):
         # Update user profile information
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
         try:
             # Build the update query acc. to provided fields
             updates = []
@@ -139,53 +179,55 @@ class UserAuth:
             if updates:
                 params.append(username)
                 query = f"UPDATE users SET {', '.join(updates)} WHERE username = ?"
-                cursor.execute(query, params)
-                conn.commit()
+                with self.connection() as conn:
+                    conn.execute(query, params)
+                self.profile_changed(username)
             
-            conn.close()
             return True, "Profile updated!"
         
         except sqlite3.IntegrityError:
-            conn.close()
             return False, "That email is already being used!"
         except Exception as e:
-            conn.close()
             return False, f"Error: {str(e)}"
     
+    @metrics.timed("auth.change_password")
     def change_password(self, username, old_password, new_password):
         # Change user's password after checking if the old password is correct
-        if not self.authenticate_user(username, old_password):
+        with self.connection() as conn:
+            result = conn.execute('SELECT password_hash FROM users WHERE username = ?', (username,)).fetchone()
+        if not result:
             return False, "Your current password is wrong!"
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
         try:
-            # Hash the new password and update it
-            new_hash = self.make_password_secure(new_password)
-            cursor.execute('UPDATE users SET password_hash = ? WHERE username = ?', 
-                         (new_hash, username))
-            conn.commit()
-            conn.close()
+            # Check the old password and hash the new one at the same time (two workers),
+            # so changing a password takes one bcrypt run of time instead of two
+            old_check = self.hasher.check_password_async(old_password, result[0])
+            new_hash = self.hasher.hash_password_async(new_password)
+            if not old_check.result():
+                new_hash.cancel()
+                return False, "Your current password is wrong!"
+            new_hash = new_hash.result()
+            with self.connection() as conn:
+                conn.execute('UPDATE users SET password_hash = ? WHERE username = ?', 
+                             (new_hash, username))
+            self.profile_changed(username)
             return True, "Password changed!"
         
+        except HasherBusy as e:
+            return False, str(e)
         except Exception as e:
-            conn.close()
             return False, f"Error: {str(e)}"
     
+    @metrics.timed("auth.update_theme_preference")
     def update_theme_preference(self, username, theme):
         # Save user's theme preference between light/dark
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
         try:
-            cursor.execute('UPDATE users SET theme_preference = ? WHERE username = ?', 
-                         (theme, username))
-            conn.commit()
-            conn.close()
+            with self.connection() as conn:
+                conn.execute('UPDATE users SET theme_preference = ? WHERE username = ?', 
+                             (theme, username))
+            self.profile_changed(username)
             return True
         except Exception:
-            conn.close()
             return False
 
 # Create the auth object that will be used in other files
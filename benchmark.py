@@ -0,0 +1,136 @@
+# This file times the recommendation functions so we can see if a change made them faster or slower.
+# It first checks that the sparse recommender gives the same results as the original pandas version
+# (and stops with an error if not)
+# Run it with: python benchmark.py [--check-only]
+
+import time
+from functools import partial
+import numpy as np
+from dataset import TABLE_FILES, MovieDataset, dataset
+from movie_catalog import genre_mask, get_movie_catalog
+from recommender import (recommend_movies_for_user, recommend_movies_for_users, recommend_movies_with_pandas,
+                         recommendation_cache)
+
+def time_calls(function, user_ids, min_rating, top_n):
+    # Run the function for every user and return the time of each call in milliseconds
+    timings = []
+    for user_id in user_ids:
+        start = time.perf_counter()
+        function(user_id, min_rating=min_rating, top_n=top_n)
+        timings.append((time.perf_counter() - start) * 1000)
+    return np.array(timings)
+
+def rank_for_check(recommendations):
+    # Rank like every ranking in the app (highest predicted_rating first, equal ones by lower movie_id).
+    # pandas and the sparse version add up the weighted ratings in a different order, so equal scores can
+    # differ in the last bits: they are rounded first
+    rounded = recommendations['predicted_rating'].round(9)
+    ranked = recommendations.assign(rounded=rounded).sort_values(['rounded', 'movie_id'], ascending=[False, True])
+    return ranked.reset_index(drop=True)
+
+def same_recommendations(candidates, actual, top_n):
+    # candidates: everything the pandas version recommends (genre filter applied), actual: the top_n of the
+    # sparse version. Where the last places are a tie, either version may pick any of the tied movies
+    expected = rank_for_check(candidates)
+    actual = rank_for_check(actual)
+    if len(actual) != min(top_n, len(expected)) or list(actual.columns) != list(expected.columns):
+        return False
+    if actual.empty:
+        return True
+    last_score = actual['rounded'].iloc[-1]
+    before_last = expected['rounded'] > last_score
+    tied = expected[expected['rounded'] == last_score]
+    if not np.array_equal(actual['movie_id'][actual['rounded'] > last_score], expected['movie_id'][before_last]):
+        return False
+    if not np.isin(actual['movie_id'][actual['rounded'] == last_score], tied['movie_id']).all():
+        return False
+    matched = expected.set_index('movie_id').loc[actual['movie_id']].reset_index()
+    return (np.array_equal(matched['title'], actual['title']) and
+            np.array_equal(matched['rating_count'], actual['rating_count']) and
+            np.allclose(matched['predicted_rating'], actual['predicted_rating'], rtol=1e-9) and
+            np.allclose(matched['avg_rating'], actual['avg_rating'], rtol=1e-9))
+
+def check_recommenders(num_users=60, thresholds=(3, 4, 5), top_n=10, genre_sets=(None, ["Drama"], ["Comedy", "Romance"])):
+    # Compare the sparse recommender with the pandas reference for a sample of users (spread over all of
+    # them), thresholds and genre filters. Returns a list of the settings that don't match
+    all_users = np.sort(dataset.users['user_id'].values)
+    user_ids = all_users[np.linspace(0, len(all_users) - 1, num_users).astype(int)]
+    catalog = get_movie_catalog()
+    mismatches = []
+    for user_id in user_ids:
+        for min_rating in thresholds:
+            # Every candidate of the pandas version (it has no genre filter, that is done here)
+            everything = recommend_movies_with_pandas(user_id, min_rating=min_rating, top_n=10 ** 9)
+            for genres in genre_sets:
+                candidates = everything
+                if genres and not everything.empty:
+                    candidates = everything[catalog.has_any_genre(everything['movie_id'], genre_mask(genres))]
+                recommendation_cache.clear()
+                actual = recommend_movies_for_user(user_id, min_rating=min_rating, top_n=top_n, genres=genres)
+                if not same_recommendations(candidates, actual, top_n):
+                    mismatches.append((int(user_id), min_rating, genres))
+    checked = len(user_ids) * len(thresholds) * len(genre_sets)
+    print(f"Sparse vs pandas: {checked - len(mismatches)} of {checked} settings match")
+    for user_id, min_rating, genres in mismatches[:10]:
+        print(f"  different: user {user_id}, min_rating={min_rating}, genres={genres}")
+    return mismatches
+
+def compare_recommenders(num_users=100, min_rating=4, top_n=5):
+    # Time the sparse version against the original pandas version on the same users
+    user_ids = dataset.users['user_id'].values[:num_users]
+    recommend_movies_for_user(user_ids[0], min_rating=min_rating, top_n=top_n)  # build the matrices first
+
+    results = {}
+    recommendation_cache.clear()
+    item_based = partial(recommend_movies_for_user, strategy="item")
+    item_based(user_ids[0], min_rating=min_rating, top_n=top_n)  # load the item neighbour lists first
+    for name, function in [("pandas", recommend_movies_with_pandas), ("sparse", recommend_movies_for_user),
+                           ("cached", recommend_movies_for_user), ("item", item_based)]:
+        # "cached" repeats the sparse calls, so every one is answered from the result cache
+        timings = time_calls(function, user_ids, min_rating, top_n)
+        results[name] = timings
+        print(f"{name:>8}: mean {timings.mean():7.2f} ms   p50 {np.percentile(timings, 50):7.2f} ms   "
+              f"p95 {np.percentile(timings, 95):7.2f} ms")
+
+    print(f"Speedup: {results['pandas'].mean() / results['sparse'].mean():.1f}x")
+    return results
+
+def time_batch(min_rating=4, top_n=5, chunk_size=500):
+    # Time recommending for every user at once against one call per user
+    user_ids = dataset.users['user_id'].values
+
+    start = time.perf_counter()
+    recommend_movies_for_users(user_ids, min_rating=min_rating, top_n=top_n, chunk_size=chunk_size)
+    batch_seconds = time.perf_counter() - start
+
+    recommendation_cache.clear()
+    start = time.perf_counter()
+    for user_id in user_ids:
+        recommend_movies_for_user(user_id, min_rating=min_rating, top_n=top_n)
+    loop_seconds = time.perf_counter() - start
+
+    print(f"All {len(user_ids)} users: batch {batch_seconds:.2f} s   one by one {loop_seconds:.2f} s   "
+          f"speedup {loop_seconds / batch_seconds:.1f}x")
+
+def time_loading():
+    # Time loading all data files from the CSV text against the binary cache
+    for name, use_cache in [("csv", False), ("cache", True)]:
+        MovieDataset(use_cache=use_cache).ratings  # make sure the cache exists before timing
+        start = time.perf_counter()
+        data = MovieDataset(use_cache=use_cache)
+        for table in TABLE_FILES:
+            data.table(table)
+        print(f"Load all tables from {name:>5}: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+if __name__ == "__main__":
+    import sys
+
+    if check_recommenders():
+        sys.exit(1)
+    if "--check-only" in sys.argv:
+        sys.exit(0)
+    time_loading()
+    for threshold in [3, 4, 5]:
+        print(f"\nmin_rating={threshold}")
+        compare_recommenders(min_rating=threshold)
+        time_batch(min_rating=threshold)
@@ -0,0 +1,285 @@
+# This file is the full benchmark: it times the recommender, the popular movies list, title search,
+# data loading and login on the real data and on bigger made-up copies of it (10x, 100x ratings),
+# writes p50/p95/p99 latency, throughput and peak memory as JSON, and compares them with a saved
+# baseline. If something got clearly slower (or uses clearly more memory) the run fails.
+# The saved baseline (benchmark_baseline.json) holds times measured on one machine (see its "system"
+# part): on another machine, run with --save-baseline first and compare later runs with that
+# Run it with: python benchmark_suite.py [--scales 1,10,100] [--output results.json] [--save-baseline]
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import rating_loader
+from dataset import TABLE_FILES, MovieDataset, dataset
+from matrix_factorization import FactorModel
+from title_search import get_title_index
+from recommender import get_rating_matrix, recommend_movies_for_user, recommend_popular_movies, recommendation_cache
+
+BASELINE_FILE = "benchmark_baseline.json"
+THRESHOLDS = [3, 4, 5]
+TOP_NS = [5, 20]
+SEARCH_QUERIES = ["star", "the", "love", "1995", "godfather", "x", "night of the"]
+
+def summarize(timings, total_seconds, peak_bytes):
+    # Latency percentiles (ms), calls per second and peak traced memory (MB) of one case
+    timings = np.asarray(timings) * 1000
+    return {
+        'calls': len(timings),
+        'mean_ms': round(float(timings.mean()), 4),
+        'p50_ms': round(float(np.percentile(timings, 50)), 4),
+        'p95_ms': round(float(np.percentile(timings, 95)), 4),
+        'p99_ms': round(float(np.percentile(timings, 99)), 4),
+        'throughput_per_s': round(len(timings) / total_seconds, 2) if total_seconds > 0 else None,
+        'peak_mem_mb': round(peak_bytes / 1e6, 3),
+    }
+
+def run_case(function, calls, before_each=None):
+    # Time function(*args) for every args in calls, then run the first call again with
+    # tracemalloc on to get its peak memory (tracing slows things down, so it isn't timed)
+    timings = []
+    start_all = time.perf_counter()
+    for args in calls:
+        if before_each is not None:
+            before_each()
+        start = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - start)
+    total_seconds = time.perf_counter() - start_all
+
+    if before_each is not None:
+        before_each()
+    tracemalloc.start()
+    function(*calls[0])
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return summarize(timings, total_seconds, peak_bytes)
+
+def scaled_data_dir(scale):
+    # The bundled data for scale 1. Bigger scales copy every user (scale - 1) times with new ids and
+    # slightly changed ratings, so there are scale x as many ratings with a realistic spread.
+    # Made once and kept in data/cache/benchmark_x<scale>
+    if scale == 1:
+        return "data"
+    data_dir = os.path.join("data", "cache", f"benchmark_x{scale}")
+    if os.path.exists(os.path.join(data_dir, TABLE_FILES['ratings'][0])):
+        return data_dir
+
+    print(f"Making {scale}x data in {data_dir} ...")
+    os.makedirs(data_dir, exist_ok=True)
+    source = MovieDataset(use_cache=False)
+    users, ratings = source.users, source.ratings
+    id_step = int(users['user_id'].max())
+    rng = np.random.default_rng(scale)
+
+    user_copies, rating_copies = [], []
+    for copy in range(scale):
+        user_copies.append(users.assign(user_id=users['user_id'] + copy * id_step))
+        changed = ratings['rating'].to_numpy() + (rng.choice([-1, 0, 0, 0, 1], len(ratings)) if copy else 0)
+        rating_copies.append(ratings.assign(user_id=ratings['user_id'] + copy * id_step, rating=changed.clip(1, 5)))
+
+    for name, table in [('users', pd.concat(user_copies)), ('ratings', pd.concat(rating_copies))]:
+        file_name, separator, columns = TABLE_FILES[name]
+        table.to_csv(os.path.join(data_dir, file_name), sep=separator, header=False, index=False, encoding="latin1")
+    with open(source.file_path('movies'), 'rb') as f, open(os.path.join(data_dir, TABLE_FILES['movies'][0]), 'wb') as out:
+        out.write(f.read())
+    return data_dir
+
+def use_data_dir(data_dir):
+    # Point the shared dataset (the one the recommender uses) at another data folder
+    dataset.data_dir = data_dir
+    dataset.reload()
+    recommendation_cache.clear()
+
+def load_all_tables(data_dir, use_cache):
+    data = MovieDataset(data_dir, use_cache=use_cache)
+    for name in TABLE_FILES:
+        data.table(name)
+
+def search_titles(query):
+    # The sidebar search of app.py
+    return get_title_index().search(query, limit=100)
+
+def benchmark_scale(scale, results):
+    data_dir = scaled_data_dir(scale)
+    prefix = f"x{scale}"
+    repeats = 3 if scale <= 10 else 1
+    num_users = 50 if scale <= 10 else 20
+
+    # Loading (the binary cache is made by the first cached load)
+    load_all_tables(data_dir, True)
+    results[f"{prefix}/load_csv"] = run_case(load_all_tables, [(data_dir, False)] * repeats)
+    results[f"{prefix}/load_cache"] = run_case(load_all_tables, [(data_dir, True)] * repeats)
+
+    # Getting the rating matrix after a start (what the first recommendation pays): mapped from
+    # data/cache, which the first call builds (see rating_loader.py)
+    def fresh_tables():
+        use_data_dir(data_dir)
+        dataset.ratings
+
+    results[f"{prefix}/build_rating_matrix"] = run_case(
+        lambda: get_rating_matrix().liked_matrices(4), [()] * repeats, before_each=fresh_tables
+    )
+
+    benchmark_streamed_loader(prefix, repeats, results)
+
+    # Training the matrix factorization model (the app trains it once per data version)
+    results[f"{prefix}/train_mf"] = run_case(
+        lambda: FactorModel.train(get_rating_matrix(), iterations=5), [()] * (1 if scale > 10 else repeats)
+    )
+
+    user_ids = np.random.default_rng(0).choice(dataset.users['user_id'].to_numpy(), num_users, replace=False)
+    for min_rating in THRESHOLDS:
+        recommend_movies_for_user(int(user_ids[0]), min_rating=min_rating)  # build the matrices first
+        for top_n in TOP_NS:
+            calls = [(int(user_id), min_rating, top_n) for user_id in user_ids]
+            results[f"{prefix}/recommend_user/min{min_rating}_top{top_n}"] = run_case(
+                recommend_movies_for_user, calls, before_each=recommendation_cache.clear
+            )
+
+    calls = [(int(user_id), 4, 5) for user_id in user_ids]
+    for args in calls:
+        recommend_movies_for_user(*args)  # fill the result cache
+    results[f"{prefix}/recommend_user_cached/min4_top5"] = run_case(recommend_movies_for_user, calls)
+    recommend_movies_for_user(int(user_ids[0]), 4, 5, strategy="item")  # load / build the neighbour lists first
+    results[f"{prefix}/recommend_item/min4_top5"] = run_case(
+        lambda user_id, min_rating, top_n: recommend_movies_for_user(user_id, min_rating, top_n, strategy="item"),
+        calls, before_each=recommendation_cache.clear
+    )
+    recommend_movies_for_user(int(user_ids[0]), 4, 5, strategy="mf")  # load / train the factors first
+    results[f"{prefix}/recommend_mf/min4_top5"] = run_case(
+        lambda user_id, min_rating, top_n: recommend_movies_for_user(user_id, min_rating, top_n, strategy="mf"),
+        calls, before_each=recommendation_cache.clear
+    )
+
+    for min_rating in THRESHOLDS:
+        results[f"{prefix}/popular/min{min_rating}_top5"] = run_case(recommend_popular_movies, [(min_rating, 5)] * 200)
+    results[f"{prefix}/popular_genres/min4_top10"] = run_case(
+        recommend_popular_movies, [(4, 10, ["Comedy", "Drama"])] * 200
+    )
+
+    get_title_index()  # build the index first
+    results[f"{prefix}/title_search"] = run_case(search_titles, [(query,) for query in SEARCH_QUERIES] * 20)
+
+def benchmark_streamed_loader(prefix, repeats, results):
+    # The streamed loader: the rating counts and the rating matrix built from the cached ratings a chunk
+    # at a time, and a liked matrix of another threshold built from the saved matrix the same way
+    table = rating_loader.cached_ratings(dataset)
+    results[f"{prefix}/stream_rating_counts"] = run_case(
+        lambda: rating_loader.RatingAggregates.build(rating_loader.column_chunks(table)), [()] * repeats
+    )
+    with tempfile.TemporaryDirectory() as temp_dir:
+        matrix_dir = os.path.join(temp_dir, "rating_matrix")
+        results[f"{prefix}/stream_rating_matrix"] = run_case(
+            lambda: rating_loader.build_rating_matrix(matrix_dir, table, dataset.file_path('ratings')),
+            [()] * repeats, before_each=lambda: shutil.rmtree(matrix_dir, ignore_errors=True)
+        )
+        results[f"{prefix}/stream_liked_matrices/min3"] = run_case(
+            lambda: rating_loader.load_or_build_liked(matrix_dir, 3), [()] * repeats,
+            before_each=lambda: shutil.rmtree(os.path.join(matrix_dir, "liked_3"), ignore_errors=True)
+        )
+
+def benchmark_auth(results, bcrypt_rounds=10, num_users=20):
+    # Sign-up, login and profile reads against a temporary database
+    from auth import UserAuth
+    from password_hasher import PasswordHasher
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        user_auth = UserAuth(os.path.join(temp_dir, "benchmark.db"))
+        user_auth.hasher = PasswordHasher(rounds=bcrypt_rounds)
+        names = [f"user{i}" for i in range(num_users)]
+        signups = iter(names + ["memory_check"])  # the memory pass repeats the first call, so it needs a name too
+
+        def sign_up():
+            name = next(signups)
+            user_auth.create_user(name, f"{name}@example.com", "password123")
+
+        results["auth/create_user"] = run_case(sign_up, [()] * num_users)
+        results["auth/login"] = run_case(user_auth.authenticate_user, [(name, "password123") for name in names])
+        results["auth/get_user_info"] = run_case(user_auth.get_user_info, [(name,) for name in names] * 25)
+        user_auth.hasher.shutdown()
+        user_auth.pool.close_all()
+
+def compare_with_baseline(results, baseline, tolerance, min_ms=0.05, min_mb=1.0):
+    # Cases that got slower (p50 / p95) or use more memory than the baseline by more than tolerance
+    # (0.5 = 50%). Tiny absolute differences are ignored, they are just timer noise
+    regressions = []
+    for name, base in baseline.get('results', {}).items():
+        current = results.get(name)
+        if current is None:
+            continue
+        for metric, floor in [('p50_ms', min_ms), ('p95_ms', min_ms), ('peak_mem_mb', min_mb)]:
+            if current[metric] > base[metric] * (1 + tolerance) and current[metric] - base[metric] > floor:
+                regressions.append(f"{name} {metric}: {base[metric]:.3f} -> {current[metric]:.3f}")
+    return regressions
+
+def system_info():
+    info = {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    try:
+        import resource
+        # Highest memory use of the whole run (kilobytes on Linux)
+        info['max_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    except ImportError:
+        pass
+    return info
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the recommender and app data paths")
+    parser.add_argument("--scales", default="1,10", help="comma separated ratings multipliers, e.g. 1,10,100")
+    parser.add_argument("--output", help="write the results JSON to this file (default: print it)")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="baseline JSON to compare with")
+    parser.add_argument("--save-baseline", action="store_true", help="save these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="allowed slowdown before failing (0.5 = 50%%)")
+    parser.add_argument("--skip-auth", action="store_true", help="don't benchmark login (it is slow on purpose)")
+    args = parser.parse_args()
+
+    results = {}
+    for scale in [int(scale) for scale in args.scales.split(",")]:
+        benchmark_scale(scale, results)
+    use_data_dir("data")
+    if not args.skip_auth:
+        benchmark_auth(results)
+    report = {'system': system_info(), 'results': results}
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            f.write(text + "\n")
+        print(f"Saved baseline to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save-baseline to make one")
+        return 0
+    with open(args.baseline) as f:
+        regressions = compare_with_baseline(results, json.load(f), args.tolerance)
+    if regressions:
+        print(f"{len(regressions)} regression(s) against {args.baseline}:")
+        for regression in regressions:
+            print("  " + regression)
+        return 1
+    print(f"No regressions against {args.baseline}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,161 @@
+# This file stores the data tables in a compact binary format next to the CSV files, so they can be
+# loaded with memory mapping instead of parsing text. Several worker processes that load the same
+# files share the same physical memory pages. The CSV files stay the source of truth: a cached
+# table is rebuilt whenever its CSV file changes (different modification time or size)
+# Convert all tables with: python data_cache.py
+
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+CACHE_FORMAT = 1
+
+# Numeric columns and the smallest type that fits them
+COLUMN_TYPES = {
+    'user_id': np.int32,
+    'movie_id': np.int32,
+    'rating': np.int8,
+    'timestamp': np.int32,
+    'age': np.int16,
+}
+
+def cache_dir_for(data_dir, name):
+    return os.path.join(data_dir, "cache", name)
+
+def source_signature(source_path):
+    # What a cached table remembers about its CSV file to know if it is still up to date
+    stat = os.stat(source_path)
+    return {'mtime': stat.st_mtime, 'size': stat.st_size, 'format': CACHE_FORMAT}
+
+def save_array(path, array):
+    # Write to a temporary file first, so other processes never see a half-written file
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(temp_path, path)
+
+def write_table(data_dir, name, table, source_path):
+    # Save a table as one .npy file per column. Genre flags are bit-packed into one matrix
+    # and text columns are saved as one UTF-8 byte array plus start offsets
+    cache_dir = cache_dir_for(data_dir, name)
+    os.makedirs(cache_dir, exist_ok=True)
+    columns = {}
+
+    genre_columns = [column for column in table.columns if column.startswith("genre_")]
+    if genre_columns:
+        genres = table[genre_columns].to_numpy(dtype=np.uint8)
+        save_array(os.path.join(cache_dir, "genres.npy"), np.packbits(genres, axis=1))
+
+    for column in table.columns:
+        if column in genre_columns:
+            columns[column] = 'genre'
+        elif column in COLUMN_TYPES:
+            save_array(os.path.join(cache_dir, f"{column}.npy"), table[column].to_numpy(dtype=COLUMN_TYPES[column]))
+            columns[column] = 'number'
+        else:
+            missing = table[column].isna().to_numpy()
+            encoded = [b"" if is_missing else str(value).encode("utf-8")
+                       for value, is_missing in zip(table[column], missing)]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(value) for value in encoded])
+            save_array(os.path.join(cache_dir, f"{column}.text.npy"), np.frombuffer(b"".join(encoded), dtype=np.uint8))
+            save_array(os.path.join(cache_dir, f"{column}.offsets.npy"), offsets)
+            save_array(os.path.join(cache_dir, f"{column}.missing.npy"), missing)
+            columns[column] = 'text'
+
+    # The meta file is written last: a table only counts as cached once it exists
+    write_meta(cache_dir, dict(source_signature(source_path), rows=len(table), columns=columns))
+
+def write_table_chunks(data_dir, name, chunks, source_path):
+    # Same as write_table for a table of number columns only, but from data frames of a few rows each
+    # (e.g. read_csv with chunksize), so the whole table is never in memory. Every column is added to a
+    # raw file chunk by chunk, and the raw files get a .npy header at the end. Returns the number of rows
+    cache_dir = cache_dir_for(data_dir, name)
+    os.makedirs(cache_dir, exist_ok=True)
+    raw_paths = {}
+    rows = 0
+    try:
+        for chunk in chunks:
+            for column in chunk.columns:
+                raw_paths.setdefault(column, os.path.join(cache_dir, f"{column}.{os.getpid()}.raw"))
+                with open(raw_paths[column], "ab" if rows else "wb") as f:
+                    f.write(chunk[column].to_numpy(dtype=COLUMN_TYPES[column]).tobytes())
+            rows += len(chunk)
+
+        for column, raw_path in raw_paths.items():
+            path = os.path.join(cache_dir, f"{column}.npy")
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, "wb") as f, open(raw_path, "rb") as raw:
+                header = {'descr': np.dtype(COLUMN_TYPES[column]).str, 'fortran_order': False, 'shape': (rows,)}
+                np.lib.format.write_array_header_1_0(f, header)
+                shutil.copyfileobj(raw, f, 16 * 1024 * 1024)
+            os.replace(temp_path, path)
+    finally:
+        for raw_path in raw_paths.values():
+            if os.path.exists(raw_path):
+                os.remove(raw_path)
+
+    write_meta(cache_dir, dict(source_signature(source_path), rows=rows,
+                               columns={column: 'number' for column in raw_paths}))
+    return rows
+
+def write_meta(cache_dir, meta):
+    # Save the meta.json of a folder of saved files. Written last, under a temporary name that is then
+    # renamed, so a folder that is only half saved is never used (see read_meta)
+    temp_path = os.path.join(cache_dir, f"meta.json.{os.getpid()}.tmp")
+    with open(temp_path, "w") as f:
+        json.dump(meta, f)
+    os.replace(temp_path, os.path.join(cache_dir, "meta.json"))
+
+def read_meta(cache_dir, source_path=None):
+    # The meta.json of a folder of saved files, or None if there is none (or it isn't finished yet).
+    # With source_path, also None if that file changed since the files were saved from it
+    try:
+        with open(os.path.join(cache_dir, "meta.json")) as f:
+            meta = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if source_path is not None and any(meta.get(key) != value for key, value in source_signature(source_path).items()):
+        return None
+    return meta
+
+def read_table(data_dir, name, source_path):
+    # Load a cached table, or return None if there is no cache or the CSV changed since it was written
+    cache_dir = cache_dir_for(data_dir, name)
+    meta = read_meta(cache_dir, source_path)
+    if meta is None:
+        return None
+
+    data = {}
+    genres = None
+    genre_position = 0
+    for column, kind in meta['columns'].items():
+        if kind == 'number':
+            # Memory-mapped, so the numbers are only read from disk when used
+            data[column] = np.load(os.path.join(cache_dir, f"{column}.npy"), mmap_mode='r')
+        elif kind == 'genre':
+            if genres is None:
+                packed = np.load(os.path.join(cache_dir, "genres.npy"), mmap_mode='r')
+                genres = np.unpackbits(packed, axis=1)
+            data[column] = genres[:, genre_position].astype(np.int64)
+            genre_position += 1
+        else:
+            text = np.load(os.path.join(cache_dir, f"{column}.text.npy"), mmap_mode='r').tobytes()
+            offsets = np.load(os.path.join(cache_dir, f"{column}.offsets.npy"))
+            missing = np.load(os.path.join(cache_dir, f"{column}.missing.npy"))
+            values = [None if is_missing else text[start:end].decode("utf-8")
+                      for start, end, is_missing in zip(offsets[:-1], offsets[1:], missing)]
+            data[column] = pd.array(values, dtype="str")
+
+    return pd.DataFrame(data, copy=False)
+
+if __name__ == "__main__":
+    from dataset import TABLE_FILES, dataset
+
+    # Convert every CSV file to the binary format (rebuilding even if it is up to date)
+    for name in TABLE_FILES:
+        table = dataset.read_csv(name)
+        write_table(dataset.data_dir, name, table, dataset.file_path(name))
+        print(f"Cached {name}: {len(table):,} rows")
@@ -0,0 +1,342 @@
+# This file loads the MovieLens data files once per process and shares them between app.py and recommender.py
+# Tables are only read again when a file on disk changes (checked using the file modification time)
+# New ratings can be added while the app runs with append_ratings(); they are used straight away and
+# written to ratings.csv from time to time (compact_ratings). Code that uses what they change (e.g. the
+# rating matrix) from other threads does so inside dataset.reading()
+
+import contextlib
+import os
+import threading
+import time
+import pandas as pd
+import data_cache
+import metrics
+
+GENRE_COLUMNS = [f"genre_{i}" for i in range(19)]
+
+# Genre names in the same order as the genre_0 ... genre_18 columns (see data/genres.csv)
+GENRE_NAMES = ["Unknown", "Action", "Adventure", "Animation", "Children's", "Comedy", "Crime",
+               "Documentary", "Drama", "Fantasy", "Film-Noir", "Horror", "Musical",
+               "Mystery", "Romance", "Sci-Fi", "Thriller", "War", "Western"]
+
+# How to read each data file: file name, separator and column names
+TABLE_FILES = {
+    'users': ("users.csv", "|", ["user_id", "age", "gender", "occupation", "zip_code"]),
+    'movies': ("movies.csv", "|", ["movie_id", "title", "release_date", "video_release_date", "imdb_url"] + GENRE_COLUMNS),
+    'ratings': ("ratings.csv", "\t", ["user_id", "movie_id", "rating", "timestamp"]),
+}
+
+class ReadWriteLock:
+    # Many readers at a time, or one writer. A thread can take it again while it holds it (nested calls),
+    # and new readers wait while a writer is waiting, so a steady stream of readers can't starve it
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = {}  # thread id -> how many times it holds the read lock
+        self._writer = None  # thread id of the writer
+        self._writer_depth = 0
+        self._writers_waiting = 0
+
+    @contextlib.contextmanager
+    def reading(self):
+        me = threading.get_ident()
+        with self._condition:
+            if self._writer != me and me not in self._readers:
+                while self._writer is not None or self._writers_waiting:
+                    self._condition.wait()
+            self._readers[me] = self._readers.get(me, 0) + 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers[me] -= 1
+                if self._readers[me] == 0:
+                    del self._readers[me]
+                    self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def writing(self):
+        me = threading.get_ident()
+        with self._condition:
+            if self._writer != me:
+                self._writers_waiting += 1
+                # A thread that is reading itself can still write once the other readers are done
+                while self._writer is not None or any(reader != me for reader in self._readers):
+                    self._condition.wait()
+                self._writers_waiting -= 1
+                self._writer = me
+            self._writer_depth += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writer_depth -= 1
+                if self._writer_depth == 0:
+                    self._writer = None
+                    self._condition.notify_all()
+
+class MovieDataset:
+    def __init__(self, data_dir="data", use_cache=True, compact_after=10000):
+        self.data_dir = data_dir
+        self.use_cache = use_cache  # load from the binary cache in data/cache (see data_cache.py)
+        self.compact_after = compact_after  # write appended ratings to disk once there are this many (None = never)
+        self.version = 0  # goes up by one every time the data is reloaded or ratings are added
+        self._tables = {}  # table name -> (file mtime, data frame)
+        self._files_used = {}  # table name -> signature of its file, for things built from the file itself
+        self._derived = {}  # things built from the tables (e.g. the rating matrix), dropped on reload
+        self._updaters = {}  # derived name -> function that updates it with new ratings
+        self._compactors = {}  # derived name -> function called after the new ratings were written to disk
+        self._unsaved_ratings = []  # appended ratings not written to ratings.csv yet
+        self._unmerged_ratings = []  # appended ratings not added to the loaded ratings table yet
+        self._lock = threading.RLock()
+        # Appending ratings changes the derived things in place (e.g. the rating matrix), so it waits
+        # for the readers that are using them (see reading) and they wait for it
+        self._updating = ReadWriteLock()
+
+    def file_path(self, name):
+        return os.path.join(self.data_dir, TABLE_FILES[name][0])
+
+    def read_table(self, name):
+        # Load one table from the binary cache, (re)building the cache from the CSV file if needed
+        if not self.use_cache:
+            with metrics.span("data.load", table=name, source="csv"):
+                return self.read_csv(name)
+
+        with metrics.span("data.load", table=name, source="cache"):
+            table = data_cache.read_table(self.data_dir, name, self.file_path(name))
+        if table is None and name == 'ratings':
+            # Ratings files can be bigger than memory, so they are converted a chunk at a time
+            import rating_loader
+            try:
+                with metrics.span("data.load", table=name, source="csv_chunks"):
+                    rating_loader.cache_ratings(self.data_dir, self.file_path(name))
+                table = data_cache.read_table(self.data_dir, name, self.file_path(name))
+            except OSError as e:
+                print("Couldn't write data cache:", e)
+        if table is None:
+            with metrics.span("data.load", table=name, source="csv"):
+                table = self.read_csv(name)
+            try:
+                data_cache.write_table(self.data_dir, name, table, self.file_path(name))
+            except OSError as e:
+                # e.g. a read-only data folder; we can still use the CSV data
+                print("Couldn't write data cache:", e)
+        return table
+
+    def read_csv(self, name):
+        # Parse one data file from disk
+        file_name, separator, columns = TABLE_FILES[name]
+        table = pd.read_csv(self.file_path(name), sep=separator, header=None, names=columns, encoding="latin1")
+        if name == 'movies':
+            # Remove columns that are not needed
+            table = table.drop(['release_date', 'video_release_date'], axis=1, errors='ignore')
+        return table
+
+    def table(self, name):
+        # Return a table, loading it the first time it is needed
+        with self._lock:
+            if name not in self._tables:
+                mtime = os.path.getmtime(self.file_path(name))
+                table = self.read_table(name)
+                if name == 'ratings':
+                    # The file has every rating but the unsaved ones, so nothing is left to merge
+                    if self._unsaved_ratings:
+                        table = pd.concat([table] + self._unsaved_ratings, ignore_index=True)
+                    self._unmerged_ratings = []
+                self._tables[name] = (mtime, table)
+            elif name == 'ratings' and self._unmerged_ratings:
+                # Appended ratings are added to the table when it is next used, not on every append
+                mtime, table = self._tables[name]
+                table = pd.concat([table] + self._unmerged_ratings, ignore_index=True)
+                self._tables[name] = (mtime, table)
+                self._unmerged_ratings = []
+            return self._tables[name][1]
+
+    @property
+    def users(self):
+        return self.table('users')
+
+    @property
+    def movies(self):
+        return self.table('movies')
+
+    @property
+    def ratings(self):
+        return self.table('ratings')
+
+    def watch_file(self, name):
+        # Called by things that are built straight from a table's file instead of the loaded table (e.g.
+        # the rating matrix, see rating_loader.py), before they read it, so reload_if_changed notices
+        # when the file changes
+        with self._lock:
+            if name not in self._files_used:
+                self._files_used[name] = data_cache.source_signature(self.file_path(name))
+
+    def unsaved_ratings(self):
+        # Appended ratings that aren't written to ratings.csv yet, as one data frame (None if there are none)
+        with self._lock:
+            if not self._unsaved_ratings:
+                return None
+            return pd.concat(self._unsaved_ratings, ignore_index=True)
+
+    def num_ratings(self):
+        # Number of ratings, appended ones included. Ratings are only ever added, so this also says
+        # how new a snapshot of the ratings is (see recommendation_store.py)
+        with self._lock:
+            if 'ratings' in self._tables:
+                return len(self._tables['ratings'][1]) + sum(map(len, self._unmerged_ratings))
+            return len(self.table('ratings'))
+
+    def ratings_version(self):
+        # Which ratings there are right now, for results saved to disk that are only valid for the same
+        # ratings (see recommendation_store.py): the signature of ratings.csv and the number of appended
+        # ratings that aren't written to it yet
+        with self._lock:
+            signature = data_cache.source_signature(self.file_path('ratings'))
+            return {'mtime': signature['mtime'], 'size': signature['size'],
+                    'appended': sum(map(len, self._unsaved_ratings))}
+
+    def derived(self, name, build, update=None, compact=None, label=None):
+        # Return something computed from the tables, building it once per data version.
+        # update(thing, new_ratings) is called when ratings are appended and returns the updated
+        # thing, or None if it has to be built again. Without update it is always built again.
+        # compact(thing) is called when the appended ratings have been written to ratings.csv.
+        # label names it in the metrics instead of name, for names with a parameter in them
+        # (every metrics label value is a separate series, so there should only be a few)
+        with self._lock:
+            if name not in self._derived:
+                with metrics.span("data.build", derived=label or name):
+                    self._derived[name] = build(self)
+                self._updaters[name] = update
+                self._compactors[name] = compact
+            return self._derived[name]
+
+    def reading(self):
+        # Hold this while using derived things that new ratings change, e.g. while scoring with the
+        # rating matrix, so append_ratings doesn't change them halfway through:
+        #     with dataset.reading(): ...
+        # Don't take it while holding the dataset lock (i.e. while building a derived thing)
+        return self._updating.reading()
+
+    @metrics.timed("data.append")
+    def append_ratings(self, ratings):
+        # Add new ratings: a data frame or a list of (user_id, movie_id, rating[, timestamp]) rows.
+        # Everything built from the ratings is updated in place, so the next recommendation
+        # already uses them. Returns the number of ratings added
+        file_name, separator, columns = TABLE_FILES['ratings']
+        if isinstance(ratings, pd.DataFrame):
+            ratings = ratings.copy()
+        else:
+            rows = [tuple(row) for row in ratings]
+            ratings = pd.DataFrame(rows, columns=columns[:len(rows[0])] if rows else columns)
+        if 'timestamp' not in ratings:
+            ratings['timestamp'] = int(time.time())
+        ratings = ratings[columns]
+        if len(ratings) == 0:
+            return 0
+        if ratings.isna().any().any():
+            raise ValueError("New ratings can't have missing values")
+        if not ratings['rating'].isin(range(1, 6)).all():
+            raise ValueError("Ratings must be whole stars from 1 to 5")
+
+        with self._updating.writing(), self._lock:
+            if 'ratings' in self._tables:
+                ratings = ratings.astype(self._tables['ratings'][1].dtypes.to_dict())
+            self._unsaved_ratings.append(ratings)
+            self._unmerged_ratings.append(ratings)
+
+            # Update what supports it (in the order it was built, so e.g. the rating matrix
+            # is updated before the things made from it), and drop the rest
+            for name in list(self._derived):
+                update = self._updaters.get(name)
+                try:
+                    updated = update(self._derived[name], ratings) if update is not None else None
+                except Exception as e:
+                    # It may be half updated; built again (with these ratings) when next needed
+                    print(f"Couldn't add the new ratings to {name}:", e)
+                    updated = None
+                if updated is None:
+                    del self._derived[name]
+                    self._updaters.pop(name, None)
+                    self._compactors.pop(name, None)
+                else:
+                    self._derived[name] = updated
+            self.version += 1
+
+            if self.compact_after is not None and sum(map(len, self._unsaved_ratings)) >= self.compact_after:
+                self.compact_ratings()
+        return len(ratings)
+
+    @metrics.timed("data.compact")
+    def compact_ratings(self):
+        # Write the appended ratings to the end of ratings.csv (the file is only ever added to)
+        # and refresh its binary cache. Returns the number of ratings written
+        with self._updating.writing(), self._lock:
+            if not self._unsaved_ratings:
+                return 0
+            file_name, separator, columns = TABLE_FILES['ratings']
+            path = self.file_path('ratings')
+            new_ratings = pd.concat(self._unsaved_ratings, ignore_index=True)
+
+            with open(path, 'rb') as f:
+                # Make sure the new rows start on a new line
+                f.seek(0, os.SEEK_END)
+                needs_newline = False
+                if f.tell() > 0:
+                    f.seek(-1, os.SEEK_END)
+                    needs_newline = f.read(1) != b"\n"
+            with open(path, 'a', encoding='latin1', newline='') as f:
+                if needs_newline:
+                    f.write("\n")
+                new_ratings.to_csv(f, sep=separator, header=False, index=False, lineterminator="\n")
+            self._unsaved_ratings = []
+            if 'ratings' not in self._tables:
+                # The table isn't loaded: it will be read from the file, which has these rows now
+                self._unmerged_ratings = []
+
+            if 'ratings' in self._files_used:
+                # Everything built from the file already has these rows too
+                self._files_used['ratings'] = data_cache.source_signature(path)
+            if 'ratings' in self._tables:
+                # The loaded table already has these rows, so it stays valid for the new file
+                table = self.table('ratings')
+                self._tables['ratings'] = (os.path.getmtime(path), table)
+                if self.use_cache:
+                    try:
+                        data_cache.write_table(self.data_dir, 'ratings', table, path)
+                    except OSError as e:
+                        print("Couldn't write data cache:", e)
+
+            # e.g. the rating matrix adds the changes it kept on the side into its base
+            for name, compact in list(self._compactors.items()):
+                if compact is not None and name in self._derived:
+                    compact(self._derived[name])
+            return len(new_ratings)
+
+    def reload(self):
+        # Forget everything loaded so far, so the next access reads the files again.
+        # Appended ratings that aren't written to disk yet are kept
+        with self._lock:
+            self._tables.clear()
+            self._files_used.clear()
+            self._derived.clear()
+            self._updaters.clear()
+            self._compactors.clear()
+            self._unmerged_ratings = []
+            self.version += 1
+
+    def reload_if_changed(self):
+        # Reload if any loaded file (or file something was built from) was modified on disk.
+        # Returns True if the data was reloaded
+        with self._lock:
+            for name, (mtime, table) in self._tables.items():
+                if os.path.getmtime(self.file_path(name)) != mtime:
+                    self.reload()
+                    return True
+            for name, signature in self._files_used.items():
+                if data_cache.source_signature(self.file_path(name)) != signature:
+                    self.reload()
+                    return True
+            return False
+
+# Create the dataset object that will be used in other files
+dataset = MovieDataset()
@@ -0,0 +1,71 @@
+# This file keeps a small pool of open SQLite connections, so we don't open and close
+# the database on every click. Connections use WAL mode, so readers don't block the writer
+
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Settings applied to every new connection
+PRAGMAS = [
+    "PRAGMA journal_mode=WAL",  # readers and one writer can work at the same time
+    "PRAGMA synchronous=NORMAL",  # safe with WAL, and much faster than FULL
+    "PRAGMA cache_size=-8000",  # 8 MB page cache per connection
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA foreign_keys=ON",
+]
+
+class SQLitePool:
+    def __init__(self, db_path, max_connections=8, timeout=10.0):
+        self.db_path = db_path
+        self.max_connections = max_connections
+        self.timeout = timeout  # seconds to wait for a free connection / for a database lock
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _open(self):
+        # check_same_thread=False is safe here: a connection is only used by one thread at a time.
+        # sqlite3 also keeps the compiled (prepared) statements of each connection for reuse
+        conn = sqlite3.connect(self.db_path, timeout=self.timeout, check_same_thread=False, cached_statements=64)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.max_connections:
+                self._created += 1
+                try:
+                    return self._open()
+                except Exception:
+                    self._created -= 1
+                    raise
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError("No free database connection (too many at once)")
+
+    @contextmanager
+    def connection(self):
+        # Borrow a connection. Changes are committed at the end, or rolled back if there was an error
+        conn = self._acquire()
+        try:
+            with conn:
+                yield conn
+        finally:
+            self._idle.put(conn)
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
@@ -0,0 +1,229 @@
+# This file measures how good the recommendations are, so min_rating / min_similar_ratings can be tuned
+# and the engines compared. The ratings are split by time (the newest ones are held out as the test set),
+# every engine recommends from the older ratings only, and the recommendations of every test user are
+# checked against the movies they rated highly later:
+#   precision@k  share of the k recommendations the user rated >= relevant_rating later
+#   recall@k     share of the user's later highly rated movies that were recommended
+#   coverage     share of all movies recommended to at least one user
+# Users are scored in batches with the same code as recommend_movies_for_users. The split, its rating
+# matrix and the trained models are saved in data/cache/evaluation, so later runs start straight away,
+# and a parameter grid runs on several worker processes that memory-map them.
+# Run it with: python evaluation.py [--strategies user,item,mf] [--min-ratings 3,4,5] [--min-similar 1,5,10,20]
+
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy import sparse
+import data_cache
+from item_similarity import ItemSimilarityModel
+from matrix_factorization import FactorModel
+from rating_matrix import RatingMatrix
+from topk import top_k_per_row
+
+SPLIT_FORMAT = 1
+
+def time_split(ratings, test_fraction=0.2, mode="global"):
+    # True for the ratings that go in the test set. "global": the newest test_fraction of all ratings
+    # (everything after one point in time), "user": the newest test_fraction of every user's ratings
+    timestamps = ratings['timestamp'].to_numpy()
+    if mode == "global":
+        cutoff = np.quantile(timestamps, 1 - test_fraction)
+        return timestamps > cutoff
+    if mode == "user":
+        # Rank every user's ratings from newest (0) to oldest
+        newest_first = ratings.assign(order=np.arange(len(ratings))).sort_values(
+            ['user_id', 'timestamp', 'order'], ascending=[True, False, False])
+        rank = newest_first.groupby('user_id').cumcount().to_numpy()
+        counts = newest_first.groupby('user_id')['user_id'].transform('size').to_numpy()
+        in_test = np.zeros(len(ratings), dtype=bool)
+        in_test[newest_first['order'].to_numpy()] = rank < np.floor(counts * test_fraction)
+        return in_test
+    raise ValueError(f"Unknown split mode: {mode}")
+
+def split_dir_for(data_dir, test_fraction, mode, relevant_rating):
+    return os.path.join(data_dir, "cache", "evaluation", f"{mode}_{test_fraction}_relevant{relevant_rating}")
+
+def prepare_split(dataset, test_fraction=0.2, mode="global", relevant_rating=4, min_ratings=(3, 4, 5),
+                  strategies=("user",)):
+    # Make (or reuse) the saved split: the training rating matrix with its liked matrices for every
+    # min_rating, the test users and their relevant movies, and the item / mf models trained on the
+    # training ratings. Returns its folder
+    split_dir = split_dir_for(dataset.data_dir, test_fraction, mode, relevant_rating)
+    source_path = dataset.file_path('ratings')
+    meta = data_cache.read_meta(split_dir, source_path)
+    if meta is None or meta.get('format') != SPLIT_FORMAT:
+        print(f"Making the {mode} split in {split_dir} ...")
+        shutil.rmtree(split_dir, ignore_errors=True)  # models trained on an older split go too
+        ratings = dataset.ratings
+        in_test = time_split(ratings, test_fraction, mode)
+        train = RatingMatrix(ratings[~in_test])
+        for min_rating in min_ratings:
+            train.liked_bits(min_rating)
+        train.save(os.path.join(split_dir, "train"))
+        save_test_set(split_dir, train, ratings[in_test], relevant_rating)
+        # The split only counts as saved once its meta.json exists
+        data_cache.write_meta(split_dir, dict(data_cache.source_signature(source_path), format=SPLIT_FORMAT,
+                                              test_fraction=test_fraction, mode=mode, relevant_rating=relevant_rating,
+                                              test_ratings=int(in_test.sum())))
+
+    train = RatingMatrix.load(os.path.join(split_dir, "train"))
+    for strategy in strategies:
+        model_dir = os.path.join(split_dir, strategy)
+        if strategy == "item" and ItemSimilarityModel.load(model_dir, source_path) is None:
+            ItemSimilarityModel.build(train).save(model_dir, source_path)
+        elif strategy == "mf" and FactorModel.load(model_dir, source_path) is None:
+            FactorModel.train(train).save(model_dir, source_path)
+    return split_dir
+
+def save_test_set(split_dir, train, test_ratings, relevant_rating):
+    # The test users (only users that also have training ratings can get recommendations) and, as a
+    # sparse (test users x training movies) matrix, the movies each of them rated >= relevant_rating.
+    # Relevant movies that aren't in the training data can't be recommended, but still count for recall
+    relevant = test_ratings[test_ratings['rating'] >= relevant_rating]
+    relevant = relevant[np.isin(relevant['user_id'].to_numpy(), train.user_ids)]
+    relevant = relevant.drop_duplicates(subset=['user_id', 'movie_id'])
+    user_ids, rows = np.unique(relevant['user_id'].to_numpy().astype(np.int64), return_inverse=True)
+    num_relevant = np.bincount(rows, minlength=len(user_ids))
+
+    movie_ids = relevant['movie_id'].to_numpy()
+    cols = np.searchsorted(train.movie_ids, movie_ids).clip(0, max(len(train.movie_ids) - 1, 0))
+    known = train.movie_ids[cols] == movie_ids
+    matrix = sparse.csr_matrix((np.ones(known.sum(), dtype=bool), (rows[known], cols[known])),
+                               shape=(len(user_ids), len(train.movie_ids)))
+    for name, array in [('test_user_ids', user_ids), ('num_relevant', num_relevant),
+                        ('relevant.indptr', matrix.indptr), ('relevant.indices', matrix.indices)]:
+        data_cache.save_array(os.path.join(split_dir, f"{name}.npy"), array)
+
+class EvaluationSplit:
+    # A split saved by prepare_split, memory-mapped
+    def __init__(self, split_dir, ratings_path):
+        def array(name):
+            return np.load(os.path.join(split_dir, f"{name}.npy"), mmap_mode='r')
+
+        self.train = RatingMatrix.load(os.path.join(split_dir, "train"))
+        self.test_user_ids = array('test_user_ids')
+        self.num_relevant = array('num_relevant')
+        indptr, indices = array('relevant.indptr'), array('relevant.indices')
+        self.relevant = sparse.csr_matrix((np.ones(len(indices), dtype=bool), indices, indptr),
+                                          shape=(len(self.test_user_ids), len(self.train.movie_ids)))
+        self.models = {
+            'item': ItemSimilarityModel.load(os.path.join(split_dir, "item"), ratings_path),
+            'mf': FactorModel.load(os.path.join(split_dir, "mf"), ratings_path),
+        }
+
+    def score(self, strategy, user_ids, min_rating):
+        # Same as recommender.score_movies_in_batch, on the training ratings
+        if strategy == "user":
+            return self.train.score_movies_for_users(user_ids, min_rating)
+        if self.models.get(strategy) is None:
+            raise ValueError(f"No {strategy} model in this split, pass it to prepare_split")
+        return self.models[strategy].score_movies_for_users(self.train, user_ids, min_rating)
+
+    def evaluate(self, strategy, min_rating, min_similar_ratings_values=(10,), ks=(10,), chunk_size=500):
+        # Metrics for every min_similar_ratings and k, from one scoring pass over the test users.
+        # Returns one dict per (min_similar_ratings, k)
+        start = time.perf_counter()
+        num_users, num_movies = len(self.test_user_ids), len(self.train.movie_ids)
+        settings = [(min_similar, k) for min_similar in min_similar_ratings_values for k in ks]
+        totals = {setting: {'precision': 0.0, 'recall': 0.0, 'hits': 0, 'users_with_recommendations': 0,
+                            'recommended': np.zeros(num_movies, dtype=bool)} for setting in settings}
+
+        for chunk_start in range(0, num_users, chunk_size):
+            chunk_users = np.asarray(self.test_user_ids[chunk_start:chunk_start + chunk_size])
+            user_ids, predicted_rating, rating_count, avg_rating = self.score(strategy, chunk_users, min_rating)
+            # Test users without liked movies got no scores: they count as users with 0 hits
+            rows = np.searchsorted(self.test_user_ids, user_ids)
+            relevant = self.relevant[rows].toarray()
+            num_relevant = np.asarray(self.num_relevant)[rows]
+
+            for min_similar in min_similar_ratings_values:
+                # Like recommend_movies_for_users: only movies with enough ratings
+                enough_ratings = rating_count >= max(min_similar, 1)
+                ranked = np.where(enough_ratings, predicted_rating, -np.inf)
+                best = top_k_per_row(ranked, max(ks))
+                valid = np.take_along_axis(enough_ratings, best, axis=1)
+                hit = np.take_along_axis(relevant, best, axis=1) & valid
+                for k in ks:
+                    total = totals[(min_similar, k)]
+                    hits = hit[:, :k].sum(axis=1)
+                    total['hits'] += int(hits.sum())
+                    total['precision'] += float((hits / k).sum())
+                    total['recall'] += float((hits / num_relevant).sum())
+                    total['users_with_recommendations'] += int(valid[:, :k].any(axis=1).sum())
+                    total['recommended'][best[:, :k][valid[:, :k]]] = True
+
+        seconds = time.perf_counter() - start
+        return [{
+            'strategy': strategy, 'min_rating': min_rating, 'min_similar_ratings': min_similar, 'k': k,
+            'precision@k': total['precision'] / max(num_users, 1),
+            'recall@k': total['recall'] / max(num_users, 1),
+            'coverage': total['recommended'].sum() / max(num_movies, 1),
+            'user_coverage': total['users_with_recommendations'] / max(num_users, 1),
+            'hits': total['hits'], 'test_users': num_users, 'seconds': round(seconds, 3),
+        } for (min_similar, k), total in totals.items()]
+
+# The split a worker loaded once when it started (see run_grid)
+_worker = {}
+
+def _start_worker(split_dir, ratings_path):
+    _worker['split'] = EvaluationSplit(split_dir, ratings_path)
+
+def _evaluate(strategy, min_rating, min_similar_ratings_values, ks):
+    return _worker['split'].evaluate(strategy, min_rating, min_similar_ratings_values, ks)
+
+def run_grid(dataset, strategies=("user",), min_ratings=(3, 4, 5), min_similar_ratings_values=(1, 5, 10, 20),
+             ks=(10,), test_fraction=0.2, mode="global", relevant_rating=4, workers=None):
+    # Evaluate every combination of the settings. Each (strategy, min_rating) pair is one task, scored
+    # once for all its min_similar_ratings and k values; tasks run on workers processes
+    # (default: EVALUATION_WORKERS or the number of CPUs, 0 = here). Returns a data frame, best first
+    split_dir = prepare_split(dataset, test_fraction, mode, relevant_rating, min_ratings, strategies)
+    setup = (split_dir, dataset.file_path('ratings'))
+    tasks = [(strategy, min_rating, tuple(min_similar_ratings_values), tuple(ks))
+             for strategy in strategies for min_rating in min_ratings]
+    if workers is None:
+        workers = int(os.environ.get("EVALUATION_WORKERS", os.cpu_count() or 1))
+    workers = min(workers, len(tasks))
+
+    if workers == 0:
+        _start_worker(*setup)
+        results = [_evaluate(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_start_worker, initargs=setup) as pool:
+            results = list(pool.map(_evaluate, *zip(*tasks)))
+
+    table = pd.DataFrame([row for rows in results for row in rows])
+    return table.sort_values(['k', 'precision@k'], ascending=[True, False], ignore_index=True)
+
+if __name__ == "__main__":
+    import argparse
+    from dataset import dataset
+
+    def numbers(text, kind=int):
+        return [kind(value) for value in text.split(",")]
+
+    parser = argparse.ArgumentParser(description="Evaluate the recommenders on a time-based split")
+    parser.add_argument("--strategies", default="user,item,mf")
+    parser.add_argument("--min-ratings", default="3,4,5")
+    parser.add_argument("--min-similar", default="1,5,10,20", help="min_similar_ratings values")
+    parser.add_argument("--k", default="10", help="list lengths to check, e.g. 5,10,20")
+    parser.add_argument("--test-fraction", type=float, default=0.2)
+    parser.add_argument("--mode", default="global", choices=["global", "user"],
+                        help="hold out the newest ratings overall or the newest of every user")
+    parser.add_argument("--relevant-rating", type=int, default=4, help="test ratings that count as a hit")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--output", help="also write the results to this CSV file")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    table = run_grid(dataset, args.strategies.split(","), numbers(args.min_ratings), numbers(args.min_similar),
+                     numbers(args.k), args.test_fraction, args.mode, args.relevant_rating, args.workers)
+    pd.set_option('display.width', 200)
+    print(table.to_string(index=False, float_format=lambda value: f"{value:.4f}"))
+    print(f"{len(table)} settings in {time.perf_counter() - start:.1f} s")
+    if args.output:
+        table.to_csv(args.output, index=False)
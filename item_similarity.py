@@ -0,0 +1,157 @@
+# This file is an item-based alternative to the user-based recommender. An offline step works out
+# how similar every pair of movies is (cosine or Jaccard over the ratings matrix) and keeps only the
+# top K neighbours of each movie. Recommending is then just adding up the neighbour lists of the
+# movies a user liked. The neighbour lists are saved in data/cache so workers can load them instantly
+# Build it with: python item_similarity.py [cosine|jaccard]
+
+import os
+import numpy as np
+from scipy import sparse
+import data_cache
+from topk import top_k_per_row
+
+class ItemSimilarityModel:
+    def __init__(self, movie_ids, neighbors, scores, metric):
+        self.movie_ids = movie_ids  # movie_id of every row
+        self.neighbors = neighbors  # (movies x K) rows of the most similar movies, -1 = no neighbour
+        self.scores = scores  # (movies x K) similarity of each neighbour
+        self.metric = metric
+        self._matrix = None
+
+    @classmethod
+    def build(cls, rating_matrix, metric="cosine", num_neighbors=50, chunk_size=1000):
+        # Work out the top num_neighbors most similar movies for every movie, chunk_size movies at a time
+        ratings = rating_matrix.ratings.tocsc()
+        if metric == "jaccard":
+            ratings = ratings.copy()
+            ratings.data[:] = 1.0
+        elif metric != "cosine":
+            raise ValueError(f"Unknown similarity metric: {metric}")
+
+        movie_ratings = ratings.T.tocsr()
+        num_movies = movie_ratings.shape[0]
+        norms = np.sqrt(np.asarray(movie_ratings.multiply(movie_ratings).sum(axis=1)).ravel())
+        rating_counts = np.diff(movie_ratings.indptr)
+        num_neighbors = min(num_neighbors, max(num_movies - 1, 0))
+
+        neighbors = np.full((num_movies, num_neighbors), -1, dtype=np.int32)
+        scores = np.zeros((num_movies, num_neighbors), dtype=np.float32)
+        for start in range(0, num_movies, chunk_size):
+            rows = np.arange(start, min(start + chunk_size, num_movies))
+            overlap = (movie_ratings[rows] @ ratings).toarray()
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                if metric == "cosine":
+                    similarity = overlap / np.outer(norms[rows], norms)
+                else:
+                    similarity = overlap / (rating_counts[rows, None] + rating_counts[None, :] - overlap)
+            similarity[~np.isfinite(similarity)] = 0.0
+            similarity[np.arange(len(rows)), rows] = 0.0  # a movie is not its own neighbour
+
+            best = top_k_per_row(similarity, num_neighbors)
+            best_scores = np.take_along_axis(similarity, best, axis=1)
+            neighbors[rows] = np.where(best_scores > 0, best, -1)
+            scores[rows] = np.where(best_scores > 0, best_scores, 0.0)
+
+        return cls(rating_matrix.movie_ids.copy(), neighbors, scores, metric)
+
+    def neighbor_matrix(self):
+        # The neighbour lists as a sparse (movies x movies) matrix, row = movie, columns = its neighbours
+        if self._matrix is None:
+            has_neighbor = self.neighbors >= 0
+            rows = np.repeat(np.arange(len(self.movie_ids)), has_neighbor.sum(axis=1))
+            self._matrix = sparse.csr_matrix(
+                (self.scores[has_neighbor].astype(np.float64), (rows, self.neighbors[has_neighbor])),
+                shape=(len(self.movie_ids), len(self.movie_ids))
+            )
+        return self._matrix
+
+    def score_movies_for_user(self, rating_matrix, user_id, min_rating, movie_filter=None):
+        # Same outputs as RatingMatrix.score_movies_for_user. predicted_rating is the user's ratings of
+        # their liked movies, weighted by similarity, summed over the neighbour lists and divided by the
+        # number of liked movies. rating_count and avg_rating are the movie's own ratings >= min_rating
+        empty = (np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0, dtype=np.int64), np.zeros(0))
+        pos = rating_matrix.user_position(user_id)
+        if pos < 0:
+            return empty
+
+        user_liked = rating_matrix.liked_rows([pos], min_rating)
+        if user_liked.nnz == 0:
+            return empty
+
+        weighted_sum = (self.neighbor_matrix().T @ user_liked.T).toarray().ravel()
+
+        # Candidates: neighbours of liked movies that the user hasn't rated yet
+        candidates = weighted_sum > 0
+        candidates[rating_matrix.rated_movies(pos)] = False
+        if movie_filter is not None:
+            candidates &= movie_filter
+
+        counts, averages = rating_matrix.movie_stats(min_rating)
+        return (
+            self.movie_ids[candidates],
+            weighted_sum[candidates] / user_liked.nnz,
+            counts[candidates].astype(np.int64),
+            averages[candidates]
+        )
+
+    def score_movies_for_users(self, rating_matrix, user_ids, min_rating, movie_filter=None):
+        # Batch version with the same outputs as RatingMatrix.score_movies_for_users
+        user_ids, positions = rating_matrix.liked_user_positions(user_ids, min_rating)
+        user_liked = rating_matrix.liked_rows(positions, min_rating)
+        liked_counts = np.diff(user_liked.indptr)
+
+        weighted_sum = (user_liked @ self.neighbor_matrix()).toarray()
+        weighted_sum[rating_matrix.rating_rows(positions).nonzero()] = 0.0
+        if movie_filter is not None:
+            weighted_sum[:, ~movie_filter] = 0.0
+
+        counts, averages = rating_matrix.movie_stats(min_rating)
+        rating_count = np.where(weighted_sum > 0, counts, 0).astype(np.int64)
+        predicted_rating = weighted_sum / liked_counts[:, None]
+        avg_rating = np.broadcast_to(averages, weighted_sum.shape)
+        return user_ids, predicted_rating, rating_count, avg_rating
+
+    def save(self, model_dir, source_path):
+        # Save as .npy files so they can be memory-mapped
+        os.makedirs(model_dir, exist_ok=True)
+        data_cache.save_array(os.path.join(model_dir, "movie_ids.npy"), self.movie_ids)
+        data_cache.save_array(os.path.join(model_dir, "neighbors.npy"), self.neighbors)
+        data_cache.save_array(os.path.join(model_dir, "scores.npy"), self.scores)
+        data_cache.write_meta(model_dir, dict(data_cache.source_signature(source_path), metric=self.metric))
+
+    @classmethod
+    def load(cls, model_dir, source_path):
+        # Load a saved model, or return None if there isn't one or the ratings file changed since
+        meta = data_cache.read_meta(model_dir, source_path)
+        if meta is None:
+            return None
+        arrays = [np.load(os.path.join(model_dir, f"{name}.npy"), mmap_mode='r')
+                  for name in ("movie_ids", "neighbors", "scores")]
+        return cls(*arrays, meta['metric'])
+
+def model_dir_for(data_dir, metric):
+    return os.path.join(data_dir, "cache", f"item_similarity_{metric}")
+
+def load_or_build(dataset, rating_matrix, metric="cosine"):
+    # Use the saved model if it is up to date, otherwise build and save a new one
+    model_dir = model_dir_for(dataset.data_dir, metric)
+    source_path = dataset.file_path('ratings')
+    model = ItemSimilarityModel.load(model_dir, source_path)
+    if model is None or not np.array_equal(model.movie_ids, rating_matrix.movie_ids):
+        model = ItemSimilarityModel.build(rating_matrix, metric)
+        try:
+            model.save(model_dir, source_path)
+        except OSError as e:
+            print("Couldn't save item similarity model:", e)
+    return model
+
+if __name__ == "__main__":
+    import sys
+    from dataset import dataset
+    from recommender import get_rating_matrix
+
+    metric = sys.argv[1] if len(sys.argv) > 1 else "cosine"
+    model = ItemSimilarityModel.build(get_rating_matrix(), metric)
+    model.save(model_dir_for(dataset.data_dir, metric), dataset.file_path('ratings'))
+    print(f"Saved {metric} neighbours for {len(model.movie_ids):,} movies")
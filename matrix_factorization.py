@@ -0,0 +1,236 @@
+# This file is a latent-factor alternative to the neighbour-based recommenders. An offline step learns a
+# short vector (32 numbers) for every user and every movie with alternating least squares (ALS), so that
+# the dot product of a user's and a movie's vector (plus the average rating) is close to the user's
+# rating of the movie. Recommending is then one matrix-vector product with all movie vectors and a top K.
+# The vectors are saved in data/cache as float32 .npy files. Training stops early when it runs out of its
+# time budget (MF_TRAIN_SECONDS), and retraining after new ratings starts from the saved vectors, so a
+# few steps are enough.
+# Train it with: python matrix_factorization.py [--iterations 15] [--seconds 60] [--fresh]
+
+import os
+import time
+import numpy as np
+from scipy import sparse
+import data_cache
+
+class FactorModel:
+    def __init__(self, user_ids, movie_ids, user_factors, item_factors, mean, info=None):
+        self.user_ids = user_ids  # user_id of every row of user_factors
+        self.movie_ids = movie_ids  # movie_id of every row of item_factors
+        self.user_factors = user_factors  # (users x factors) float32
+        self.item_factors = item_factors  # (movies x factors) float32
+        self.mean = mean  # average rating, added to every dot product
+        self.info = info or {}  # how it was trained (iterations, seconds, error ...)
+        self._aligned = None  # (number of rating matrix movies, their factors, known), see aligned_items
+
+    @classmethod
+    def train(cls, rating_matrix, factors=32, reg=0.1, iterations=15, max_seconds=None, previous=None, seed=0):
+        # Learn the factors of every user and movie of the rating matrix. Each iteration solves the
+        # movie factors for fixed user factors and then the other way round (a small least squares
+        # problem per user / movie, all solved at once). reg keeps the factors small, scaled by the
+        # number of ratings of each user / movie. Stops after max_seconds if an iteration wouldn't fit.
+        # previous is an older model to start from (its users and movies keep their factors)
+        start = time.perf_counter()
+        ratings = rating_matrix.ratings.tocsr()
+        ratings_t = ratings.T.tocsr()
+        mean = float(ratings.data.mean()) if ratings.nnz else 0.0
+        rng = np.random.default_rng(seed)
+
+        def start_factors(ids, old_ids, old_factors):
+            new = (rng.standard_normal((len(ids), factors)) * 0.1).astype(np.float32)
+            if old_factors is not None and old_factors.shape[1] == factors:
+                rows = np.searchsorted(old_ids, ids).clip(0, max(len(old_ids) - 1, 0))
+                found = old_ids[rows] == ids if len(old_ids) else np.zeros(len(ids), dtype=bool)
+                new[found] = old_factors[rows[found]]
+            return new
+
+        warm = previous is not None and previous.user_factors.shape[1] == factors
+        old = (previous.user_ids, previous.user_factors, previous.movie_ids, previous.item_factors) if warm else \
+            (None, None, None, None)
+        user_factors = start_factors(rating_matrix.user_ids, old[0], old[1])
+        item_factors = start_factors(rating_matrix.movie_ids, old[2], old[3])
+
+        done = 0
+        last_seconds = 0.0
+        while done < iterations:
+            elapsed = time.perf_counter() - start
+            if max_seconds is not None and done > 0 and elapsed + last_seconds > max_seconds:
+                break
+            iteration_start = time.perf_counter()
+            item_factors = solve_factors(ratings_t, user_factors, reg, mean)
+            user_factors = solve_factors(ratings, item_factors, reg, mean)
+            last_seconds = time.perf_counter() - iteration_start
+            done += 1
+
+        info = {'factors': factors, 'reg': reg, 'iterations': done, 'warm_start': warm,
+                'seconds': round(time.perf_counter() - start, 3),
+                'train_rmse': round(training_error(ratings, user_factors, item_factors, mean), 4)}
+        return cls(rating_matrix.user_ids.copy(), rating_matrix.movie_ids.copy(), user_factors, item_factors, mean, info)
+
+    def aligned_items(self, rating_matrix):
+        # Factors of the rating matrix's movies in its column order (zeros for movies the model hasn't
+        # seen), and which of them the model knows. Movies are only ever added, so this is worked out
+        # again only when the number of movies changes
+        num_movies = len(rating_matrix.movie_ids)
+        if self._aligned is None or self._aligned[0] != num_movies:
+            rows = np.searchsorted(self.movie_ids, rating_matrix.movie_ids).clip(0, max(len(self.movie_ids) - 1, 0))
+            known = self.movie_ids[rows] == rating_matrix.movie_ids if len(self.movie_ids) else \
+                np.zeros(num_movies, dtype=bool)
+            factors = np.zeros((num_movies, self.item_factors.shape[1]), dtype=np.float32)
+            factors[known] = self.item_factors[rows[known]]
+            self._aligned = (num_movies, factors, known)
+        return self._aligned[1], self._aligned[2]
+
+    def user_vectors(self, rating_matrix, positions):
+        # Factors of the users at these rows of the rating matrix. Users the model hasn't seen (they
+        # rated something after training) get factors worked out from their ratings right now
+        user_ids = rating_matrix.user_ids[positions]
+        rows = np.searchsorted(self.user_ids, user_ids).clip(0, max(len(self.user_ids) - 1, 0))
+        known = self.user_ids[rows] == user_ids if len(self.user_ids) else np.zeros(len(positions), dtype=bool)
+        vectors = np.empty((len(positions), self.user_factors.shape[1]), dtype=np.float32)
+        vectors[known] = self.user_factors[rows[known]]
+        if not known.all():
+            item_factors = self.aligned_items(rating_matrix)[0]
+            unknown_ratings = rating_matrix.rating_rows(np.asarray(positions)[~known])
+            vectors[~known] = solve_factors(unknown_ratings, item_factors, self.info.get('reg', 0.1), self.mean)
+        return vectors
+
+    def score_movies_for_user(self, rating_matrix, user_id, min_rating, movie_filter=None):
+        # Same outputs as RatingMatrix.score_movies_for_user. predicted_rating is the predicted rating of
+        # every movie the user hasn't rated yet; rating_count and avg_rating are the movie's own
+        # ratings >= min_rating (like the item-based recommender)
+        empty = (np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0, dtype=np.int64), np.zeros(0))
+        pos = rating_matrix.user_position(user_id)
+        if pos < 0:
+            return empty
+
+        item_factors, known = self.aligned_items(rating_matrix)
+        scores = item_factors @ self.user_vectors(rating_matrix, [pos])[0] + self.mean
+
+        candidates = known.copy()
+        candidates[rating_matrix.rated_movies(pos)] = False
+        if movie_filter is not None:
+            candidates &= movie_filter
+
+        counts, averages = rating_matrix.movie_stats(min_rating)
+        return (
+            rating_matrix.movie_ids[candidates],
+            scores[candidates].astype(np.float64),
+            counts[candidates].astype(np.int64),
+            averages[candidates]
+        )
+
+    def score_movies_for_users(self, rating_matrix, user_ids, min_rating, movie_filter=None):
+        # Batch version with the same outputs as RatingMatrix.score_movies_for_users. Unlike the other
+        # engines it doesn't need liked movies, so every user with ratings gets recommendations
+        user_ids = np.asarray(user_ids)
+        positions = np.searchsorted(rating_matrix.user_ids, user_ids).clip(0, max(len(rating_matrix.user_ids) - 1, 0))
+        found = rating_matrix.user_ids[positions] == user_ids if len(rating_matrix.user_ids) else user_ids < 0
+        user_ids, positions = user_ids[found], positions[found]
+        item_factors, known = self.aligned_items(rating_matrix)
+        predicted_rating = (self.user_vectors(rating_matrix, positions) @ item_factors.T + self.mean).astype(np.float64)
+
+        counts, averages = rating_matrix.movie_stats(min_rating)
+        rating_count = np.broadcast_to(np.where(known, counts, 0), predicted_rating.shape).astype(np.int64)
+        rating_count[rating_matrix.rating_rows(positions).nonzero()] = 0
+        if movie_filter is not None:
+            rating_count[:, ~movie_filter] = 0
+        avg_rating = np.broadcast_to(averages, predicted_rating.shape)
+        return user_ids, predicted_rating, rating_count, avg_rating
+
+    def save(self, model_dir, source_path):
+        # Save as .npy files so they can be memory-mapped
+        os.makedirs(model_dir, exist_ok=True)
+        data_cache.save_array(os.path.join(model_dir, "user_ids.npy"), self.user_ids)
+        data_cache.save_array(os.path.join(model_dir, "movie_ids.npy"), self.movie_ids)
+        data_cache.save_array(os.path.join(model_dir, "user_factors.npy"), self.user_factors)
+        data_cache.save_array(os.path.join(model_dir, "item_factors.npy"), self.item_factors)
+        data_cache.write_meta(model_dir, dict(data_cache.source_signature(source_path), mean=self.mean,
+                                              info=self.info))
+
+    @classmethod
+    def load(cls, model_dir, source_path=None):
+        # Load a saved model, or return None if there isn't one. With source_path it must also have
+        # been trained on that ratings file as it is now (without, older models are fine, e.g. to
+        # start training from)
+        meta = data_cache.read_meta(model_dir, source_path)
+        if meta is None:
+            return None
+        arrays = [np.load(os.path.join(model_dir, f"{name}.npy"), mmap_mode='r')
+                  for name in ("user_ids", "movie_ids", "user_factors", "item_factors")]
+        return cls(*arrays, meta['mean'], meta.get('info'))
+
+def solve_factors(ratings, fixed, reg, mean, max_cells=4_000_000):
+    # Least squares factors of every row of a sparse ratings matrix, for fixed factors of its columns:
+    # row x = (sum of f f^T over its rated columns + reg * n I)^-1 (sum of (rating - mean) f), n = its
+    # number of ratings. Both sums for all rows are two sparse x dense products; rows are done in
+    # groups so the (rows x factors x factors) systems take at most max_cells numbers
+    ratings = sparse.csr_matrix(ratings)
+    num_rows, k = ratings.shape[0], fixed.shape[1]
+    fixed = np.asarray(fixed, dtype=np.float64)
+    outer = (fixed[:, :, None] * fixed[:, None, :]).reshape(len(fixed), k * k)  # f f^T of every column
+    rated = ratings.copy()
+    rated.data = np.ones_like(rated.data)
+    centered = ratings.copy()
+    centered.data = centered.data - mean
+    counts = np.diff(ratings.indptr)
+
+    result = np.zeros((num_rows, k), dtype=np.float32)
+    step = max(1, max_cells // (k * k))
+    for start in range(0, num_rows, step):
+        rows = slice(start, min(start + step, num_rows))
+        systems = (rated[rows] @ outer).reshape(-1, k, k)
+        systems += (reg * np.maximum(counts[rows], 1))[:, None, None] * np.eye(k)
+        targets = centered[rows] @ fixed
+        result[rows] = np.linalg.solve(systems, targets[:, :, None])[:, :, 0]
+    return result
+
+def training_error(ratings, user_factors, item_factors, mean, max_ratings=1_000_000):
+    # Root mean squared error on (up to max_ratings of) the training ratings
+    if ratings.nnz == 0:
+        return 0.0
+    rows = np.repeat(np.arange(ratings.shape[0]), np.diff(ratings.indptr))[:max_ratings]
+    cols, values = ratings.indices[:max_ratings], ratings.data[:max_ratings]
+    predicted = np.einsum('ij,ij->i', user_factors[rows], item_factors[cols]) + mean
+    return float(np.sqrt(np.mean((predicted - values) ** 2)))
+
+def model_dir_for(data_dir):
+    return os.path.join(data_dir, "cache", "matrix_factorization")
+
+def load_or_train(dataset, rating_matrix, max_seconds=None, warm_iterations=3):
+    # Use the saved model if it was trained on the current ratings file. Otherwise train one (within
+    # max_seconds, default MF_TRAIN_SECONDS or 60), starting from the saved factors if there are any,
+    # and save it
+    model_dir = model_dir_for(dataset.data_dir)
+    source_path = dataset.file_path('ratings')
+    model = FactorModel.load(model_dir, source_path)
+    if model is None:
+        if max_seconds is None:
+            max_seconds = float(os.environ.get("MF_TRAIN_SECONDS", 60))
+        previous = FactorModel.load(model_dir)
+        iterations = warm_iterations if previous is not None else 15
+        model = FactorModel.train(rating_matrix, iterations=iterations, max_seconds=max_seconds, previous=previous)
+        try:
+            model.save(model_dir, source_path)
+        except OSError as e:
+            print("Couldn't save matrix factorization model:", e)
+    return model
+
+if __name__ == "__main__":
+    import argparse
+    from dataset import dataset
+    from recommender import get_rating_matrix
+
+    parser = argparse.ArgumentParser(description="Train the matrix factorization recommender")
+    parser.add_argument("--factors", type=int, default=32)
+    parser.add_argument("--reg", type=float, default=0.1)
+    parser.add_argument("--iterations", type=int, default=15)
+    parser.add_argument("--seconds", type=float, help="time budget for training")
+    parser.add_argument("--fresh", action="store_true", help="don't start from the saved factors")
+    args = parser.parse_args()
+
+    model_dir = model_dir_for(dataset.data_dir)
+    previous = None if args.fresh else FactorModel.load(model_dir)
+    model = FactorModel.train(get_rating_matrix(), args.factors, args.reg, args.iterations, args.seconds, previous)
+    model.save(model_dir, dataset.file_path('ratings'))
+    print(f"Saved factors of {len(model.user_ids):,} users and {len(model.movie_ids):,} movies: {model.info}")
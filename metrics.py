@@ -0,0 +1,287 @@
+# This file measures how long each step of a request takes (loading data, scoring, looking up titles,
+# login ...) and sends the timings to one or more "sinks": an in-memory histogram, logfmt lines or a
+# Prometheus text file. It is off unless the METRICS environment variable is set, and when it is off
+# span() and trace() do almost nothing, so the timing code can stay in the hot paths.
+#   METRICS=memory,logfmt,prometheus   which sinks to use (any of them, comma separated)
+#   METRICS_LOGFMT_FILE                 file for the logfmt lines (default: stderr)
+#   METRICS_PROMETHEUS_FILE             file to write the Prometheus metrics to (default: metrics.prom)
+#   METRICS_TRACES                      how many recent traces to keep for the debug panel (default: 50)
+
+import functools
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+class Histogram:
+    def __init__(self):
+        self.bucket_counts = [0] * (len(BUCKETS) + 1)  # the last bucket is everything slower
+        self.count = 0
+        self.sum = 0.0
+
+    def record(self, seconds):
+        index = 0
+        while index < len(BUCKETS) and seconds > BUCKETS[index]:
+            index += 1
+        self.bucket_counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def percentile(self, q):
+        # Upper bound of the bucket that holds the q-th percentile (q from 0 to 100)
+        if self.count == 0:
+            return None
+        wanted = q / 100 * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS + [float("inf")], self.bucket_counts):
+            seen += count
+            if seen >= wanted:
+                return bound
+        return float("inf")
+
+class HistogramSink:
+    # Keeps a histogram per span name (and labels) plus error counts in memory
+    def __init__(self):
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.errors = {}  # name -> number of errors
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].record(seconds)
+
+    def error(self, name, error):
+        with self._lock:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def summary(self):
+        # One row per span: count, mean and approximate p50/p95/p99 in milliseconds
+        with self._lock:
+            rows = []
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                row = {'span': name, **dict(labels), 'count': histogram.count,
+                       'mean_ms': histogram.sum / histogram.count * 1000}
+                for q in (50, 95, 99):
+                    row[f'p{q}_ms'] = histogram.percentile(q) * 1000
+                rows.append(row)
+            return rows
+
+    def prometheus_text(self):
+        # The histograms in the Prometheus text exposition format
+        with self._lock:
+            lines = ["# HELP movie_recommender_span_seconds Time spent in each step",
+                     "# TYPE movie_recommender_span_seconds histogram"]
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                label_text = ",".join([f'span="{name}"'] + [f'{key}="{value}"' for key, value in labels])
+                seen = 0
+                for bound, count in zip(BUCKETS + ["+Inf"], histogram.bucket_counts):
+                    seen += count
+                    lines.append(f'movie_recommender_span_seconds_bucket{{{label_text},le="{bound}"}} {seen}')
+                lines.append(f"movie_recommender_span_seconds_sum{{{label_text}}} {histogram.sum}")
+                lines.append(f"movie_recommender_span_seconds_count{{{label_text}}} {histogram.count}")
+            lines += ["# HELP movie_recommender_errors_total Errors in each step",
+                      "# TYPE movie_recommender_errors_total counter"]
+            for name, count in sorted(self.errors.items()):
+                lines.append(f'movie_recommender_errors_total{{span="{name}"}} {count}')
+            return "\n".join(lines) + "\n"
+
+class PrometheusFileSink(HistogramSink):
+    # Histograms that are written to a text file (for the Prometheus node exporter's textfile
+    # collector) at most every interval seconds
+    def __init__(self, path, interval=10.0):
+        super().__init__()
+        self.path = path
+        self.interval = interval
+        self._last_write = 0.0
+
+    def record(self, name, seconds, labels):
+        super().record(name, seconds, labels)
+        if time.monotonic() - self._last_write >= self.interval:
+            self.flush()
+
+    def flush(self):
+        self._last_write = time.monotonic()
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, "w") as f:
+                f.write(self.prometheus_text())
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print("Couldn't write metrics file:", e)
+
+class LogfmtSink:
+    # Writes one "key=value" line per span, e.g. ts=... span=recommend.score duration_ms=0.812 strategy=user
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stderr
+        self._lock = threading.Lock()
+
+    def write(self, fields):
+        text = " ".join(f"{key}={format_value(value)}" for key, value in fields.items())
+        with self._lock:
+            self.stream.write(text + "\n")
+            self.stream.flush()
+
+    def record(self, name, seconds, labels):
+        self.write({'ts': f"{time.time():.3f}", 'span': name, 'duration_ms': f"{seconds * 1000:.3f}", **labels})
+
+    def error(self, name, error):
+        self.write({'ts': f"{time.time():.3f}", 'level': 'error', 'span': name, 'error': repr(error)})
+
+def format_value(value):
+    text = str(value)
+    if not text or any(char in text for char in ' ="'):
+        text = '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    return text
+
+class Trace:
+    # The spans of one request (e.g. one recommendation), kept for the debug panel
+    def __init__(self, name, info):
+        self.name = name
+        self.info = info  # what the request was for, e.g. the user_id
+        self.started_at = time.time()
+        self.spans = []  # (span name, milliseconds) in the order they finished
+        self.total_ms = None
+        self.error = None
+
+class NoSpan:
+    # What span() and trace() return when metrics are off
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+NO_SPAN = NoSpan()
+
+enabled = False
+sinks = []
+recent_traces = deque(maxlen=50)
+_local = threading.local()
+
+class Span:
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        seconds = time.perf_counter() - self.start
+        current = getattr(_local, 'trace', None)
+        if current is not None:
+            current.spans.append((self.name, seconds * 1000))
+        send(self.name, seconds, self.labels)
+        if exc is not None:
+            record_error(self.name, exc)
+        return False
+
+class TraceSpan(Span):
+    def __init__(self, name, info):
+        super().__init__(name, {})
+        self.trace = Trace(name, info)
+
+    def __enter__(self):
+        self.outer = getattr(_local, 'trace', None)
+        if self.outer is None:
+            # Only the outermost trace is kept; inner ones just add their spans to it
+            _local.trace = self.trace
+        return super().__enter__()
+
+    def __exit__(self, exc_type, exc, traceback):
+        super().__exit__(exc_type, exc, traceback)
+        if self.outer is None:
+            _local.trace = None
+            self.trace.total_ms = (time.perf_counter() - self.start) * 1000
+            recent_traces.append(self.trace)
+        return False
+
+def span(name, **labels):
+    # Time a block: with metrics.span("recommend.score", strategy="user"): ...
+    # Labels should only have a few possible values (not user ids), every combination is a histogram
+    if not enabled:
+        return NO_SPAN
+    return Span(name, labels)
+
+def trace(name, **info):
+    # Like span, but also collects the spans inside it for the debug panel (see recent_traces)
+    if not enabled:
+        return NO_SPAN
+    return TraceSpan(name, info)
+
+def timed(name):
+    # Decorator that runs the whole function inside a span
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with Span(name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def send(name, seconds, labels):
+    for sink in sinks:
+        sink.record(name, seconds, labels)
+
+def record_error(name, error):
+    # Count an error (also marks the current trace as failed)
+    if not enabled:
+        return
+    current = getattr(_local, 'trace', None)
+    if current is not None and current.error is None:
+        current.error = f"{type(error).__name__}: {error}"
+    for sink in sinks:
+        if hasattr(sink, 'error'):
+            sink.error(name, error)
+
+def enable(new_sinks=(), max_traces=50):
+    # Turn metrics on with the given sinks (objects with record(name, seconds, labels) and,
+    # optionally, error(name, error))
+    global enabled, recent_traces
+    sinks[:] = list(new_sinks)
+    recent_traces = deque(recent_traces, maxlen=max_traces)
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+    for sink in sinks:
+        if hasattr(sink, 'flush'):
+            sink.flush()
+
+def sink_of_type(sink_type):
+    # The first active sink of a type (e.g. HistogramSink for the debug panel), or None
+    for sink in sinks:
+        if isinstance(sink, sink_type):
+            return sink
+    return None
+
+def configure_from_env():
+    # Set up the sinks named in METRICS
+    names = [name.strip() for name in os.environ.get("METRICS", "").lower().split(",") if name.strip()]
+    if not names or names == ["off"] or names == ["0"]:
+        return
+    new_sinks = []
+    for name in names:
+        if name == "memory":
+            new_sinks.append(HistogramSink())
+        elif name == "logfmt":
+            path = os.environ.get("METRICS_LOGFMT_FILE")
+            new_sinks.append(LogfmtSink(open(path, "a") if path else None))
+        elif name == "prometheus":
+            new_sinks.append(PrometheusFileSink(os.environ.get("METRICS_PROMETHEUS_FILE", "metrics.prom")))
+        else:
+            print(f"Unknown metrics sink: {name}")
+    enable(new_sinks, int(os.environ.get("METRICS_TRACES", 50)))
+
+configure_from_env()
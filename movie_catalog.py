@@ -0,0 +1,69 @@
+# This file keeps an index of the movies table, so the title, IMDb link and genres of many movies
+# can be looked up at once by movie_id instead of scanning the whole table for every movie
+
+import numpy as np
+from dataset import GENRE_COLUMNS, GENRE_NAMES, dataset
+
+def genre_mask(genres):
+    # Turn a list of genre names into one number with bit i set for genre_i
+    mask = 0
+    for genre in genres:
+        mask |= 1 << GENRE_NAMES.index(genre)
+    return mask
+
+class MovieCatalog:
+    def __init__(self, movies):
+        self.movie_ids = movies['movie_id'].to_numpy(dtype=np.int64)
+        self.titles = movies['title'].fillna("Unknown").to_numpy(dtype=object)
+        self.imdb_urls = movies['imdb_url'].fillna("").to_numpy(dtype=object)
+        self.genres = movies[GENRE_COLUMNS].to_numpy(dtype=np.uint8)
+        # All genres of a movie packed into one number: bit i is set if the movie has genre_i
+        self.genre_bits = self.genres.astype(np.uint32) @ (1 << np.arange(len(GENRE_COLUMNS), dtype=np.uint32))
+
+        # positions[movie_id] = row of that movie, or -1 if there is no such movie
+        self.positions = np.full(self.movie_ids.max() + 1 if len(self.movie_ids) else 0, -1, dtype=np.int64)
+        self.positions[self.movie_ids] = np.arange(len(self.movie_ids))
+
+    def __len__(self):
+        return len(self.movie_ids)
+
+    def lookup(self, movie_ids):
+        # Rows of the given movie ids (-1 for unknown ids)
+        movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        found = (movie_ids >= 0) & (movie_ids < len(self.positions))
+        rows = np.full(len(movie_ids), -1, dtype=np.int64)
+        rows[found] = self.positions[movie_ids[found]]
+        return rows
+
+    def titles_for(self, movie_ids, default="Unknown"):
+        return self._values_for(self.titles, movie_ids, default)
+
+    def imdb_urls_for(self, movie_ids, default=""):
+        return self._values_for(self.imdb_urls, movie_ids, default)
+
+    def genres_for(self, movie_ids):
+        # One row of 19 genre flags (0/1) per movie, all zeros for unknown ids
+        rows = self.lookup(movie_ids)
+        flags = np.zeros((len(rows), self.genres.shape[1]), dtype=np.uint8)
+        flags[rows >= 0] = self.genres[rows[rows >= 0]]
+        return flags
+
+    def genre_bits_for(self, movie_ids):
+        return self._values_for(self.genre_bits, movie_ids, 0)
+
+    def has_any_genre(self, movie_ids, mask):
+        # Which of the movies have at least one of the genres in the mask (see genre_mask)
+        return (self.genre_bits_for(movie_ids) & np.uint32(mask)) != 0
+
+    def _values_for(self, values, movie_ids, default):
+        rows = self.lookup(movie_ids)
+        result = np.full(len(rows), default, dtype=values.dtype)
+        result[rows >= 0] = values[rows[rows >= 0]]
+        return result
+
+def get_movie_catalog():
+    # The catalog is built once per data version and shared by the app and the recommender.
+    # New ratings don't change the movies table, so the catalog is kept when they arrive
+    return dataset.derived(
+        'movie_catalog', lambda data: MovieCatalog(data.movies), update=lambda catalog, new_ratings: catalog
+    )
@@ -0,0 +1,157 @@
+# This file runs the batch recommender (recommend_movies_for_users) on several CPU cores, for big jobs
+# like a nightly precompute of everyone's top N. The rating matrix is saved once as .npy files that
+# every worker process memory-maps (the operating system shares the pages, nothing is pickled), the
+# users are split into shards, and every worker writes the recommendations of its shard to its own CSV
+# file. The parts are added to one output file in shard order as they finish, so the results are never
+# all in memory at once.
+# Settings (environment variables): RECOMMEND_WORKERS (default: number of CPUs, 0 = no pool),
+# RECOMMEND_SHARED_DIR (where the shared arrays go, default: the system temp folder)
+# Run it with: python parallel_recommender.py output.csv [--workers 8] [--shard-size 2000] [--top-n 10]
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from item_similarity import ItemSimilarityModel
+from matrix_factorization import FactorModel
+from rating_matrix import RatingMatrix
+
+OUTPUT_COLUMNS = ['user_id', 'movie_id', 'title', 'predicted_rating', 'rating_count', 'avg_rating']
+
+# What a worker loads once when it starts (see _start_worker)
+_worker = {}
+
+def save_shared_arrays(shared_dir, rating_matrix, min_rating, movie_filter, strategy):
+    # Everything the workers need, as files they can memory-map
+    rating_matrix.liked_bits(min_rating)  # build the liked matrices and bitsets once, here
+    rating_matrix.save(os.path.join(shared_dir, "rating_matrix"))
+
+    from movie_catalog import get_movie_catalog
+    titles = get_movie_catalog().titles_for(rating_matrix.movie_ids)
+    np.save(os.path.join(shared_dir, "titles.npy"), np.array([title.encode("utf-8") for title in titles]))
+    if movie_filter is not None:
+        np.save(os.path.join(shared_dir, "movie_filter.npy"), movie_filter)
+    if strategy in ("item", "mf"):
+        from dataset import dataset
+        from recommender import get_factor_model, get_item_similarity
+        model = get_item_similarity() if strategy == "item" else get_factor_model()
+        model.save(os.path.join(shared_dir, strategy), dataset.file_path('ratings'))
+
+def _start_worker(shared_dir, strategy, ratings_path):
+    # Runs once in every worker process: attach to the shared arrays
+    _worker['rating_matrix'] = RatingMatrix.load(os.path.join(shared_dir, "rating_matrix"))
+    _worker['titles'] = np.load(os.path.join(shared_dir, "titles.npy"), mmap_mode='r')
+    filter_path = os.path.join(shared_dir, "movie_filter.npy")
+    _worker['movie_filter'] = np.load(filter_path, mmap_mode='r') if os.path.exists(filter_path) else None
+    _worker['model'] = None  # the item or factor model, None for "user"
+    if strategy == "item":
+        _worker['model'] = ItemSimilarityModel.load(os.path.join(shared_dir, strategy), ratings_path)
+    elif strategy == "mf":
+        _worker['model'] = FactorModel.load(os.path.join(shared_dir, strategy), ratings_path)
+
+def _recommend_shard(user_ids, part_path, min_rating, top_n, min_similar_ratings, chunk_size):
+    # Recommend for one shard of users, chunk_size users at a time, appending every chunk to part_path.
+    # Returns the number of rows written
+    from recommender import top_recommendations_for_chunk
+
+    rating_matrix, titles = _worker['rating_matrix'], _worker['titles']
+    movie_filter, model = _worker['movie_filter'], _worker['model']
+    written = 0
+    with open(part_path, "w", encoding="utf-8", newline="") as f:
+        for start in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[start:start + chunk_size]
+            if model is not None:
+                scores = model.score_movies_for_users(rating_matrix, chunk, min_rating, movie_filter)
+            else:
+                scores = rating_matrix.score_movies_for_users(chunk, min_rating, movie_filter)
+            top_recommendations = top_recommendations_for_chunk(rating_matrix.movie_ids, scores, top_n,
+                                                                min_similar_ratings)
+            if top_recommendations is None:
+                continue
+
+            columns = np.searchsorted(rating_matrix.movie_ids, top_recommendations['movie_id'].to_numpy())
+            top_recommendations.insert(2, 'title', [title.decode("utf-8") for title in titles[columns]])
+            top_recommendations.to_csv(f, header=False, index=False, lineterminator="\n")
+            written += len(top_recommendations)
+    return written
+
+def recommend_movies_for_users_parallel(output_path, user_ids=None, min_rating=4, top_n=5, min_similar_ratings=10,
+                                        genres=None, strategy="user", workers=None, shard_size=2000, chunk_size=500):
+    # Same recommendations as recommend_movies_for_users (for every user if user_ids is None), written to
+    # output_path as CSV with a header row. workers processes each take shard_size users at a time.
+    # Returns the number of recommendations written
+    from dataset import dataset
+    from recommender import get_genre_filter, get_rating_matrix
+
+    if strategy not in ("user", "item", "mf"):
+        raise ValueError(f"Unknown recommendation strategy: {strategy}")
+    if workers is None:
+        workers = int(os.environ.get("RECOMMEND_WORKERS", os.cpu_count() or 1))
+    rating_matrix = get_rating_matrix()
+    user_ids = np.asarray(rating_matrix.user_ids if user_ids is None else list(user_ids), dtype=np.int64)
+    shards = [user_ids[start:start + shard_size] for start in range(0, len(user_ids), shard_size)]
+
+    shared_dir = tempfile.mkdtemp(prefix="recommend_shared_", dir=os.environ.get("RECOMMEND_SHARED_DIR"))
+    pool = None
+    try:
+        save_shared_arrays(shared_dir, rating_matrix, min_rating, get_genre_filter(genres), strategy)
+        setup = (shared_dir, strategy, dataset.file_path('ratings'))
+        part_paths = [os.path.join(shared_dir, f"part-{shard:05d}.csv") for shard in range(len(shards))]
+        jobs = [(shard_users, part_path, min_rating, top_n, min_similar_ratings, chunk_size)
+                for shard_users, part_path in zip(shards, part_paths)]
+
+        if workers == 0:
+            # No pool: run the shards one after another here (same code, handy for debugging)
+            _start_worker(*setup)
+            results = (_recommend_shard(*job) for job in jobs)
+        else:
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=_start_worker, initargs=setup)
+            futures = [pool.submit(_recommend_shard, *job) for job in jobs]
+            results = (future.result() for future in futures)
+
+        # Add the parts to the output in shard order as they finish (waiting for the next one in line),
+        # deleting each part once it is copied. The output only appears when it is complete
+        temp_path = f"{output_path}.{os.getpid()}.tmp"
+        total = 0
+        try:
+            with open(temp_path, "w", encoding="utf-8", newline="") as out:
+                out.write(",".join(OUTPUT_COLUMNS) + "\n")
+                for part_path, written in zip(part_paths, results):
+                    with open(part_path, encoding="utf-8", newline="") as part:
+                        shutil.copyfileobj(part, out)
+                    os.remove(part_path)
+                    total += written
+            os.replace(temp_path, output_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return total
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        shutil.rmtree(shared_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Recommend movies for every user on several CPU cores")
+    parser.add_argument("output", help="CSV file to write the recommendations to")
+    parser.add_argument("--workers", type=int, help="worker processes (default: RECOMMEND_WORKERS or the CPU count)")
+    parser.add_argument("--shard-size", type=int, default=2000, help="users per task given to a worker")
+    parser.add_argument("--chunk-size", type=int, default=500, help="users scored at once inside a worker")
+    parser.add_argument("--min-rating", type=int, default=4)
+    parser.add_argument("--top-n", type=int, default=5)
+    parser.add_argument("--strategy", default="user", choices=["user", "item", "mf"])
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    written = recommend_movies_for_users_parallel(
+        args.output, min_rating=args.min_rating, top_n=args.top_n, strategy=args.strategy,
+        workers=args.workers, shard_size=args.shard_size, chunk_size=args.chunk_size
+    )
+    print(f"Wrote {written:,} recommendations to {args.output} in {time.perf_counter() - start:.1f} s")
@@ -0,0 +1,152 @@
+# This file runs bcrypt (deliberately slow, ~100-300 ms per password) in a small pool of worker
+# processes, so sign-ins don't all queue up behind each other on the Streamlit script threads.
+# The number of waiting jobs is limited: when too many sign-ins arrive at once, new ones wait a
+# little and are then rejected with HasherBusy instead of piling up without limit.
+# If a worker process dies (killed, out of memory) the pool is replaced and the job is run again.
+# Settings (environment variables): BCRYPT_ROUNDS, AUTH_HASH_WORKERS (0 = no pool), AUTH_HASH_QUEUE,
+# AUTH_HASH_WAIT (seconds to wait for a free place in the queue)
+
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import bcrypt
+
+class HasherBusy(Exception):
+    # Raised when the hashing queue is full
+    pass
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+def _check(password, stored_hash):
+    return bcrypt.checkpw(password, stored_hash)
+
+def hash_rounds(stored_hash):
+    # The cost factor saved inside a bcrypt hash ("$2b$12$..." -> 12)
+    if isinstance(stored_hash, str):
+        stored_hash = stored_hash.encode('utf-8')
+    try:
+        return int(stored_hash.split(b"$")[2])
+    except (IndexError, ValueError):
+        return 0
+
+class PasswordHasher:
+    def __init__(self, rounds=None, max_workers=None, max_queued=None, queue_wait=None):
+        self.rounds = rounds or int(os.environ.get("BCRYPT_ROUNDS", 12))
+        self.max_workers = max_workers if max_workers is not None else int(
+            os.environ.get("AUTH_HASH_WORKERS", min(4, os.cpu_count() or 1)))
+        self.max_queued = max_queued if max_queued is not None else int(os.environ.get("AUTH_HASH_QUEUE", 32))
+        self.queue_wait = queue_wait if queue_wait is not None else float(os.environ.get("AUTH_HASH_WAIT", 5.0))
+        # Places for running + waiting jobs; a job holds its place until it is finished
+        self._places = threading.BoundedSemaphore(max(self.max_workers, 1) + self.max_queued)
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        # The worker processes are started the first time they are needed
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._pool
+
+    def _discard_pool(self, pool):
+        # A pool whose worker died can't run anything anymore; the next job starts a new one
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _run_in_pool(self, future, function, args, retries=1):
+        # Run the job in the pool and pass its result on to future. When the pool is broken the job is
+        # run again in a new pool, and if that one breaks too, without a pool in the thread that noticed
+        pool = self._get_pool()
+        try:
+            job = pool.submit(function, *args)
+        except BrokenProcessPool as e:
+            job = Future()
+            job.set_exception(e)
+
+        def done(job):
+            if future.done():
+                # Cancelled by the caller
+                return
+            if job.cancelled():
+                future.cancel()
+                return
+            error = job.exception()
+            if isinstance(error, BrokenProcessPool):
+                self._discard_pool(pool)
+                if retries > 0:
+                    self._run_in_pool(future, function, args, retries - 1)
+                    return
+                try:
+                    future.set_result(function(*args))
+                except Exception as e:
+                    future.set_exception(e)
+            elif error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(job.result())
+
+        job.add_done_callback(done)
+        # Cancelling the returned future also cancels the job if it hasn't started yet
+        future.add_done_callback(lambda future: job.cancel() if future.cancelled() else None)
+
+    def _submit(self, function, *args):
+        if not self._places.acquire(timeout=self.queue_wait):
+            raise HasherBusy("Too many sign-ins at the moment, please try again in a few seconds")
+
+        try:
+            if self.max_workers == 0:
+                # No pool: run here (the old behaviour)
+                future = Future()
+                try:
+                    future.set_result(function(*args))
+                except Exception as e:
+                    future.set_exception(e)
+            else:
+                future = Future()
+                self._run_in_pool(future, function, args)
+        except Exception:
+            self._places.release()
+            raise
+        future.add_done_callback(lambda f: self._places.release())
+        return future
+
+    def hash_password_async(self, password):
+        # Returns a Future with the bcrypt hash of the password
+        return self._submit(_hash, password.encode('utf-8'), self.rounds)
+
+    def check_password_async(self, password, stored_hash):
+        # Returns a Future with True if the password matches the stored hash
+        if isinstance(stored_hash, str):
+            stored_hash = stored_hash.encode('utf-8')
+        return self._submit(_check, password.encode('utf-8'), stored_hash)
+
+    def hash_password(self, password):
+        return self.hash_password_async(password).result()
+
+    def check_password(self, password, stored_hash):
+        return self.check_password_async(password, stored_hash).result()
+
+    async def hash_password_coroutine(self, password):
+        # For asyncio code: await the hash without blocking the event loop
+        return await asyncio.wrap_future(self.hash_password_async(password))
+
+    async def check_password_coroutine(self, password, stored_hash):
+        return await asyncio.wrap_future(self.check_password_async(password, stored_hash))
+
+    def needs_rehash(self, stored_hash):
+        # True if the hash was made with a lower cost factor than we use now
+        return hash_rounds(stored_hash) < self.rounds
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
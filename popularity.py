@@ -0,0 +1,70 @@
+# This file keeps a ranking of the most popular movies (highest average rating) for every minimum
+# rating from 1 to 5 stars, so the "Popular Movies" list doesn't regroup all ratings on every click
+
+import numpy as np
+
+RATING_VALUES = np.arange(6)  # ratings are whole stars 1-5 (0 is unused)
+
+class PopularityRanking:
+    def __init__(self, ratings, min_count=10):
+        self.min_count = min_count  # movies need at least this many ratings to be ranked
+        self.movie_ids = np.zeros(0, dtype=np.int64)
+        # rating_counts[row, r] = how many r star ratings the movie in that row has
+        self.rating_counts = np.zeros((0, len(RATING_VALUES)), dtype=np.int64)
+        self._rankings = {}  # min_rating -> ranked arrays, rebuilt after new ratings arrive
+        self.add_ratings(ratings['movie_id'].to_numpy(), ratings['rating'].to_numpy())
+
+    @classmethod
+    def from_counts(cls, movie_ids, rating_counts, min_count=10):
+        # A ranking from counts made elsewhere (e.g. rating_loader.RatingAggregates), without the ratings
+        # table. The counts are copied, so adding ratings here doesn't change them
+        ranking = cls.__new__(cls)
+        ranking.min_count = min_count
+        ranking.movie_ids = np.array(movie_ids, dtype=np.int64)
+        ranking.rating_counts = np.array(rating_counts, dtype=np.int64)
+        ranking._rankings = {}
+        return ranking
+
+    def add_ratings(self, movie_ids, ratings):
+        # Count new ratings. Only the counters change here; rankings are re-sorted on the next query
+        movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        ratings = np.asarray(ratings, dtype=np.int64)
+        if len(movie_ids) == 0:
+            return
+
+        # Add rows for movies we haven't seen before, keeping the rows sorted by movie_id
+        new_ids = np.setdiff1d(movie_ids, self.movie_ids)
+        if len(new_ids):
+            insert_at = np.searchsorted(self.movie_ids, new_ids)
+            self.movie_ids = np.insert(self.movie_ids, insert_at, new_ids)
+            self.rating_counts = np.insert(self.rating_counts, insert_at, 0, axis=0)
+
+        rows = np.searchsorted(self.movie_ids, movie_ids)
+        np.add.at(self.rating_counts, (rows, ratings), 1)
+        self._rankings.clear()
+
+    def movie_stats(self, min_rating):
+        # Number and average of the ratings >= min_rating for every movie
+        counts = self.rating_counts[:, min_rating:].sum(axis=1)
+        sums = self.rating_counts[:, min_rating:] @ RATING_VALUES[min_rating:]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return counts, sums / counts
+
+    def ranking(self, min_rating):
+        # Movies with enough ratings, sorted by average rating (equal averages by movie_id)
+        min_rating = int(min_rating)
+        if min_rating not in self._rankings:
+            counts, averages = self.movie_stats(min_rating)
+            ranked = np.flatnonzero(counts >= self.min_count)
+            ranked = ranked[np.lexsort((self.movie_ids[ranked], -averages[ranked]))]
+            self._rankings[min_rating] = (self.movie_ids[ranked], averages[ranked], counts[ranked])
+        return self._rankings[min_rating]
+
+    def top_movies(self, min_rating, top_n, keep=None):
+        # The top_n movies for a minimum rating as (movie_ids, avg_ratings, rating_counts).
+        # keep is an optional function that gets the ranked movie ids and returns which to keep
+        movie_ids, averages, counts = self.ranking(min_rating)
+        if keep is not None:
+            mask = keep(movie_ids)
+            movie_ids, averages, counts = movie_ids[mask], averages[mask], counts[mask]
+        return movie_ids[:top_n], averages[:top_n], counts[:top_n]
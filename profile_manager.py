@@ -44,8 +44,8 @@ class ProfileManager:
     def show_profile_info(self):
         st.subheader("Your Profile")
         
-        # Get current user information from database
-        user_info = auth.get_user_info(st.session_state.username)
+        # Get current user information (read from the database once, then kept in the session)
+        user_info = auth.get_profile(st.session_state.username)
         if not user_info:
             st.error("Couldn't load profile info")
             return
@@ -130,7 +130,7 @@ class ProfileManager:
         st.subheader("App Settings")
         
         # Get current theme preference
-        user_info = auth.get_user_info(st.session_state.username)
+        user_info = auth.get_profile(st.session_state.username)
         current_theme = user_info.get('theme_preference', 'light') if user_info else 'light'
         
         # Theme selector
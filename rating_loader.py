@@ -0,0 +1,460 @@
+# This file loads ratings files that can be bigger than memory. The file is read RATINGS_CHUNK_SIZE lines
+# at a time (default 1,000,000) with the small number types of data_cache.py, and everything the app
+# needs is built a chunk at a time:
+# - the binary cache of the ratings table (data/cache/ratings) that dataset.py memory-maps
+# - RatingAggregates: how many ratings of every star each movie and each user has. That gives the number
+#   and average of all ratings (the "Dataset Info" stats), the counts and averages of the popularity
+#   ranking and every user's number of liked movies
+# - the sparse user x movie matrix and its liked matrices, written straight into memory-mapped .npy files
+#   in the format of RatingMatrix.save, so RatingMatrix.load can map them instead of building the matrix
+#   in memory. Every version of the ratings file gets its own folder (data/cache/rating_matrix/<version>),
+#   built under a temporary name and renamed when it is finished, so a rebuild never changes files that
+#   other processes have mapped. The liked matrices of the other "Minimum Rating" thresholds are added
+#   to that folder (in their own folders, built the same way) the first time they are used
+# Memory use depends on the chunk size and the number of users and movies, not on the number of ratings.
+# Ratings are whole stars, like everywhere else (see popularity.py)
+# Run it with: python rating_loader.py [ratings file] [--chunk-size 1000000]
+
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import data_cache
+from dataset import TABLE_FILES
+from popularity import RATING_VALUES
+from rating_matrix import LIKED_NAMES, RatingMatrix, load_csr
+
+# Liked matrices built together with the rating matrix (the default of the app's "Minimum Rating" slider).
+# The other thresholds are built from the saved matrix, a chunk at a time, when first needed
+LIKED_MIN_RATINGS = [4]
+
+def chunk_size_or_default(chunk_size):
+    return chunk_size or int(os.environ.get("RATINGS_CHUNK_SIZE", 1000000))
+
+def read_rating_chunks(path, chunk_size=None):
+    # The ratings file as data frames of chunk_size rows, with the column types of the binary cache
+    file_name, separator, columns = TABLE_FILES['ratings']
+    column_types = {column: data_cache.COLUMN_TYPES[column] for column in columns}
+    with pd.read_csv(path, sep=separator, header=None, names=columns, dtype=column_types, encoding="latin1",
+                     chunksize=chunk_size_or_default(chunk_size)) as reader:
+        yield from reader
+
+def cache_ratings(data_dir, path, chunk_size=None):
+    # Convert the ratings file to the binary cache a chunk at a time. Returns the number of ratings
+    return data_cache.write_table_chunks(data_dir, 'ratings', read_rating_chunks(path, chunk_size), path)
+
+def cached_ratings(dataset, chunk_size=None):
+    # The ratings of the file on disk (appended ratings that aren't written yet are not included),
+    # memory-mapped from the binary cache, which is made first if it is missing or out of date
+    path = dataset.file_path('ratings')
+    table = data_cache.read_table(dataset.data_dir, 'ratings', path)
+    if table is None:
+        cache_ratings(dataset.data_dir, path, chunk_size)
+        table = data_cache.read_table(dataset.data_dir, 'ratings', path)
+    return table
+
+def column_chunks(table, chunk_size=None):
+    # (user_ids, movie_ids, ratings) arrays of chunk_size rows at a time. With a memory-mapped table
+    # only the current chunk is read from disk
+    chunk_size = chunk_size_or_default(chunk_size)
+    users, movies, ratings = (table[column].to_numpy() for column in ('user_id', 'movie_id', 'rating'))
+    for start in range(0, len(users), chunk_size):
+        yield users[start:start + chunk_size], movies[start:start + chunk_size], ratings[start:start + chunk_size]
+
+def add_counts(ids, counts, new_ids, ratings):
+    # Count ratings per id and star: rows are added for ids we haven't seen (kept sorted by id).
+    # Returns new arrays, so counts that are shared (or memory-mapped) are never changed
+    new_ids = np.asarray(new_ids, dtype=np.int64)
+    unseen = np.setdiff1d(new_ids, ids)
+    if len(unseen):
+        insert_at = np.searchsorted(ids, unseen)
+        ids = np.insert(ids, insert_at, unseen)
+        counts = np.insert(counts, insert_at, 0, axis=0)
+    rows = np.searchsorted(ids, new_ids)
+    cells = rows * len(RATING_VALUES) + np.asarray(ratings, dtype=np.int64)
+    return ids, counts + np.bincount(cells, minlength=counts.size).reshape(counts.shape)
+
+class RatingAggregates:
+    def __init__(self, movie_ids=None, movie_rating_counts=None, user_ids=None, user_rating_counts=None):
+        # movie_rating_counts[row, r] = how many r star ratings the movie in that row has (same for users).
+        # Every rating line counts, like in the ratings table
+        no_counts = np.zeros((0, len(RATING_VALUES)), dtype=np.int64)
+        self.movie_ids = np.zeros(0, dtype=np.int64) if movie_ids is None else movie_ids
+        self.movie_rating_counts = no_counts if movie_rating_counts is None else movie_rating_counts
+        self.user_ids = np.zeros(0, dtype=np.int64) if user_ids is None else user_ids
+        self.user_rating_counts = no_counts if user_rating_counts is None else user_rating_counts
+
+    @classmethod
+    def build(cls, chunks):
+        # Count the ratings of (user_ids, movie_ids, ratings) chunks, see column_chunks
+        aggregates = cls()
+        for user_ids, movie_ids, ratings in chunks:
+            aggregates.add_ratings(user_ids, movie_ids, ratings)
+        return aggregates
+
+    def add_ratings(self, user_ids, movie_ids, ratings):
+        self.movie_ids, self.movie_rating_counts = add_counts(self.movie_ids, self.movie_rating_counts,
+                                                              movie_ids, ratings)
+        self.user_ids, self.user_rating_counts = add_counts(self.user_ids, self.user_rating_counts,
+                                                            user_ids, ratings)
+
+    @property
+    def num_ratings(self):
+        return int(self.movie_rating_counts.sum())
+
+    def average_rating(self):
+        # Average of all ratings (nan if there are none)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return float(self.movie_rating_counts.sum(axis=0) @ RATING_VALUES / self.num_ratings)
+
+    def movie_stats(self, min_rating):
+        # Number and average of the ratings >= min_rating of every movie
+        counts = self.movie_rating_counts[:, min_rating:].sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return counts, self.movie_rating_counts[:, min_rating:] @ RATING_VALUES[min_rating:] / counts
+
+    def liked_counts(self, min_rating):
+        # Number of ratings >= min_rating of every user (a movie rated twice counts twice)
+        return self.user_rating_counts[:, min_rating:].sum(axis=1)
+
+    def save(self, directory, source_path):
+        # Save as .npy files
+        os.makedirs(directory, exist_ok=True)
+        for name in ("movie_ids", "movie_rating_counts", "user_ids", "user_rating_counts"):
+            data_cache.save_array(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+        data_cache.write_meta(directory, data_cache.source_signature(source_path))
+
+    @classmethod
+    def load(cls, directory, source_path):
+        # Load saved counts, or return None if there are none or the ratings file changed since
+        if data_cache.read_meta(directory, source_path) is None:
+            return None
+        return cls(*[np.load(os.path.join(directory, f"{name}.npy"))
+                     for name in ("movie_ids", "movie_rating_counts", "user_ids", "user_rating_counts")])
+
+def unique_ids(column, chunk_size):
+    # Sorted distinct values of a (memory-mapped) column, a chunk at a time
+    ids = np.zeros(0, dtype=np.int64)
+    for start in range(0, len(column), chunk_size):
+        chunk = np.sort(column[start:start + chunk_size].astype(np.int64))
+        ids = np.union1d(ids, chunk[np.append(True, chunk[1:] != chunk[:-1])])
+    return ids
+
+def row_blocks(indptr, chunk_size):
+    # Split the rows of a CSR matrix into blocks of about chunk_size entries (at least one row each)
+    start = 0
+    num_rows = len(indptr) - 1
+    while start < num_rows:
+        end = int(np.searchsorted(indptr, indptr[start] + chunk_size, side='right')) - 1
+        end = min(max(end, start + 1), num_rows)
+        yield start, end
+        start = end
+
+def ranks_within_groups(keys):
+    # For keys sorted in groups of equal values, the position of every key inside its group
+    starts = np.flatnonzero(np.append(True, keys[1:] != keys[:-1]))
+    return np.arange(len(keys)) - np.repeat(starts, np.diff(np.append(starts, len(keys))))
+
+class CSRWriter:
+    # The three arrays of a CSR matrix as memory-mapped .npy files in directory, named like
+    # RatingMatrix.save names them (f"{name}.data.npy" ...), filled a few entries at a time
+    def __init__(self, directory, name, counts, index_dtype, data_dtype=np.float64):
+        self.paths = {part: os.path.join(directory, f"{name}.{part}.npy") for part in ("data", "indices", "indptr")}
+        self.indptr = np.lib.format.open_memmap(self.paths['indptr'], 'w+', index_dtype, (len(counts) + 1,))
+        self.indptr[0] = 0
+        self.indptr[1:] = np.cumsum(counts)
+        size = int(self.indptr[-1])
+        self.indices = np.lib.format.open_memmap(self.paths['indices'], 'w+', index_dtype, (size,))
+        self.data = np.lib.format.open_memmap(self.paths['data'], 'w+', data_dtype, (size,))
+        self.filled = np.zeros(len(counts), dtype=np.int64)  # entries written to every row so far
+
+    def add(self, rows, indices, data):
+        # Add entries to the ends of their rows. Entries of the same row keep their order
+        order = np.argsort(rows, kind='stable')
+        rows = rows[order]
+        positions = self.indptr[rows] + self.filled[rows] + ranks_within_groups(rows)
+        self.indices[positions] = indices[order]
+        self.data[positions] = data[order]
+        self.filled += np.bincount(rows, minlength=len(self.filled))
+
+    def close(self):
+        for array in (self.indptr, self.indices, self.data):
+            array.flush()
+        del self.indptr, self.indices, self.data
+
+def shrink_array(path, length, chunk_size):
+    # Keep only the first length values of a .npy file (copied a chunk at a time)
+    old = np.load(path, mmap_mode='r')
+    if len(old) == length:
+        return
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    new = np.lib.format.open_memmap(temp_path, 'w+', old.dtype, (length,))
+    for start in range(0, length, chunk_size):
+        end = min(start + chunk_size, length)
+        new[start:end] = old[start:end]
+    new.flush()
+    del new, old
+    os.replace(temp_path, path)
+
+def build_rating_matrix(directory, table, source_path, chunk_size=None, liked_min_ratings=LIKED_MIN_RATINGS):
+    # Write the rating matrix of a (memory-mapped) ratings table to directory in the format of
+    # RatingMatrix.save, in a few passes over the table, chunk_size ratings at a time. Gives the same
+    # matrix as RatingMatrix(table): a (user, movie) pair rated more than once keeps its last rating.
+    # It is written to a temporary folder next to directory first (see move_into_place).
+    # Returns the matrix, loaded with RatingMatrix.load
+    temp_dir = f"{directory}.{os.getpid()}.tmp"
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+    try:
+        write_rating_matrix(temp_dir, table, source_path, chunk_size_or_default(chunk_size), liked_min_ratings)
+        move_into_place(temp_dir, directory, source_path)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return RatingMatrix.load(directory)
+
+def move_into_place(temp_dir, directory, source_path):
+    # Rename a finished matrix folder to directory. If another process has finished the same matrix
+    # first, that one is kept (it may be in use already). An older matrix in the way is renamed away
+    # and deleted: processes that have its files mapped keep them until they let go of them
+    if os.path.exists(directory) and load_rating_matrix(directory, source_path) is not None:
+        return
+    try:
+        os.rename(temp_dir, directory)
+    except OSError:
+        old_dir = f"{directory}.{os.getpid()}.old"
+        os.rename(directory, old_dir)
+        os.rename(temp_dir, directory)
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+def write_rating_matrix(directory, table, source_path, chunk_size, liked_min_ratings):
+    # The files of build_rating_matrix, written to directory (meta.json last)
+    users, movies, ratings = (table[column].to_numpy() for column in ('user_id', 'movie_id', 'rating'))
+    user_ids, movie_ids = unique_ids(users, chunk_size), unique_ids(movies, chunk_size)
+    data_cache.save_array(os.path.join(directory, "user_ids.npy"), user_ids)
+    data_cache.save_array(os.path.join(directory, "movie_ids.npy"), movie_ids)
+    # The index type scipy would pick, so the mapped arrays are used as they are instead of converted
+    index_dtype = np.int32 if max(len(users), len(user_ids), len(movie_ids)) < 2 ** 31 else np.int64
+
+    def chunks():
+        for start in range(0, len(users), chunk_size):
+            end = start + chunk_size
+            yield (np.searchsorted(user_ids, users[start:end]), np.searchsorted(movie_ids, movies[start:end]),
+                   ratings[start:end])
+
+    # 1. Put every rating in its user's row, in file order (a counting sort: count, then place)
+    row_counts = np.zeros(len(user_ids), dtype=np.int64)
+    for rows, cols, values in chunks():
+        row_counts += np.bincount(rows, minlength=len(user_ids))
+    writer = CSRWriter(directory, "ratings", row_counts, index_dtype)
+    for rows, cols, values in chunks():
+        writer.add(rows, cols.astype(index_dtype), values.astype(np.float64))
+
+    # 2. Sort every row by movie and drop all but the last rating of a movie, moving the entries forward
+    # in place (a block is read before it is written, and never further back than where it started)
+    indptr, indices, data = writer.indptr, writer.indices, writer.data
+    row_starts = np.array(indptr)  # where the rows are before they move (indptr is updated as they do)
+    written = 0
+    for start, end in row_blocks(row_starts, chunk_size):
+        begin, finish = int(row_starts[start]), int(row_starts[end])
+        block_cols, block_values = np.array(indices[begin:finish]), np.array(data[begin:finish])
+        block_rows = np.repeat(np.arange(end - start), np.diff(row_starts[start:end + 1]))
+        keys = block_rows.astype(np.int64) * len(movie_ids) + block_cols
+        order = np.argsort(keys, kind='stable')
+        keep = order[np.append(keys[order][1:] != keys[order][:-1], True)]
+        indices[written:written + len(keep)] = block_cols[keep]
+        data[written:written + len(keep)] = block_values[keep]
+        indptr[start + 1:end + 1] = written + np.cumsum(np.bincount(block_rows[keep], minlength=end - start))
+        written += len(keep)
+    writer.close()
+    shrink_array(writer.paths['indices'], written, chunk_size)
+    shrink_array(writer.paths['data'], written, chunk_size)
+    ratings_matrix = load_csr(directory, "ratings", (len(user_ids), len(movie_ids)))
+
+    # 3. The liked matrices of the thresholds built now (the others are built when first needed, see
+    # load_or_build_liked)
+    for min_rating in liked_min_ratings:
+        write_liked_matrices(directory, ratings_matrix, min_rating, chunk_size)
+
+    meta = dict(data_cache.source_signature(source_path), shape=[len(user_ids), len(movie_ids)],
+                liked=list(liked_min_ratings), bits=[])
+    data_cache.write_meta(directory, meta)
+
+def write_liked_matrices(directory, ratings_matrix, min_rating, chunk_size):
+    # The liked matrices of min_rating (see RatingMatrix.liked_matrices) of a (memory-mapped) rating
+    # matrix, written to directory: the ratings >= min_rating row by row, their transposes (a counting
+    # sort by movie) and the same with 1 for every rating
+    num_users, num_movies = ratings_matrix.shape
+    index_dtype = ratings_matrix.indices.dtype
+    row_counts = np.zeros(num_users, dtype=np.int64)
+    col_counts = np.zeros(num_movies, dtype=np.int64)
+    for start, end in row_blocks(ratings_matrix.indptr, chunk_size):
+        block = ratings_matrix[start:end]
+        liked = block.data >= min_rating
+        block_rows = np.repeat(np.arange(end - start), np.diff(block.indptr))
+        row_counts[start:end] = np.bincount(block_rows[liked], minlength=end - start)
+        col_counts += np.bincount(block.indices[liked], minlength=num_movies)
+    writers = {name: CSRWriter(directory, f"{name}_{min_rating}", row_counts if name in ("liked", "binary")
+                               else col_counts, index_dtype) for name in LIKED_NAMES}
+    for start, end in row_blocks(ratings_matrix.indptr, chunk_size):
+        block = ratings_matrix[start:end]
+        liked = block.data >= min_rating
+        rows = start + np.repeat(np.arange(end - start), np.diff(block.indptr))[liked]
+        cols, values = block.indices[liked], block.data[liked]
+        ones = np.ones(len(values))
+        writers['liked'].add(rows, cols, values)
+        writers['binary'].add(rows, cols, ones)
+        writers['liked_t'].add(cols, rows.astype(index_dtype), values)
+        writers['binary_t'].add(cols, rows.astype(index_dtype), ones)
+    for writer in writers.values():
+        writer.close()
+
+def load_or_build_liked(directory, min_rating, chunk_size=None):
+    # The liked matrices of a threshold that build_rating_matrix didn't build, for the matrix in
+    # directory: written a chunk at a time into a folder of their own inside it the first time a
+    # process needs them (under a temporary name, like the matrix), then memory-mapped by every
+    # process. None if they can't be written (the matrix builds them in memory then)
+    liked_dir = os.path.join(directory, f"liked_{min_rating}")
+    temp_dir = f"{liked_dir}.{os.getpid()}.tmp"
+    try:
+        meta = data_cache.read_meta(directory)
+        if meta is None:
+            raise FileNotFoundError(f"No rating matrix in {directory}")
+        shape = tuple(meta['shape'])
+        if data_cache.read_meta(liked_dir) is None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            os.makedirs(temp_dir)
+            write_liked_matrices(temp_dir, load_csr(directory, "ratings", shape), min_rating,
+                                 chunk_size_or_default(chunk_size))
+            data_cache.write_meta(temp_dir, {'shape': list(shape), 'liked': [min_rating]})
+            try:
+                os.rename(temp_dir, liked_dir)
+            except OSError:
+                # Another process was faster, use its files
+                if data_cache.read_meta(liked_dir) is None:
+                    raise
+        return tuple(load_csr(liked_dir, f"{name}_{min_rating}", shape if name in ("liked", "binary") else shape[::-1])
+                     for name in LIKED_NAMES)
+    except OSError as e:
+        # Can't write them, or the matrix folder was deleted (the ratings file changed)
+        print(f"Couldn't save the liked matrices of {min_rating} stars:", e)
+        return None
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def aggregates_dir_for(data_dir):
+    return os.path.join(data_dir, "cache", "rating_aggregates")
+
+def matrices_dir_for(data_dir):
+    return os.path.join(data_dir, "cache", "rating_matrix")
+
+def matrix_dir_for(data_dir, source_path):
+    # The folder of the matrix of this version of the ratings file
+    signature = data_cache.source_signature(source_path)
+    return os.path.join(matrices_dir_for(data_dir), f"{signature['format']}-{signature['size']}-{signature['mtime']!r}")
+
+def remove_old_matrices(data_dir, keep):
+    # Delete the matrices of older versions of the ratings file (and files left by the layout before
+    # there were folders per version). Folders that are still being built are left alone
+    matrices_dir = matrices_dir_for(data_dir)
+    for name in os.listdir(matrices_dir):
+        path = os.path.join(matrices_dir, name)
+        if path == keep or name.endswith(".tmp"):
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Another process deleted it first
+                pass
+
+def aggregates_of_table(ratings):
+    return RatingAggregates.build([(ratings['user_id'].to_numpy(), ratings['movie_id'].to_numpy(),
+                                    ratings['rating'].to_numpy())])
+
+def load_or_build_aggregates(dataset, chunk_size=None):
+    # The rating counts of the dataset: the saved ones if they are up to date, otherwise counted from
+    # the cached ratings (and saved), plus the appended ratings that aren't written to the file yet.
+    # Without the binary cache they are counted from the ratings table
+    if not dataset.use_cache:
+        return aggregates_of_table(dataset.ratings)
+    dataset.watch_file('ratings')
+    directory, source_path = aggregates_dir_for(dataset.data_dir), dataset.file_path('ratings')
+    aggregates = RatingAggregates.load(directory, source_path)
+    if aggregates is None:
+        try:
+            aggregates = RatingAggregates.build(column_chunks(cached_ratings(dataset, chunk_size), chunk_size))
+            aggregates.save(directory, source_path)
+        except OSError as e:
+            print("Couldn't save rating counts:", e)
+            return aggregates_of_table(dataset.ratings)
+    unsaved = dataset.unsaved_ratings()
+    if unsaved is not None:
+        aggregates.add_ratings(unsaved['user_id'], unsaved['movie_id'], unsaved['rating'])
+    return aggregates
+
+def load_rating_matrix(directory, source_path):
+    # A matrix written by build_rating_matrix, or None if there is none or the ratings file changed since
+    try:
+        if data_cache.read_meta(directory, source_path) is None:
+            return None
+        return RatingMatrix.load(directory)
+    except (FileNotFoundError, ValueError):
+        # Not there, or deleted by another process while loading it
+        return None
+
+def load_or_build_rating_matrix(dataset, chunk_size=None):
+    # The rating matrix of the dataset, memory-mapped from data/cache (built there first if needed),
+    # plus the appended ratings that aren't written to the file yet. Without the binary cache it is
+    # built in memory from the ratings table like before
+    if not dataset.use_cache:
+        return RatingMatrix(dataset.ratings)
+    dataset.watch_file('ratings')
+    source_path = dataset.file_path('ratings')
+    directory = matrix_dir_for(dataset.data_dir, source_path)
+    rating_matrix = load_rating_matrix(directory, source_path)
+    if rating_matrix is None:
+        try:
+            rating_matrix = build_rating_matrix(directory, cached_ratings(dataset, chunk_size), source_path,
+                                                chunk_size)
+        except OSError as e:
+            print("Couldn't save the rating matrix, building it in memory:", e)
+            return RatingMatrix(dataset.ratings)
+        try:
+            remove_old_matrices(dataset.data_dir, keep=directory)
+        except OSError as e:
+            # The new matrix is fine, the old files are tried again after the next build
+            print("Couldn't delete old rating matrices:", e)
+    rating_matrix.liked_source = lambda min_rating: load_or_build_liked(directory, min_rating, chunk_size)
+    unsaved = dataset.unsaved_ratings()
+    if unsaved is not None:
+        rating_matrix.add_ratings(unsaved)
+    return rating_matrix
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    import tracemalloc
+
+    parser = argparse.ArgumentParser(description="Load a ratings file in chunks and build the rating counts and matrix")
+    parser.add_argument("ratings", nargs="?", default="data/ratings.csv", help="ratings file (in a data folder)")
+    parser.add_argument("--chunk-size", type=int, help="ratings per chunk (default: RATINGS_CHUNK_SIZE or 1,000,000)")
+    args = parser.parse_args()
+
+    from dataset import MovieDataset
+    data = MovieDataset(os.path.dirname(os.path.abspath(args.ratings)))
+    tracemalloc.start()  # numpy arrays are counted too; the memory-mapped files are not
+    start = time.perf_counter()
+    rows = cache_ratings(data.data_dir, data.file_path('ratings'), args.chunk_size)
+    print(f"Cached {rows:,} ratings in {time.perf_counter() - start:.1f} s")
+    start = time.perf_counter()
+    aggregates = load_or_build_aggregates(data, args.chunk_size)
+    print(f"Counted {aggregates.num_ratings:,} ratings (average {aggregates.average_rating():.2f}) of "
+          f"{len(aggregates.user_ids):,} users and {len(aggregates.movie_ids):,} movies "
+          f"in {time.perf_counter() - start:.1f} s")
+    start = time.perf_counter()
+    rating_matrix = build_rating_matrix(matrix_dir_for(data.data_dir, data.file_path('ratings')), cached_ratings(data),
+                                        data.file_path('ratings'), args.chunk_size)
+    print(f"Built the rating matrix ({rating_matrix.ratings.nnz:,} ratings) in {time.perf_counter() - start:.1f} s")
+    print(f"Peak memory allocated while loading: {tracemalloc.get_traced_memory()[1] / 1024 ** 2:.0f} MB")
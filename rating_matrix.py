@@ -0,0 +1,432 @@
+# This file builds a sparse user x movie rating matrix once, so recommendations can be worked out
+# with sparse matrix-vector products (and bitsets of liked movies for finding similar users)
+# instead of scanning the whole ratings table on every request
+
+import os
+import numpy as np
+from scipy import sparse
+import data_cache
+
+# Names of the four matrices liked_matrices returns, for save / load
+LIKED_NAMES = ["liked", "binary", "liked_t", "binary_t"]
+
+# Number of 1 bits in every byte value, for numpy versions without np.bitwise_count
+BYTE_BIT_COUNTS = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint8)
+
+def popcount(words):
+    # Number of 1 bits in every element of an unsigned integer array
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    return BYTE_BIT_COUNTS[words.view(np.uint8)].reshape(words.shape + (-1,)).sum(axis=-1, dtype=np.uint8)
+
+class RatingMatrix:
+    # The matrix is kept in two parts: the base (built from the ratings file, usually memory-mapped
+    # from data/cache) and a small delta with the changes made by add_ratings since then. The scores
+    # add the delta on top of the base, so a new rating costs about as much as the delta is big
+    # instead of a copy of the whole matrix. merge_changes adds the delta into the base
+    def __init__(self, ratings):
+        # Give every user and movie a dense integer position (sorted by id)
+        ratings = ratings.drop_duplicates(subset=['user_id', 'movie_id'], keep='last')
+        self.user_ids = np.unique(ratings['user_id'].values).astype(np.int64)
+        self.movie_ids = np.unique(ratings['movie_id'].values).astype(np.int64)
+        rows = np.searchsorted(self.user_ids, ratings['user_id'].values)
+        cols = np.searchsorted(self.movie_ids, ratings['movie_id'].values)
+
+        # CSR for per-user rows, CSC (stored as the transposed CSR) for per-movie sums
+        base = sparse.csr_matrix(
+            (ratings['rating'].values.astype(np.float64), (rows, cols)),
+            shape=(len(self.user_ids), len(self.movie_ids))
+        )
+        base.sort_indices()
+        self._start(base, {}, {})
+
+    def _start(self, base, liked, liked_bits):
+        self._base = base
+        self._delta = self._empty(base.shape)  # new rating - old rating (0 = not rated) per changed pair
+        self._liked = {min_rating: (matrices, self._empty_liked_delta()) for min_rating, matrices in liked.items()}
+        self._liked_bits = liked_bits
+        self._merged = {}  # base + delta, made when someone asks for the whole matrix (see ratings)
+        # Gives the liked matrices of a threshold of this base without copying it (rating_loader sets it
+        # for a matrix mapped from data/cache), or None: then liked_parts builds them in memory
+        self.liked_source = None
+
+    def save(self, directory):
+        # Save the matrix, plus the liked matrices and bitsets built so far, as .npy files that other
+        # processes can memory-map with load() instead of building (or receiving a copy of) their own.
+        # Changes from add_ratings are saved added into the base
+        os.makedirs(directory, exist_ok=True)
+        arrays = {'user_ids': self.user_ids, 'movie_ids': self.movie_ids}
+        arrays.update(csr_arrays("ratings", self.ratings))
+        for min_rating in list(self._liked):
+            for name, matrix in zip(LIKED_NAMES, self.liked_matrices(min_rating)):
+                arrays.update(csr_arrays(f"{name}_{min_rating}", matrix))
+        for min_rating in list(self._liked_bits):
+            arrays[f"bits_{min_rating}"] = self.liked_bits(min_rating)
+        for name, array in arrays.items():
+            data_cache.save_array(os.path.join(directory, f"{name}.npy"), array)
+
+        data_cache.write_meta(directory, {'shape': list(self._base.shape), 'liked': list(self._liked),
+                                          'bits': list(self._liked_bits)})
+
+    @classmethod
+    def load(cls, directory):
+        # A matrix saved with save(), memory-mapped read-only: the operating system shares the pages
+        # between every process that loads it. New ratings go into the delta, the files are never
+        # changed (bitsets are copied the first time a rating changes them)
+        meta = data_cache.read_meta(directory)
+        if meta is None:
+            raise FileNotFoundError(f"No saved rating matrix in {directory}")
+
+        def array(name):
+            return np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r')
+
+        shape = tuple(meta['shape'])
+        rating_matrix = cls.__new__(cls)  # skip __init__, everything comes from the files
+        rating_matrix.user_ids = array('user_ids')
+        rating_matrix.movie_ids = array('movie_ids')
+        liked = {
+            min_rating: tuple(load_csr(directory, f"{name}_{min_rating}",
+                                       shape if name in ("liked", "binary") else shape[::-1])
+                              for name in LIKED_NAMES)
+            for min_rating in meta['liked']
+        }
+        liked_bits = {min_rating: array(f"bits_{min_rating}") for min_rating in meta['bits']}
+        rating_matrix._start(load_csr(directory, "ratings", shape), liked, liked_bits)
+        return rating_matrix
+
+    @property
+    def shape(self):
+        return (len(self.user_ids), len(self.movie_ids))
+
+    @property
+    def ratings(self):
+        # The whole matrix with the changes added (a copy of the base once there are changes, made
+        # once per change). For building models; recommendations use the base and the delta directly
+        if self._delta.nnz == 0:
+            return self._base
+        if 'ratings' not in self._merged:
+            self._merged['ratings'] = self._base + self._delta
+        return self._merged['ratings']
+
+    def rating_rows(self, positions):
+        # The ratings of the users at these rows (a small CSR matrix)
+        return self._base[positions] + self._delta[positions]
+
+    def rated_movies(self, pos):
+        # Column positions of the movies the user at row pos has rated
+        if self._delta.indptr[pos] == self._delta.indptr[pos + 1]:
+            return self._base.indices[self._base.indptr[pos]:self._base.indptr[pos + 1]]
+        return self.rating_rows([pos]).indices
+
+    def user_position(self, user_id):
+        # Return the row of a user, or -1 if the user has no ratings
+        pos = np.searchsorted(self.user_ids, user_id)
+        if pos < len(self.user_ids) and self.user_ids[pos] == user_id:
+            return int(pos)
+        return -1
+
+    def liked_user_positions(self, user_ids, min_rating):
+        # (user_ids, rows) of the given users that have at least one rating >= min_rating
+        user_ids = np.asarray(user_ids)
+        if len(self.user_ids) == 0:
+            return user_ids[:0], np.zeros(0, dtype=np.int64)
+        positions = np.searchsorted(self.user_ids, user_ids).clip(0, len(self.user_ids) - 1)
+        (liked, binary, liked_t, binary_t), (liked_delta, binary_delta) = self.liked_parts(min_rating)
+        liked_counts = np.diff(binary.indptr)[positions] + np.asarray(binary_delta[positions].sum(axis=1)).ravel()
+        keep = (self.user_ids[positions] == user_ids) & (liked_counts > 0)
+        return user_ids[keep], positions[keep]
+
+    def liked_parts(self, min_rating):
+        # ((liked, binary, liked_t, binary_t) of the base, (liked, binary) changes since then) for the
+        # ratings >= min_rating. The base part is built once per threshold and reused
+        if min_rating not in self._liked:
+            matrices = self.liked_source(min_rating) if self.liked_source is not None else None
+            if matrices is not None:
+                # Saved for the base as it was loaded; new users / movies are added at the end
+                shape = self.shape
+                matrices = tuple(grow_csr(matrix, shape if name in ("liked", "binary") else shape[::-1])
+                                 for name, matrix in zip(LIKED_NAMES, matrices))
+            else:
+                liked = self._base.copy()
+                liked.data[liked.data < min_rating] = 0
+                liked.eliminate_zeros()
+                binary = liked.copy()
+                binary.data[:] = 1.0
+                matrices = (liked, binary, liked.T.tocsr(), binary.T.tocsr())
+            # The changes made so far, from the rating before and after every change
+            rows, cols = self._delta.nonzero()
+            old_values = values_at(self._base, rows, cols)
+            new_values = old_values + values_at(self._delta, rows, cols)
+            self._liked[min_rating] = (matrices, self._liked_changes(rows, cols, old_values, new_values, min_rating))
+        return self._liked[min_rating]
+
+    def liked_matrices(self, min_rating):
+        # (liked, binary, liked_t, binary_t): the ratings >= min_rating, their 1s, and both transposed,
+        # with the changes added (a copy once there are changes, see ratings)
+        (liked, binary, liked_t, binary_t), (liked_delta, binary_delta) = self.liked_parts(min_rating)
+        if liked_delta.nnz == 0 and binary_delta.nnz == 0:
+            return liked, binary, liked_t, binary_t
+        if min_rating not in self._merged:
+            liked, binary = liked + liked_delta, binary + binary_delta
+            self._merged[min_rating] = (liked, binary, liked.T.tocsr(), binary.T.tocsr())
+        return self._merged[min_rating]
+
+    def liked_rows(self, positions, min_rating):
+        # The ratings >= min_rating of the users at these rows (a small CSR matrix)
+        (liked, binary, liked_t, binary_t), (liked_delta, binary_delta) = self.liked_parts(min_rating)
+        return liked[positions] + liked_delta[positions]
+
+    def add_ratings(self, ratings):
+        # Add new ratings (a data frame like the ratings table) to the delta, without touching the base.
+        # A new rating for a (user, movie) pair that is already rated replaces the old one, like
+        # drop_duplicates(keep='last') in __init__. The liked changes and bitsets are patched with the
+        # same changes
+        ratings = ratings.drop_duplicates(subset=['user_id', 'movie_id'], keep='last')
+        if len(ratings) == 0:
+            return
+        user_ids = ratings['user_id'].to_numpy().astype(np.int64)
+        movie_ids = ratings['movie_id'].to_numpy().astype(np.int64)
+        new_values = ratings['rating'].to_numpy().astype(np.float64)
+
+        new_users = np.setdiff1d(user_ids, self.user_ids)
+        new_movies = np.setdiff1d(movie_ids, self.movie_ids)
+        if len(new_users) or len(new_movies):
+            self._add_positions(new_users, new_movies)
+
+        rows = np.searchsorted(self.user_ids, user_ids)
+        cols = np.searchsorted(self.movie_ids, movie_ids)
+        old_values = values_at(self._base, rows, cols) + values_at(self._delta, rows, cols)  # 0 = not rated before
+        self._delta = self._delta + self._changes(rows, cols, new_values - old_values)
+        self._merged = {}
+
+        for min_rating, (matrices, (liked_delta, binary_delta)) in list(self._liked.items()):
+            liked_changes, binary_changes = self._liked_changes(rows, cols, old_values, new_values, min_rating)
+            self._liked[min_rating] = (matrices, (liked_delta + liked_changes, binary_delta + binary_changes))
+
+            if min_rating in self._liked_bits:
+                bits = self._liked_bits[min_rating]
+                if not bits.flags.writeable:
+                    # Loaded from a file: the changes go into a copy
+                    bits = self._liked_bits[min_rating] = np.array(bits)
+                movies = cols.astype(np.uint64)
+                words = (movies >> np.uint64(6)).astype(np.int64)
+                masks = np.uint64(1) << (movies & np.uint64(63))
+                was_liked = old_values >= min_rating
+                now_liked = new_values >= min_rating
+                added = now_liked & ~was_liked
+                removed = was_liked & ~now_liked
+                np.bitwise_or.at(bits, (words[added], rows[added]), masks[added])
+                np.bitwise_and.at(bits, (words[removed], rows[removed]), ~masks[removed])
+
+    def merge_changes(self):
+        # Add the delta into the base (this copies the base into memory), e.g. after the new ratings
+        # have been written to the ratings file
+        if self._delta.nnz == 0:
+            return
+        liked = {min_rating: self.liked_matrices(min_rating) for min_rating in self._liked}
+        self._start(self.ratings, liked, self._liked_bits)
+
+    def _changes(self, rows, cols, values):
+        # Sparse matrix with the given changes; adding it to a matrix drops entries that become 0
+        return sparse.csr_matrix((values, (rows, cols)), shape=self.shape)
+
+    def _liked_changes(self, rows, cols, old_values, new_values, min_rating):
+        # Changes to the liked and binary matrices of min_rating when ratings go from old to new
+        was_liked = old_values >= min_rating
+        now_liked = new_values >= min_rating
+        return (self._changes(rows, cols, np.where(now_liked, new_values, 0) - np.where(was_liked, old_values, 0)),
+                self._changes(rows, cols, now_liked.astype(np.float64) - was_liked))
+
+    def _empty(self, shape):
+        return sparse.csr_matrix(shape, dtype=np.float64)
+
+    def _empty_liked_delta(self):
+        return self._empty(self.shape), self._empty(self.shape)
+
+    def _add_positions(self, new_users, new_movies):
+        # Make room for users / movies we haven't seen before. Positions are sorted by id, so ids
+        # bigger than every id so far (the usual case) get new rows / columns at the end and the base
+        # keeps its arrays. Any other new id moves existing rows or columns: then the changes are
+        # added into the base and the liked matrices and bitsets are built again when needed
+        if ((len(new_users) and len(self.user_ids) and new_users[0] < self.user_ids[-1]) or
+                (len(new_movies) and len(self.movie_ids) and new_movies[0] < self.movie_ids[-1])):
+            ratings = self.ratings.tocoo()
+            old_users, old_movies = self.user_ids, self.movie_ids
+            self.user_ids = np.union1d(old_users, new_users)
+            self.movie_ids = np.union1d(old_movies, new_movies)
+            base = sparse.csr_matrix(
+                (ratings.data, (np.searchsorted(self.user_ids, old_users)[ratings.row],
+                                np.searchsorted(self.movie_ids, old_movies)[ratings.col])),
+                shape=self.shape
+            )
+            base.sort_indices()
+            self._start(base, {}, {})
+            return
+
+        self.user_ids = np.concatenate([self.user_ids, new_users])
+        self.movie_ids = np.concatenate([self.movie_ids, new_movies])
+        shape = self.shape
+        self._base = grow_csr(self._base, shape)
+        self._delta = grow_csr(self._delta, shape)
+        self._merged = {}
+        for min_rating, ((liked, binary, liked_t, binary_t), changes) in list(self._liked.items()):
+            self._liked[min_rating] = (
+                (grow_csr(liked, shape), grow_csr(binary, shape),
+                 grow_csr(liked_t, shape[::-1]), grow_csr(binary_t, shape[::-1])),
+                tuple(grow_csr(matrix, shape) for matrix in changes)
+            )
+        for min_rating, bits in list(self._liked_bits.items()):
+            num_words = (shape[1] + 63) // 64
+            if bits.shape[0] < num_words or bits.shape[1] < shape[0]:
+                # Room for some more users and words, so not every new user copies the bitsets
+                grown = np.zeros((max(num_words + 4, bits.shape[0]), max(shape[0] + shape[0] // 8 + 64, bits.shape[1])),
+                                 dtype=np.uint64)
+                grown[:bits.shape[0], :bits.shape[1]] = bits
+                self._liked_bits[min_rating] = grown
+
+    def liked_bits(self, min_rating):
+        # Index of every user's liked movies (ratings >= min_rating) as a bitset: bit (movie % 64) of
+        # word (movie // 64) is set if the user liked that movie. Stored as (words x users), so the
+        # same word of all users is one contiguous row, which is what common_liked reads
+        if min_rating not in self._liked_bits:
+            binary = self.liked_matrices(min_rating)[1]
+            num_words = (binary.shape[1] + 63) // 64
+            bits = np.zeros((num_words, binary.shape[0]), dtype=np.uint64)
+            users = np.repeat(np.arange(binary.shape[0]), np.diff(binary.indptr))
+            movies = binary.indices.astype(np.uint64)
+            np.bitwise_or.at(bits, (movies >> np.uint64(6), users), np.uint64(1) << (movies & np.uint64(63)))
+            self._liked_bits[min_rating] = bits
+        # The array can have room for more users and words (see _add_positions)
+        return self._liked_bits[min_rating][:(self.shape[1] + 63) // 64, :self.shape[0]]
+
+    def common_liked(self, pos, min_rating):
+        # Number of liked movies every user has in common with the user at row pos: AND the bitsets
+        # and count the 1 bits. Only the words where this user has liked movies need to be read, so
+        # the cost depends on the number of users, not on how many ratings there are
+        bits = self.liked_bits(min_rating)
+        user_bits = bits[:, pos]
+        words = np.flatnonzero(user_bits)
+        return popcount(bits[words] & user_bits[words, None]).sum(axis=0, dtype=np.uint32)
+
+    def movie_stats(self, min_rating):
+        # Number and average of every movie's ratings >= min_rating
+        (liked, binary, liked_t, binary_t), (liked_delta, binary_delta) = self.liked_parts(min_rating)
+        counts = np.diff(liked_t.indptr) + np.asarray(binary_delta.sum(axis=0)).ravel().astype(np.int64)
+        sums = np.asarray(liked_t.sum(axis=1)).ravel() + np.asarray(liked_delta.sum(axis=0)).ravel()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            averages = sums / counts
+        return counts, averages
+
+    def score_movies_for_user(self, user_id, min_rating, movie_filter=None):
+        # Same scores as the pandas version: for every movie liked by a similar user,
+        # predicted_rating = mean(rating * similarity), rating_count and avg_rating of those ratings.
+        # movie_filter is an optional True/False array (one per movie position) of movies to allow.
+        # Returns arrays (movie_ids, predicted_rating, rating_count, avg_rating) of the candidate movies
+        empty = (np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0, dtype=np.int64), np.zeros(0))
+        pos = self.user_position(user_id)
+        if pos < 0:
+            return empty
+
+        (liked, binary, liked_t, binary_t), (liked_delta, binary_delta) = self.liked_parts(min_rating)
+        if binary_delta.indptr[pos] == binary_delta.indptr[pos + 1]:
+            liked_cols = binary.indices[binary.indptr[pos]:binary.indptr[pos + 1]]
+        else:
+            liked_cols = (binary[pos] + binary_delta[pos]).indices
+        if len(liked_cols) == 0:
+            return empty
+
+        # 1. Count common liked movies with every other user (bitset intersections, see liked_bits)
+        common = self.common_liked(pos, min_rating).astype(np.float64)
+        common[pos] = 0.0
+
+        similar = (common > 0).astype(np.float64)
+        if not similar.any():
+            return empty
+
+        # 2. Sum the ratings of similar users per movie. The weighted sum is kept in whole
+        # numbers (rating * common movies) and divided at the end, so equal scores stay equal
+        weighted_sum = liked_t @ common
+        rating_sum = liked_t @ similar
+        rating_count = binary_t @ similar
+        if liked_delta.nnz or binary_delta.nnz:
+            # Plus the changes since the base (liked_delta.T is a small CSC matrix, no copy)
+            weighted_sum += liked_delta.T @ common
+            rating_sum += liked_delta.T @ similar
+            rating_count += binary_delta.T @ similar
+
+        # 3. Keep movies liked by similar users that the user hasn't liked already
+        candidates = rating_count > 0
+        candidates[liked_cols] = False
+        if movie_filter is not None:
+            candidates &= movie_filter
+        counts = rating_count[candidates]
+
+        return (
+            self.movie_ids[candidates],
+            weighted_sum[candidates] / len(liked_cols) / counts,
+            counts.astype(np.int64),
+            rating_sum[candidates] / counts
+        )
+
+    def score_movies_for_users(self, user_ids, min_rating, movie_filter=None):
+        # Batch version of score_movies_for_user. Scores a group of users with matrix-matrix
+        # products and returns dense (users x movies) arrays; movies that aren't candidates
+        # for a user (not liked by similar users, or already liked) get a rating_count of 0.
+        # Memory is len(user_ids) x (users + 3 x movies) floats, so callers pass chunks
+        user_ids = np.asarray(user_ids)
+        (liked, binary, liked_t, binary_t), (liked_delta, binary_delta) = self.liked_parts(min_rating)
+
+        # Keep only users that have at least one liked movie
+        user_ids, positions = self.liked_user_positions(user_ids, min_rating)
+        user_liked = binary[positions] + binary_delta[positions]
+        liked_counts = np.diff(user_liked.indptr)
+
+        # 1. Common liked movies between each batch user and every user (not counting themselves),
+        # one bitset pass per batch user
+        common = np.zeros((len(positions), binary.shape[0]))
+        for row, pos in enumerate(positions):
+            common[row] = self.common_liked(pos, min_rating)
+        common[np.arange(len(positions)), positions] = 0.0
+        similar = (common > 0).astype(np.float64)
+
+        # 2. Per user and movie sums of the (weighted) ratings of their similar users
+        weighted_sum = (liked_t @ common.T).T
+        rating_sum = (liked_t @ similar.T).T
+        rating_count = (binary_t @ similar.T).T
+        if liked_delta.nnz or binary_delta.nnz:
+            weighted_sum += (liked_delta.T @ common.T).T
+            rating_sum += (liked_delta.T @ similar.T).T
+            rating_count += (binary_delta.T @ similar.T).T
+
+        # 3. Movies the user already liked (or filtered out) are not candidates
+        rating_count[user_liked.nonzero()] = 0.0
+        if movie_filter is not None:
+            rating_count[:, ~movie_filter] = 0.0
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            predicted_rating = weighted_sum / liked_counts[:, None] / rating_count
+            avg_rating = rating_sum / rating_count
+        return user_ids, predicted_rating, rating_count.astype(np.int64), avg_rating
+
+def values_at(matrix, rows, cols):
+    # matrix[rows[i], cols[i]] for every i, as a flat array
+    if len(rows) == 0:
+        return np.zeros(0)
+    return np.asarray(matrix[rows, cols]).ravel()
+
+def grow_csr(matrix, shape):
+    # The same CSR matrix with empty rows / columns added at the end, sharing the data arrays
+    indptr = matrix.indptr
+    if shape[0] > len(indptr) - 1:
+        indptr = np.concatenate([indptr, np.full(shape[0] + 1 - len(indptr), indptr[-1], dtype=indptr.dtype)])
+    return sparse.csr_matrix((matrix.data, matrix.indices, indptr), shape=shape, copy=False)
+
+def load_csr(directory, name, shape):
+    # A CSR matrix saved with csr_arrays, memory-mapped without copying
+    data, indices, indptr = (np.load(os.path.join(directory, f"{name}.{part}.npy"), mmap_mode='r')
+                             for part in ("data", "indices", "indptr"))
+    return sparse.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+
+def csr_arrays(name, matrix):
+    # The three arrays of a CSR matrix, named for RatingMatrix.save
+    return {f"{name}.data": matrix.data, f"{name}.indices": matrix.indices, f"{name}.indptr": matrix.indptr}
@@ -0,0 +1,113 @@
+# This file follows a ratings file that another program keeps adding lines to (same format as
+# data/ratings.csv: user_id, movie_id, rating, timestamp separated by tabs) and passes every new
+# line to dataset.append_ratings, so new ratings show up in recommendations while the app runs.
+# Start it from the app by setting RATINGS_STREAM_FILE, or run: python rating_stream.py <file>
+
+import io
+import os
+import threading
+import numpy as np
+import pandas as pd
+from dataset import TABLE_FILES
+
+def parse_ratings(data):
+    # The ratings in complete lines of a ratings file, and the number of bad lines left out: lines with
+    # missing or extra fields, values that aren't whole numbers and ratings that aren't 1 to 5 stars
+    file_name, separator, columns = TABLE_FILES['ratings']
+    num_lines = sum(1 for line in data.splitlines() if line.strip())
+    ratings = pd.read_csv(io.BytesIO(data), sep=separator, header=None, names=columns, dtype=str, encoding="latin1",
+                          on_bad_lines='skip')
+    ratings = ratings.apply(pd.to_numeric, errors='coerce')
+    valid = ratings.notna().all(axis=1) & (ratings % 1 == 0).all(axis=1) & ratings['rating'].isin(range(1, 6))
+    ratings = ratings[valid].astype(np.int64)
+    return ratings, num_lines - len(ratings)
+
+class RatingsFileTail:
+    def __init__(self, dataset, path, poll_interval=1.0, from_start=False):
+        self.dataset = dataset
+        self.path = path
+        self.poll_interval = poll_interval  # seconds between checks for new lines
+        self.offset = 0 if from_start or not os.path.exists(path) else os.path.getsize(path)
+        self.added = 0  # ratings passed on so far
+        self.skipped = 0  # bad lines left out so far
+        self._stop = threading.Event()
+        self._thread = None
+
+    def poll(self):
+        # Read the complete lines added since the last poll and append them. Returns the number added
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+        if size < self.offset:
+            # The file was truncated or replaced, start again from the beginning
+            self.offset = 0
+        if size == self.offset:
+            return 0
+
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read(size - self.offset)
+        # A line that is still being written (no newline yet) is read on the next poll
+        end = data.rfind(b"\n") + 1
+        if end == 0:
+            return 0
+        self.offset += end
+
+        new_ratings, skipped = parse_ratings(data[:end])
+        if skipped:
+            self.skipped += skipped
+            print(f"Skipped {skipped} bad line(s) in {self.path}")
+        added = self.dataset.append_ratings(new_ratings)
+        self.added += added
+        return added
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                # e.g. the file can't be read right now; tried again on the next poll
+                print("Couldn't read new ratings:", e)
+            self._stop.wait(self.poll_interval)
+
+    def start(self):
+        # Follow the file in a background thread
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run, name="ratings-tail", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+_started = None
+_start_lock = threading.Lock()
+
+def start_from_env(dataset):
+    # Start following the file in RATINGS_STREAM_FILE (once per process), if it is set
+    global _started
+    path = os.environ.get("RATINGS_STREAM_FILE")
+    if not path:
+        return None
+    with _start_lock:
+        if _started is None:
+            _started = RatingsFileTail(dataset, path, float(os.environ.get("RATINGS_STREAM_INTERVAL", 1.0))).start()
+        return _started
+
+if __name__ == "__main__":
+    import sys
+    import time
+    from dataset import dataset
+
+    tail = RatingsFileTail(dataset, sys.argv[1], from_start="--from-start" in sys.argv)
+    while True:
+        added = tail.poll()
+        if added:
+            written = dataset.compact_ratings()
+            print(f"Added {added:,} ratings ({written:,} written to {dataset.file_path('ratings')})")
+        time.sleep(tail.poll_interval)
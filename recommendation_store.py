@@ -0,0 +1,188 @@
+# This file keeps precomputed recommendations: an offline job works out every user's top 50 for a few
+# common settings (min_rating 3 / 4 / 5 with the default filters) and saves them in a SQLite file in
+# data/cache, one compact row per user and setting. recommend_movies_for_user answers from it when the
+# settings match, and works them out live otherwise.
+# Every run remembers which ratings it was made from: the signature of ratings.csv (modification time
+# and size) and how many ratings had been appended on top of it (see dataset.ratings_version). A run is
+# only used for the same ratings file with at most RECOMMENDATION_STORE_MAX_LAG more appended ratings
+# (default 0: only for exactly the same ratings)
+# Fill it with: python recommendation_store.py [--min-ratings 3,4,5] [--top-n 50]
+
+import os
+import threading
+import time
+import numpy as np
+import pandas as pd
+from db_pool import SQLitePool
+
+# One stored recommendation, packed into bytes (one payload per user holds all of them in order)
+RECORD_TYPE = np.dtype([('movie_id', '<i4'), ('predicted_rating', '<f8'), ('rating_count', '<i4'),
+                        ('avg_rating', '<f8')])
+
+def settings_key(min_rating, min_similar_ratings, genres, strategy):
+    # The settings of a run as one string, e.g. "user|4|10|" (genres sorted, empty = all)
+    return f"{strategy}|{min_rating}|{min_similar_ratings}|{','.join(sorted(genres or []))}"
+
+class RecommendationStore:
+    def __init__(self, db_path, max_lag=None):
+        self.db_path = db_path
+        self.max_lag = max_lag if max_lag is not None else int(os.environ.get("RECOMMENDATION_STORE_MAX_LAG", 0))
+        self.pool = None  # opened the first time the file exists
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _connection(self, create=False):
+        with self._lock:
+            if self.pool is None:
+                if not create and not os.path.exists(self.db_path):
+                    return None
+                os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+                self.pool = self._open()
+        return self.pool.connection()
+
+    def _open(self):
+        pool = SQLitePool(self.db_path)
+        with pool.connection() as conn:
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(runs)")]
+            if columns and 'ratings_size' not in columns:
+                # Made by an older version that only saved the number of ratings: those runs can't be
+                # checked, so they are dropped
+                conn.execute("DROP TABLE runs")
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS runs (
+                    settings TEXT PRIMARY KEY,
+                    top_n INTEGER NOT NULL,
+                    ratings_mtime REAL NOT NULL,
+                    ratings_size INTEGER NOT NULL,
+                    appended_ratings INTEGER NOT NULL,
+                    built_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS recommendations (
+                    settings TEXT NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    payload BLOB NOT NULL,
+                    PRIMARY KEY (settings, user_id)
+                ) WITHOUT ROWID
+            ''')
+        return pool
+
+    def lookup(self, user_id, min_rating, top_n, min_similar_ratings, genres, strategy, ratings_version, titles_for):
+        # The stored recommendations of a user as a data frame like recommend_movies_for_user's, or None
+        # if there is no run for these settings, it has fewer than top_n per user, or it was made from
+        # other ratings than ratings_version (see dataset.ratings_version). titles_for(movie_ids) adds
+        # the titles
+        connection = self._connection()
+        if connection is None:
+            return None
+        with connection as conn:
+            row = conn.execute('''
+                SELECT runs.top_n, runs.ratings_mtime, runs.ratings_size, runs.appended_ratings,
+                       recommendations.payload
+                FROM runs JOIN recommendations ON recommendations.settings = runs.settings
+                WHERE runs.settings = ? AND recommendations.user_id = ?
+            ''', (settings_key(min_rating, min_similar_ratings, genres, strategy), int(user_id))).fetchone()
+
+        if row is None:
+            self.misses += 1
+            return None
+        stored_top_n, stored_mtime, stored_size, stored_appended, payload = row
+        records = np.frombuffer(payload, dtype=RECORD_TYPE)
+        appended = ratings_version['appended']
+        too_old = (stored_mtime != ratings_version['mtime'] or stored_size != ratings_version['size'] or
+                   not (appended - self.max_lag <= stored_appended <= appended))
+        # A user with fewer than stored_top_n recommendations has all of them stored
+        if too_old or (top_n > stored_top_n and len(records) == stored_top_n):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        records = records[:top_n]
+        if len(records) == 0:
+            return pd.DataFrame()
+        return pd.DataFrame({
+            'movie_id': records['movie_id'].astype(np.int64),
+            'title': titles_for(records['movie_id']),
+            'predicted_rating': records['predicted_rating'],
+            'rating_count': records['rating_count'].astype(np.int64),
+            'avg_rating': records['avg_rating']
+        })
+
+    def write_run(self, chunks, user_ids, top_n, ratings_version, min_rating, min_similar_ratings=10, genres=None,
+                  strategy="user"):
+        # Save a run: chunks are tables like recommend_movies_for_users_in_chunks yields (every user's rows
+        # together, best first). Users of user_ids without recommendations are stored as empty, so they
+        # are answered from the store too. Replaces the previous run of the same settings in one
+        # transaction, so readers see either the old run or the new one. Returns the number of users
+        key = settings_key(min_rating, min_similar_ratings, genres, strategy)
+        empty_users = set(int(user_id) for user_id in user_ids)
+        with self._connection(create=True) as conn:
+            conn.execute("DELETE FROM recommendations WHERE settings = ?", (key,))
+            for chunk in chunks:
+                records = np.empty(len(chunk), dtype=RECORD_TYPE)
+                for column in RECORD_TYPE.names:
+                    records[column] = chunk[column].to_numpy()
+                chunk_users = chunk['user_id'].to_numpy()
+                starts = np.flatnonzero(np.append(True, chunk_users[1:] != chunk_users[:-1]))
+                ends = np.append(starts[1:], len(chunk_users))
+                conn.executemany(
+                    "INSERT INTO recommendations (settings, user_id, payload) VALUES (?, ?, ?)",
+                    ((key, int(chunk_users[start]), records[start:end].tobytes()) for start, end in zip(starts, ends))
+                )
+                empty_users.difference_update(chunk_users[starts].tolist())
+            conn.executemany(
+                "INSERT INTO recommendations (settings, user_id, payload) VALUES (?, ?, ?)",
+                ((key, user_id, b"") for user_id in sorted(empty_users))
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO runs (settings, top_n, ratings_mtime, ratings_size, appended_ratings, built_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, top_n, ratings_version['mtime'], ratings_version['size'], ratings_version['appended'], time.time())
+            )
+        return len(user_ids)
+
+    def runs(self):
+        # One row per saved run: settings, top_n, ratings_mtime, ratings_size, appended_ratings, built_at
+        connection = self._connection()
+        if connection is None:
+            return []
+        with connection as conn:
+            return conn.execute("SELECT settings, top_n, ratings_mtime, ratings_size, appended_ratings, built_at "
+                                "FROM runs ORDER BY settings").fetchall()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+def store_path(data_dir):
+    return os.path.join(data_dir, "cache", "recommendations.db")
+
+def materialize(dataset, min_ratings=(3, 4, 5), top_n=50, min_similar_ratings=10, strategy="user", chunk_size=500):
+    # The offline job: work out every user's top_n for each min_rating and save them in the store
+    from recommender import get_recommendation_store, get_rating_matrix, recommend_movies_for_users_in_chunks
+
+    store = get_recommendation_store()
+    ratings_version = dataset.ratings_version()  # before scoring, so the run never claims newer data than it used
+    user_ids = get_rating_matrix().user_ids
+    for min_rating in min_ratings:
+        start = time.perf_counter()
+        chunks = recommend_movies_for_users_in_chunks(user_ids, min_rating, top_n, min_similar_ratings, chunk_size,
+                                                      strategy=strategy)
+        store.write_run(chunks, user_ids, top_n, ratings_version, min_rating, min_similar_ratings, strategy=strategy)
+        print(f"min_rating={min_rating}: stored the top {top_n} of {len(user_ids):,} users "
+              f"in {time.perf_counter() - start:.1f} s")
+    return store
+
+if __name__ == "__main__":
+    import argparse
+    from dataset import dataset
+
+    parser = argparse.ArgumentParser(description="Precompute every user's recommendations for common settings")
+    parser.add_argument("--min-ratings", default="3,4,5", help="comma separated min_rating values")
+    parser.add_argument("--top-n", type=int, default=50, help="recommendations kept per user")
+    parser.add_argument("--strategy", default="user", choices=["user", "item", "mf"])
+    args = parser.parse_args()
+
+    materialize(dataset, [int(value) for value in args.min_ratings.split(",")], args.top_n, strategy=args.strategy)
+    print(f"Saved to {store_path(dataset.data_dir)}")
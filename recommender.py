@@ -1,23 +1,316 @@
 # This file contains the movie recommendation logic. It uses collaborative filtering to find users with similar prefrences and recommends movies they liked
 
+import numpy as np
 import pandas as pd
+from dataset import dataset
+import ann_index
+import item_similarity
+import matrix_factorization
+import metrics
+import rating_loader
+from movie_catalog import genre_mask, get_movie_catalog
+from popularity import PopularityRanking
+from recommendation_store import RecommendationStore, store_path
+from result_cache import RecommendationCache
+from topk import top_k, top_k_per_row
 
-# Load the movie data files
-ratings_data = pd.read_csv("data/ratings.csv", sep="\t", header=None, encoding="latin1")
-movies_data = pd.read_csv("data/movies.csv", sep="|", header=None, encoding="latin1")
-users_data = pd.read_csv("data/users.csv", sep="|", header=None, encoding="latin1")
+# The data files are loaded once per process by the shared dataset object
+# (the same tables app.py uses), and reloaded when the files change
 
-# Name the columns 
-ratings_data.columns = ["user_id", "movie_id", "rating", "timestamp"]
-movies_data.columns = ["movie_id", "title", "release_date", "video_release_date", "imdb_url"] + [f"genre_{i}" for i in range(19)]
-users_data.columns = ["user_id", "age", "gender", "occupation", "zip_code"]
+# Recent results, shared by all sessions. Entries from an older data version are never returned
+recommendation_cache = RecommendationCache(max_size=1024)
 
-# Remove columns that are not needed
-movies_data = movies_data.drop(['release_date', 'video_release_date'], axis=1, errors='ignore')
+def get_rating_matrix():
+    # Sparse user x movie matrix, loaded once per data version and shared by every recommendation. It is
+    # built from the ratings file a chunk at a time and memory-mapped from data/cache (see rating_loader.py).
+    # Ratings added with dataset.append_ratings go into a small delta on top of it instead of building it
+    # again, and the delta is added into the matrix when they are written to ratings.csv
+    return dataset.derived('rating_matrix', rating_loader.load_or_build_rating_matrix, update=update_rating_matrix,
+                           compact=lambda matrix: matrix.merge_changes())
 
-def recommend_movies_for_user(user_id, min_rating=4, top_n=5, min_similar_ratings=10):
+def update_rating_matrix(matrix, new_ratings):
+    matrix.add_ratings(new_ratings)
+    return matrix
+
+def keep_while_no_new_movies(thing, num_movies):
+    # Things with one entry per movie of the rating matrix stay valid until new movies get rated
+    # (movies are only ever added, so comparing the number is enough)
+    return thing if num_movies == len(get_rating_matrix().movie_ids) else None
+
+def get_item_similarity():
+    # Item-item neighbour lists, loaded from data/cache (or built and saved there) once per data version.
+    # New ratings don't change the neighbour lists (they are rebuilt offline), so they are kept
+    # as long as there are no new movies
+    return dataset.derived(
+        'item_similarity', lambda data: item_similarity.load_or_build(data, get_rating_matrix()),
+        update=lambda model, new_ratings: keep_while_no_new_movies(model, len(model.movie_ids))
+    )
+
+def get_factor_model():
+    # User and movie factors (see matrix_factorization.py), loaded from data/cache (or trained and saved
+    # there) once per data version. Users who rate their first movies later get their factors worked
+    # out from their ratings when they ask, so the model is kept when ratings arrive
+    return dataset.derived(
+        'factor_model', lambda data: matrix_factorization.load_or_train(data, get_rating_matrix()),
+        update=lambda model, new_ratings: model
+    )
+
+def get_neighbor_index(kind):
+    # Approximate nearest neighbour index over the user ("users") or movie ("movies") factors, loaded
+    # from data/cache (or built and saved there) once per data version. Kept when ratings arrive, like
+    # the factors it is built from
+    return dataset.derived(
+        f'ann_{kind}', lambda data: ann_index.load_or_build(data, get_factor_model(), kind),
+        update=lambda index, new_ratings: index
+    )
+
+def find_similar_movies(movie_id, top_n=10, nprobe=16):
+    # Movies most like this one (cosine similarity of their factors), found with the nearest neighbour
+    # index. A higher nprobe finds more of the true most similar movies but takes longer
+    model = get_factor_model()
+    row = np.searchsorted(model.movie_ids, movie_id)
+    if row >= len(model.movie_ids) or model.movie_ids[row] != movie_id:
+        return pd.DataFrame()
+    movie_ids, similarity = get_neighbor_index("movies").search(model.item_factors[row], top_n, nprobe,
+                                                                exclude=[movie_id])
+    return pd.DataFrame({'movie_id': movie_ids, 'title': get_movie_catalog().titles_for(movie_ids),
+                         'similarity': similarity})
+
+def find_similar_users(user_id, top_n=10, nprobe=16):
+    # Users with the most similar taste (cosine similarity of their factors), found with the index
+    with dataset.reading():
+        model = get_factor_model()
+        rating_matrix = get_rating_matrix()
+        pos = rating_matrix.user_position(user_id)
+        if pos < 0:
+            return pd.DataFrame()
+        user_vector = model.user_vectors(rating_matrix, [pos])[0]
+    user_ids, similarity = get_neighbor_index("users").search(user_vector, top_n, nprobe, exclude=[user_id])
+    return pd.DataFrame({'user_id': user_ids, 'similarity': similarity})
+
+def score_movies(strategy, user_id, min_rating, movie_filter):
+    # Scores from the chosen engine: "user" (similar users), "item" (similar movies) or "mf" (factors)
+    if strategy == "user":
+        return get_rating_matrix().score_movies_for_user(user_id, min_rating, movie_filter)
+    if strategy == "item":
+        return get_item_similarity().score_movies_for_user(get_rating_matrix(), user_id, min_rating, movie_filter)
+    if strategy == "mf":
+        return get_factor_model().score_movies_for_user(get_rating_matrix(), user_id, min_rating, movie_filter)
+    raise ValueError(f"Unknown recommendation strategy: {strategy}")
+
+def score_movies_in_batch(strategy, user_ids, min_rating, movie_filter):
+    # Batch version of score_movies
+    if strategy == "user":
+        return get_rating_matrix().score_movies_for_users(user_ids, min_rating, movie_filter)
+    if strategy == "item":
+        return get_item_similarity().score_movies_for_users(get_rating_matrix(), user_ids, min_rating, movie_filter)
+    if strategy == "mf":
+        return get_factor_model().score_movies_for_users(get_rating_matrix(), user_ids, min_rating, movie_filter)
+    raise ValueError(f"Unknown recommendation strategy: {strategy}")
+
+def get_recommendation_store():
+    # Precomputed top N lists for common settings (see recommendation_store.py), one per data folder.
+    # The store checks itself whether a run is new enough, so it is kept when ratings arrive
+    return dataset.derived(
+        'recommendation_store', lambda data: RecommendationStore(store_path(data.data_dir)),
+        update=lambda store, new_ratings: store
+    )
+
+def get_rating_aggregates():
+    # Rating counts per movie and user (see rating_loader.py), for the dataset stats and the popularity
+    # ranking, counted once per data version without loading the whole ratings table
+    return dataset.derived('rating_aggregates', rating_loader.load_or_build_aggregates, update=update_aggregates)
+
+def update_aggregates(aggregates, new_ratings):
+    aggregates.add_ratings(new_ratings['user_id'], new_ratings['movie_id'], new_ratings['rating'])
+    return aggregates
+
+def get_popularity_ranking():
+    # Most popular movies for every minimum rating, built once per data version from the rating counts
+    return dataset.derived(
+        'popularity_ranking',
+        lambda data: PopularityRanking.from_counts(get_rating_aggregates().movie_ids,
+                                                   get_rating_aggregates().movie_rating_counts),
+        update=update_popularity
+    )
+
+def update_popularity(ranking, new_ratings):
+    ranking.add_ratings(new_ratings['movie_id'].to_numpy(), new_ratings['rating'].to_numpy())
+    return ranking
+
+def get_genre_filter(genres):
+    # True/False for every movie of the rating matrix: does it have any of the genres?
+    # Built once per genre combination, None means no genre filter
+    if not genres:
+        return None
+    mask = genre_mask(genres)
+    return dataset.derived(
+        f'genre_filter_{mask}',
+        lambda data: get_movie_catalog().has_any_genre(get_rating_matrix().movie_ids, mask),
+        update=lambda movie_filter, new_ratings: keep_while_no_new_movies(movie_filter, len(movie_filter)),
+        label='genre_filter'
+    )
+
+def recommend_popular_movies(min_rating=4, top_n=5, genres=None):
+    # Movies with the best average rating (ratings >= min_rating, at least 10 of them),
+    # used when no user is picked. genres is an optional list of genre names to pick from
+    with metrics.trace("popular", min_rating=min_rating, top_n=top_n, genres=genres):
+        catalog = get_movie_catalog()
+        keep = None
+        if genres:
+            mask = genre_mask(genres)
+            keep = lambda movie_ids: catalog.has_any_genre(movie_ids, mask)
+
+        with metrics.span("popular.rank"), dataset.reading():
+            movie_ids, avg_ratings, rating_counts = get_popularity_ranking().top_movies(min_rating, top_n, keep)
+        with metrics.span("popular.titles"):
+            return pd.DataFrame({
+                'movie_id': movie_ids,
+                'title': catalog.titles_for(movie_ids),
+                'predicted_rating': avg_ratings,
+                'rating_count': rating_counts
+            })
+
+def recommend_movies_for_user(user_id, min_rating=4, top_n=5, min_similar_ratings=10, genres=None, strategy="user"):
+    # strategy picks the engine: "user" finds users with similar taste (the original method),
+    # "item" uses the precomputed lists of similar movies (see item_similarity.py) and
+    # "mf" the learned user and movie factors (see matrix_factorization.py)
+
+    with metrics.trace("recommend", user_id=user_id, min_rating=min_rating, top_n=top_n,
+                       genres=genres, strategy=strategy):
+        try:
+            # Answer from the cache if this query (or the same query with a bigger top_n) was seen before
+            key = (user_id, min_rating, min_similar_ratings, tuple(sorted(genres or [])), strategy)
+            with metrics.span("recommend.cache_lookup"):
+                cached = recommendation_cache.get(key, top_n, dataset.version)
+            if cached is not None:
+                return cached
+
+            # Then from the precomputed lists, if they were made for these settings and recent enough ratings
+            with metrics.span("recommend.store_lookup"):
+                final_recommendations = get_recommendation_store().lookup(
+                    user_id, min_rating, top_n, min_similar_ratings, genres, strategy, dataset.ratings_version(),
+                    get_movie_catalog().titles_for
+                )
+            if final_recommendations is None:
+                final_recommendations = find_recommendations_for_user(
+                    user_id, min_rating, top_n, min_similar_ratings, genres, strategy
+                )
+            with metrics.span("recommend.cache_store"):
+                recommendation_cache.put(key, top_n, dataset.version, final_recommendations)
+            return final_recommendations
+
+        except Exception as e:
+            print("Error:", e)
+            metrics.record_error("recommend", e)
+            return pd.DataFrame()
+
+def find_recommendations_for_user(user_id, min_rating, top_n, min_similar_ratings, genres, strategy="user"):
+    # 1-6. Score the candidate movies with sparse matrix products
+    # (movies outside the picked genres are left out before sorting). New ratings wait until the
+    # scores are worked out, so the matrices and the filter all have the same users and movies
+    with dataset.reading():
+        with metrics.span("recommend.genre_filter"):
+            movie_filter = get_genre_filter(genres)
+        with metrics.span("recommend.score", strategy=strategy):
+            movie_ids, predicted_rating, rating_count, avg_rating = score_movies(
+                strategy, user_id, min_rating, movie_filter
+            )
+
+    # Only recommend movies that have enough ratings for reliability
+    enough_ratings = rating_count >= min_similar_ratings
+    movie_ids, predicted_rating = movie_ids[enough_ratings], predicted_rating[enough_ratings]
+    rating_count, avg_rating = rating_count[enough_ratings], avg_rating[enough_ratings]
+
+    # Pick the top N movies by predicted rating
+    with metrics.span("recommend.top_k"):
+        best = top_k(predicted_rating, movie_ids, top_n)
+    if len(best) == 0:
+        return pd.DataFrame()
+
+    # 7. Add movie titles to the recommendations
+    with metrics.span("recommend.titles"):
+        final_recommendations = pd.DataFrame({
+            'movie_id': movie_ids[best],
+            'title': get_movie_catalog().titles_for(movie_ids[best]),
+            'predicted_rating': predicted_rating[best],
+            'rating_count': rating_count[best],
+            'avg_rating': avg_rating[best]
+        })
+
+    return final_recommendations
+
+def recommend_movies_for_users_in_chunks(user_ids, min_rating=4, top_n=5, min_similar_ratings=10, chunk_size=500,
+                                         genres=None, strategy="user"):
+    # Score users chunk_size at a time and yield one long table per chunk,
+    # so memory stays bounded however many users there are
+    user_ids = np.asarray(list(user_ids))
+    catalog = get_movie_catalog()
+
+    for start in range(0, len(user_ids), chunk_size):
+        # New ratings can arrive between chunks (not while one is scored, see find_recommendations_for_user)
+        with dataset.reading():
+            movie_filter = get_genre_filter(genres)
+            scores = score_movies_in_batch(strategy, user_ids[start:start + chunk_size], min_rating, movie_filter)
+            movie_ids = get_rating_matrix().movie_ids
+        top_recommendations = top_recommendations_for_chunk(movie_ids, scores, top_n, min_similar_ratings)
+        if top_recommendations is None:
+            continue
+
+        # Add movie titles to the recommendations
+        top_recommendations.insert(2, 'title', catalog.titles_for(top_recommendations['movie_id']))
+        yield top_recommendations
+
+def top_recommendations_for_chunk(movie_ids, scores, top_n, min_similar_ratings):
+    # Every user's top N movies out of the dense (users x movies) arrays of score_movies_in_batch, as one
+    # long table without titles (None if nobody got a recommendation). Also used by parallel_recommender.py
+    chunk_users, predicted_rating, rating_count, avg_rating = scores
+
+    # Only recommend movies that have enough ratings for reliability
+    enough_ratings = rating_count >= max(min_similar_ratings, 1)
+
+    # Pick every user's top N movies by predicted rating
+    ranked = np.where(enough_ratings, predicted_rating, -np.inf)
+    top_columns = top_k_per_row(ranked, top_n)
+    rows = np.repeat(np.arange(len(chunk_users)), top_columns.shape[1])
+    cols = top_columns.ravel()
+    keep = enough_ratings[rows, cols]
+    rows, cols = rows[keep], cols[keep]
+    if len(rows) == 0:
+        return None
+
+    return pd.DataFrame({
+        'user_id': chunk_users[rows],
+        'movie_id': movie_ids[cols],
+        'predicted_rating': predicted_rating[rows, cols],
+        'rating_count': rating_count[rows, cols],
+        'avg_rating': avg_rating[rows, cols]
+    })
+
+def recommend_movies_for_users(user_ids, min_rating=4, top_n=5, min_similar_ratings=10, chunk_size=500, genres=None,
+                               strategy="user"):
+    # Recommend movies for many users at once, e.g. for a nightly job that precomputes everyone's top N.
+    # Returns one long table with a row per (user_id, movie_id) recommendation
 
     try:
+        chunks = list(recommend_movies_for_users_in_chunks(
+            user_ids, min_rating, top_n, min_similar_ratings, chunk_size, genres, strategy
+        ))
+        if not chunks:
+            return pd.DataFrame()
+        return pd.concat(chunks, ignore_index=True)
+
+    except Exception as e:
+        print("Error:", e)
+        return pd.DataFrame()
+
+def recommend_movies_with_pandas(user_id, min_rating=4, top_n=5, min_similar_ratings=10):
+    # Original pandas version, kept as the reference for checking and benchmarking the sparse version
+
+    try:
+        ratings_data = dataset.ratings
+        movies_data = dataset.movies
+
         # 1. Find highly rated movies by current user
         user_ratings = ratings_data[ratings_data['user_id'] == user_id]
         liked_movies = user_ratings[user_ratings['rating'] >= min_rating]['movie_id']
@@ -0,0 +1,53 @@
+# This file has a small in-memory cache for recommendation results, so the same query
+# (same user and filters) isn't worked out again on every Streamlit rerun
+
+import threading
+import time
+from collections import OrderedDict
+
+class RecommendationCache:
+    def __init__(self, max_size=1024, ttl=None):
+        self.max_size = max_size  # most results kept, the least recently used one is dropped first
+        self.ttl = ttl  # seconds a result stays valid (None = until the data changes)
+        self._entries = OrderedDict()  # key -> (data version, top_n, time stored, result)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, top_n, data_version):
+        # Return a copy of the cached result for key, or None. A result computed for a bigger
+        # top_n (or one that ran out of movies before reaching its top_n) is sliced to top_n
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                version, cached_top_n, stored_at, result = entry
+                expired = self.ttl is not None and time.monotonic() - stored_at > self.ttl
+                if version != data_version or expired:
+                    del self._entries[key]
+                elif top_n <= cached_top_n or len(result) < cached_top_n:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return result.head(top_n).copy()
+            self.misses += 1
+            return None
+
+    def put(self, key, top_n, data_version, result):
+        # Store a copy of the result (callers are free to change the one they got)
+        with self._lock:
+            old = self._entries.get(key)
+            if old is not None and old[0] == data_version and old[1] > top_n:
+                return  # keep the bigger result, it can answer this top_n too
+            self._entries[key] = (data_version, top_n, time.monotonic(), result.copy())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
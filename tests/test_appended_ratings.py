@@ -0,0 +1,140 @@
+# Checks the ratings added while the app runs: appended, written to ratings.csv (compact_ratings) and
+# read from a file another program adds lines to (rating_stream.py)
+import os
+import shutil
+import threading
+import numpy as np
+import pandas as pd
+import pytest
+import rating_loader
+from dataset import TABLE_FILES, MovieDataset, ReadWriteLock
+from rating_matrix import RatingMatrix
+from rating_stream import RatingsFileTail
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+@pytest.fixture
+def data_dir(tmp_path):
+    # A copy of the bundled data, so the tests can add to ratings.csv
+    for file_name, separator, columns in TABLE_FILES.values():
+        shutil.copy(os.path.join(DATA_DIR, file_name), tmp_path)
+    return str(tmp_path)
+
+def file_ratings(data_dir):
+    return len(MovieDataset(data_dir, use_cache=False).ratings)
+
+def test_append_then_compact_before_the_table_is_loaded(data_dir):
+    on_disk = file_ratings(data_dir)
+    data = MovieDataset(data_dir, compact_after=None)
+    assert data.append_ratings([(1, 2, 5), (2, 3, 4)]) == 2
+    assert data.compact_ratings() == 2
+    assert file_ratings(data_dir) == on_disk + 2
+    # Read twice: the rows are in the file now, so they must not be added again
+    assert len(data.ratings) == on_disk + 2
+    assert len(data.ratings) == on_disk + 2
+    assert data.num_ratings() == on_disk + 2
+
+def test_append_then_compact_with_the_table_loaded(data_dir):
+    on_disk = file_ratings(data_dir)
+    data = MovieDataset(data_dir, compact_after=None)
+    data.ratings
+    data.append_ratings([(1, 2, 5), (2, 3, 4)])
+    assert data.num_ratings() == on_disk + 2
+    data.compact_ratings()
+    assert len(data.ratings) == on_disk + 2
+    data.reload()
+    assert len(data.ratings) == on_disk + 2
+    assert data.unsaved_ratings() is None
+
+def assert_same_matrix(found, expected, user_ids):
+    assert np.array_equal(found.user_ids, expected.user_ids)
+    assert np.array_equal(found.movie_ids, expected.movie_ids)
+    assert (found.ratings != expected.ratings).nnz == 0
+    for min_rating in (3, 4):
+        for found_part, expected_part in zip(found.liked_matrices(min_rating), expected.liked_matrices(min_rating)):
+            assert (found_part != expected_part).nnz == 0
+        assert np.array_equal(found.liked_bits(min_rating), expected.liked_bits(min_rating))
+        for user_id in user_ids:
+            for found_scores, expected_scores in zip(found.score_movies_for_user(user_id, min_rating),
+                                                     expected.score_movies_for_user(user_id, min_rating)):
+                assert np.allclose(found_scores, expected_scores)
+
+def test_new_users_and_movies_match_a_fresh_matrix(data_dir):
+    data = MovieDataset(data_dir, compact_after=None)
+    matrix = data.derived('rating_matrix', rating_loader.load_or_build_rating_matrix,
+                          update=lambda matrix, new_ratings: matrix.add_ratings(new_ratings) or matrix,
+                          compact=lambda matrix: matrix.merge_changes())
+    file_table = data.ratings.copy()
+    # Changed ratings, new users and movies after every id so far, then ids in between the old ones
+    new_batches = [
+        [(1, 1, 1), (1, 2, 5), (2, 1, 4)],
+        [(5000, 1, 5), (5000, 50, 4), (5001, 1, 4), (1, 5000, 5), (5000, 5000, 4), (2, 5001, 3)],
+        [(950, 1, 5), (950, 1690, 4), (3, 1690, 5)],
+    ]
+    user_ids = [1, 2, 3, 5000, 950]
+    for batch in new_batches:
+        data.append_ratings(batch)
+        matrix = data.derived('rating_matrix', None)
+        all_ratings = pd.concat([file_table, data.unsaved_ratings()], ignore_index=True)
+        assert_same_matrix(matrix, RatingMatrix(all_ratings), user_ids)
+
+    # Written to ratings.csv: the changes are merged into the base, and a new process gets the same
+    data.compact_ratings()
+    assert_same_matrix(data.derived('rating_matrix', None), RatingMatrix(all_ratings), user_ids)
+    assert_same_matrix(rating_loader.load_or_build_rating_matrix(MovieDataset(data_dir)), RatingMatrix(all_ratings),
+                       user_ids)
+
+def test_bad_lines_in_a_streamed_batch_are_skipped(data_dir, tmp_path):
+    data = MovieDataset(data_dir, compact_after=None)
+    stream_path = os.path.join(tmp_path, "new_ratings.csv")
+    open(stream_path, "w").close()
+    tail = RatingsFileTail(data, stream_path)
+    with open(stream_path, "a") as f:
+        f.write("1\t5\t4\t100\n2\t7\t3\t101\n3\t9\t7\t102\nx\t1\t4\t103\n4\t1\t4.5\t104\n5\t2")
+    assert tail.poll() == 2
+    assert tail.skipped == 3
+    assert data.unsaved_ratings()[['user_id', 'movie_id', 'rating']].values.tolist() == [[1, 5, 4], [2, 7, 3]]
+    # The unfinished last line is read once it is complete
+    with open(stream_path, "a") as f:
+        f.write("\t5\t105\n")
+    assert tail.poll() == 1
+    assert tail.poll() == 0
+    assert data.num_ratings() == file_ratings(data_dir) + 3
+
+def test_ratings_are_appended_between_reads(data_dir):
+    # append_ratings waits for a reader (e.g. a recommendation being scored) to finish
+    data = MovieDataset(data_dir, compact_after=None)
+    data.ratings
+    appended = threading.Event()
+    with data.reading():
+        with data.reading():  # nested reads don't wait
+            thread = threading.Thread(target=lambda: data.append_ratings([(1, 2, 5)]) and appended.set())
+            thread.start()
+            assert not appended.wait(0.2)
+    thread.join()
+    assert appended.is_set() and data.unsaved_ratings() is not None
+
+def test_waiting_writer_goes_before_new_readers():
+    lock = ReadWriteLock()
+    order = []
+
+    def write():
+        with lock.writing():
+            order.append("write")
+
+    def read():
+        with lock.reading():
+            order.append("read")
+
+    with lock.reading():
+        writer = threading.Thread(target=write)
+        writer.start()
+        while not lock._writers_waiting:
+            pass
+        reader = threading.Thread(target=read)
+        reader.start()
+        reader.join(0.2)
+        assert order == []
+    writer.join()
+    reader.join()
+    assert order == ["write", "read"]
@@ -0,0 +1,48 @@
+# Checks that the password hasher keeps working when one of its worker processes dies
+import time
+import bcrypt
+from password_hasher import PasswordHasher
+
+def kill_workers(hasher):
+    for process in list(hasher._pool._processes.values()):
+        process.kill()
+        process.join()
+
+def test_replaces_pool_after_a_worker_was_killed():
+    hasher = PasswordHasher(rounds=4, max_workers=1)
+    try:
+        stored_hash = hasher.hash_password("secret")
+        broken_pool = hasher._pool
+        kill_workers(hasher)
+        # Give the pool time to notice that its worker is gone
+        time.sleep(0.5)
+        assert hasher.check_password("secret", stored_hash)
+        assert not hasher.check_password("wrong", stored_hash)
+        assert hasher._pool is not broken_pool
+    finally:
+        hasher.shutdown()
+
+def test_job_survives_its_worker_being_killed():
+    hasher = PasswordHasher(rounds=4, max_workers=1)
+    try:
+        hasher.hash_password("start the pool")
+        # A slow hash, so the worker is killed while it is working on it
+        hasher.rounds = 14
+        future = hasher.hash_password_async("secret")
+        time.sleep(0.3)
+        assert not future.done()
+        kill_workers(hasher)
+        stored_hash = future.result(timeout=60)
+        assert bcrypt.checkpw(b"secret", stored_hash)
+    finally:
+        hasher.shutdown()
+
+def test_queue_places_are_given_back():
+    hasher = PasswordHasher(rounds=4, max_workers=1, max_queued=0, queue_wait=0.1)
+    try:
+        hasher.hash_password("start the pool")
+        kill_workers(hasher)
+        for _ in range(3):
+            hasher.hash_password("secret")
+    finally:
+        hasher.shutdown()
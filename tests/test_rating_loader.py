@@ -0,0 +1,63 @@
+# Checks that the liked matrices of every "Minimum Rating" a user can pick are the same whether they were
+# built with the streamed rating matrix, built later from its files, or built in memory
+import os
+import numpy as np
+import pandas as pd
+import rating_loader
+from rating_matrix import RatingMatrix
+
+def same(a, b):
+    return (a.shape == b.shape and np.array_equal(a.indptr, b.indptr) and np.array_equal(a.indices, b.indices)
+            and np.array_equal(a.data, b.data))
+
+def random_ratings(seed, num_ratings, first_user=1):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'user_id': rng.integers(first_user, first_user + 60, num_ratings),
+                         'movie_id': rng.integers(1, 80, num_ratings), 'rating': rng.integers(1, 6, num_ratings),
+                         'timestamp': np.zeros(num_ratings, dtype=np.int64)})
+
+def test_liked_matrices_of_every_threshold(tmp_path):
+    ratings = random_ratings(0, 2000)
+    source_path = os.path.join(tmp_path, "ratings.csv")
+    ratings.to_csv(source_path, sep="\t", header=False, index=False)
+    directory = os.path.join(tmp_path, "rating_matrix")
+    streamed = rating_loader.build_rating_matrix(directory, ratings, source_path, chunk_size=97, liked_min_ratings=[4])
+    streamed.liked_source = lambda min_rating: rating_loader.load_or_build_liked(directory, min_rating, 97)
+    in_memory = RatingMatrix(ratings)
+
+    # New ratings: changed ones, and new users and movies (which go at the end)
+    new_ratings = pd.concat([ratings.sample(50, random_state=1).assign(rating=lambda df: df['rating'] % 5 + 1),
+                             random_ratings(2, 30, first_user=100)], ignore_index=True)
+    streamed.add_ratings(new_ratings)
+    in_memory.add_ratings(new_ratings)
+    for min_rating in range(1, 6):
+        for found, expected in zip(streamed.liked_matrices(min_rating), in_memory.liked_matrices(min_rating)):
+            assert same(found, expected)
+        assert os.path.exists(os.path.join(directory, f"liked_{min_rating}", "meta.json")) == (min_rating != 4)
+
+    # Another process maps the files that were built by the first one
+    loaded = RatingMatrix.load(directory)
+    loaded.liked_source = lambda min_rating: rating_loader.load_or_build_liked(directory, min_rating, 97)
+    for min_rating in range(1, 6):
+        for found, expected in zip(loaded.liked_matrices(min_rating), RatingMatrix(ratings).liked_matrices(min_rating)):
+            assert same(found, expected)
+            assert not found.data.flags.writeable  # mapped read-only from the files, not copied
+
+def test_a_failed_cleanup_keeps_the_new_matrix(tmp_path, monkeypatch):
+    from dataset import MovieDataset
+    ratings = random_ratings(3, 500)
+    ratings.to_csv(os.path.join(tmp_path, "ratings.csv"), sep="\t", header=False, index=False)
+    old_files = os.path.join(rating_loader.matrices_dir_for(str(tmp_path)), "old_layout.npy")
+    os.makedirs(os.path.dirname(old_files))
+    open(old_files, "w").close()
+
+    def remove(path):
+        raise PermissionError(f"can't delete {path}")
+
+    data = MovieDataset(str(tmp_path))
+    rating_loader.cached_ratings(data)
+    monkeypatch.setattr(os, "remove", remove)
+    matrix = rating_loader.load_or_build_rating_matrix(data)
+    assert not matrix.ratings.data.flags.writeable  # mapped from the saved files, not built in memory
+    assert same(matrix.ratings, RatingMatrix(ratings).ratings)
+    assert os.path.exists(old_files)
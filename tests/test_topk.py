@@ -0,0 +1,41 @@
+# Checks that the chunked top K (StreamingTopK) picks the same items, in the same order, as top_k
+import numpy as np
+from topk import StreamingTopK, top_k
+
+def streamed(scores, ids, k, chunk_size):
+    best = StreamingTopK(k)
+    for start in range(0, len(scores), chunk_size):
+        best.push(scores[start:start + chunk_size], ids[start:start + chunk_size])
+    return best.result()
+
+def test_matches_top_k():
+    rng = np.random.default_rng(0)
+    scores = rng.random(1000)
+    ids = rng.permutation(5000)[:1000]
+    for k in (1, 10, 999, 1000, 2000):
+        for chunk_size in (1, 7, 100, 1000):
+            expected = top_k(scores, ids, k)
+            found_ids, found_scores = streamed(scores, ids, k, chunk_size)
+            assert np.array_equal(found_ids, ids[expected])
+            assert np.array_equal(found_scores, scores[expected])
+
+def test_ties_are_ordered_by_id():
+    # Few distinct scores, so most of the top k are ties, and the ids arrive in no particular order
+    rng = np.random.default_rng(1)
+    scores = rng.integers(0, 4, 500).astype(np.float32)
+    ids = rng.permutation(500)
+    for k in (5, 50, 200):
+        for chunk_size in (3, 64, 500):
+            found_ids, found_scores = streamed(scores, ids, k, chunk_size)
+            assert np.array_equal(found_ids, ids[top_k(scores, ids, k)])
+            # Highest score first, equal scores by lower id
+            assert all((a, -i) > (b, -j) for a, i, b, j in
+                       zip(found_scores, found_ids, found_scores[1:], found_ids[1:]))
+
+def test_empty_chunks_and_k_zero():
+    best = StreamingTopK(3)
+    best.push(np.zeros(0), np.zeros(0, dtype=np.int64))
+    best.push(np.array([0.5, 0.5]), np.array([9, 2]))
+    ids, scores = best.result()
+    assert list(ids) == [2, 9] and list(scores) == [0.5, 0.5]
+    assert len(StreamingTopK(0).result()[0]) == 0
@@ -0,0 +1,176 @@
+# This file has the search index for the sidebar "Search Movies" box. It is built once from the movie
+# titles and finds the same movies as movies['title'].str.contains(query, case=False) (the query is
+# plain text, not a regular expression), without scanning every title on each rerun:
+# - an n-gram index (every 1, 2 and 3 letter piece of every lower-cased title -> titles that have it)
+#   answers short queries; longer ones are matched with the places of their 3-letter pieces
+# - a sorted list of every title suffix that starts at a word (a flattened prefix trie) finds titles
+#   with a word starting with the query, for type-ahead and for ranking
+# Results are ranked: exact title, title starts with the query, a word starts with it, anywhere else
+
+import re
+from bisect import bisect_left, bisect_right
+import numpy as np
+from dataset import dataset
+
+YEAR_PATTERN = re.compile(r"\((\d{4})\)\s*$")
+WORD_START_PATTERN = re.compile(r"(?<!\w)\w")
+
+def gram_code(piece):
+    # One number for a 1-3 byte piece of text: its length in the top bits, then the bytes
+    code = len(piece) << 24
+    for i, byte in enumerate(piece):
+        code |= byte << (16 - 8 * i)
+    return code
+
+class TitleIndex:
+    def __init__(self, movie_ids, titles):
+        self.movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        self.titles = list(titles)
+        num_titles = len(self.titles)
+        # Missing titles never match, like na=False in str.contains
+        self.has_title = np.array([isinstance(title, str) for title in self.titles], dtype=bool)
+        lowered = [title.lower() if isinstance(title, str) else "" for title in self.titles]
+        self.encoded = [title.encode('utf-8') for title in lowered]
+        self.years = np.array([int(match.group(1)) if match else 0
+                               for match in map(YEAR_PATTERN.search, lowered)], dtype=np.int16)
+        # Lower-cased title, with and without the year -> rows (for exact matches)
+        self.exact = {}
+        for row, title in enumerate(lowered):
+            for key in {title.strip(), YEAR_PATTERN.sub("", title).strip()}:
+                self.exact.setdefault(key, []).append(row)
+        lengths = np.array([len(title) for title in self.encoded], dtype=np.int64)
+
+        # Ranking among results of the same kind: shorter titles first, then by movie_id
+        self.rank = np.empty(num_titles, dtype=np.int64)
+        self.rank[np.lexsort((self.movie_ids, lengths))] = np.arange(num_titles)
+
+        self._build_grams(lengths)
+        self._build_word_starts(lowered)
+
+    @classmethod
+    def from_movies(cls, movies):
+        return cls(movies['movie_id'].to_numpy(), movies['title'].tolist())
+
+    def _build_grams(self, lengths):
+        # Every (n-gram, title) pair once, sorted by n-gram: gram_codes[k] has the titles
+        # postings[gram_offsets[k]:gram_offsets[k + 1]]. For 3-grams also every place they appear
+        # (row * width + byte position), in trigram_places the same way
+        num_titles = max(len(self.encoded), 1)
+        self.width = int(lengths.max(initial=0)) + 1
+        blob = np.frombuffer(b"".join(self.encoded), dtype=np.uint8).astype(np.int64)
+        title_of = np.repeat(np.arange(len(self.encoded)), lengths)
+        position = np.arange(len(blob)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        room_left = lengths[title_of] - position  # bytes from each position to the end of its title
+
+        pairs = []
+        for n in (1, 2, 3):
+            at = np.flatnonzero(room_left >= n)
+            codes = np.full(len(at), n << 24, dtype=np.int64)
+            for i in range(n):
+                codes |= blob[at + i] << (16 - 8 * i)
+            pairs.append(codes * num_titles + title_of[at])
+        pairs = drop_repeats(np.sort(np.concatenate(pairs)))
+        self.gram_codes, self.gram_offsets, self.postings = group_by_code(pairs // num_titles, pairs % num_titles)
+
+        places = title_of[at] * self.width + position[at]
+        order = np.lexsort((places, codes))
+        self.trigram_codes, self.trigram_offsets, self.trigram_places = group_by_code(codes[order], places[order])
+
+    def _build_word_starts(self, lowered):
+        # (suffix, title) for every word start of every title, sorted by suffix. All suffixes that
+        # start with a query are next to each other, so one binary search finds them
+        entries = sorted(
+            (title[match.start():], row, match.start())
+            for row, title in enumerate(lowered) for match in WORD_START_PATTERN.finditer(title)
+        )
+        self.suffixes = [suffix for suffix, row, start in entries]
+        self.suffix_titles = np.array([row for suffix, row, start in entries], dtype=np.int64)
+        self.suffix_at_start = np.array([start == 0 for suffix, row, start in entries], dtype=bool)
+
+    def _posting(self, piece):
+        # Rows of the titles that have this 1-3 byte piece
+        return find_group(self.gram_codes, self.gram_offsets, self.postings, gram_code(piece))
+
+    def matching_rows(self, query):
+        # Rows of all titles that contain the query (case-insensitive)
+        piece = query.lower().encode('utf-8')
+        if len(piece) == 0:
+            return np.flatnonzero(self.has_title)
+        if len(piece) <= 3:
+            # The query is itself one n-gram, so its list is exactly the answer
+            return self._posting(piece).astype(np.int64)
+
+        # The query is at a place if its 3-gram number i is at place + i for every i. Start from
+        # the rarest 3-gram's places (minus i, so they are all start places) and keep the ones
+        # where the other 3-grams are found too
+        starts = sorted((find_group(self.trigram_codes, self.trigram_offsets, self.trigram_places,
+                                    gram_code(piece[i:i + 3])) - i for i in range(len(piece) - 2)), key=len)
+        found = starts[0]
+        for other in starts[1:]:
+            if len(found) == 0:
+                break
+            at = np.searchsorted(other, found).clip(0, max(len(other) - 1, 0))
+            found = found[other[at] == found] if len(other) else found[:0]
+        return drop_repeats(found // self.width)
+
+    def word_prefix_rows(self, prefix):
+        # Rows of titles with a word that starts with prefix, and whether that word starts the title
+        prefix = prefix.lower()
+        low = bisect_left(self.suffixes, prefix)
+        high = bisect_right(self.suffixes, prefix + "\U0010ffff", low)
+        return self.suffix_titles[low:high], self.suffix_at_start[low:high]
+
+    def search(self, query, limit=None, year=None):
+        # Movie ids of the titles that contain query, best matches first, and how many matched in total.
+        # limit keeps only the first results, year keeps only movies from that year
+        rows = self.matching_rows(query)
+        if year is not None:
+            rows = rows[self.years[rows] == year]
+        total = len(rows)
+        if total == 0:
+            return self.movie_ids[:0], 0
+
+        # 0 = exact title (with or without the year), 1 = title starts with the query,
+        # 2 = a word starts with the query, 3 = anywhere else
+        kind = np.full(len(self.titles), 3, dtype=np.int64)
+        prefix_rows, at_start = self.word_prefix_rows(query.strip())
+        kind[prefix_rows] = 2
+        kind[prefix_rows[at_start]] = 1
+        kind[self.exact.get(query.strip().lower(), [])] = 0
+
+        order_key = kind[rows] * len(self.titles) + self.rank[rows]
+        if limit is not None and limit < total:
+            best = np.argpartition(order_key, limit - 1)[:limit]
+            rows, order_key = rows[best], order_key[best]
+        rows = rows[np.argsort(order_key, kind='stable')]
+        return self.movie_ids[rows], total
+
+    def complete(self, prefix, limit=10):
+        # Type-ahead: titles with a word starting with prefix, titles starting with it first
+        rows, at_start = self.word_prefix_rows(prefix)
+        kind = np.full(len(self.titles), 2, dtype=np.int64)
+        kind[rows[at_start]] = 1
+        rows = drop_repeats(np.sort(rows))
+        order_key = kind[rows] * len(self.titles) + self.rank[rows]
+        return self.movie_ids[rows[np.argsort(order_key)][:limit]]
+
+def drop_repeats(values):
+    # Unique values of a sorted array (np.unique sorts again, which is much slower on big arrays)
+    return values[np.append(True, np.diff(values) != 0)] if len(values) else values
+
+def group_by_code(codes, values):
+    # (unique codes, offsets, values) for values sorted by code: code k has values[offsets[k]:offsets[k + 1]]
+    starts = np.flatnonzero(np.append(True, np.diff(codes) != 0)) if len(codes) else np.zeros(0, dtype=np.int64)
+    return codes[starts], np.append(starts, len(codes)), values.astype(np.int64)
+
+def find_group(codes, offsets, values, code):
+    k = np.searchsorted(codes, code)
+    if k < len(codes) and codes[k] == code:
+        return values[offsets[k]:offsets[k + 1]]
+    return values[:0]
+
+def get_title_index():
+    # Built once per data version; new ratings don't change the titles, so it is kept when they arrive
+    return dataset.derived(
+        'title_index', lambda data: TitleIndex.from_movies(data.movies), update=lambda index, new_ratings: index
+    )
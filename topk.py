@@ -0,0 +1,71 @@
+# This file picks the best K items out of a list of scores without sorting the whole list.
+# Every ranking in the app uses the same order: highest score first, equal scores by lower id first
+
+import heapq
+import numpy as np
+
+def top_k(scores, ids, k):
+    # Positions of the k best scores, in ranking order
+    scores = np.asarray(scores)
+    ids = np.asarray(ids)
+    if k <= 0 or len(scores) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    if k < len(scores):
+        # Partial selection finds the k-th best score in linear time. Everything that beats it,
+        # plus every score equal to it (for the id tie-break), goes on to the small final sort
+        kth_best = -np.partition(-scores, k - 1)[k - 1]
+        candidates = np.flatnonzero(scores >= kth_best)
+    else:
+        candidates = np.arange(len(scores))
+
+    order = np.lexsort((ids[candidates], -scores[candidates]))[:k]
+    return candidates[order]
+
+def top_k_per_row(scores, k):
+    # Column positions of the k best scores in every row of a 2D array, in ranking order.
+    # Equal scores are ordered by column, so columns should be sorted by id
+    rows, columns = scores.shape
+    k = min(k, columns)
+    if k <= 0 or rows == 0:
+        return np.zeros((rows, 0), dtype=np.int64)
+
+    # The k-th best score of every row, then the columns that beat it and
+    # as many of the columns equal to it (lowest first) as are needed to make k
+    kth_best = -np.partition(-scores, k - 1, axis=1)[:, k - 1:k]
+    better = scores > kth_best
+    equal = scores == kth_best
+    places_left = k - better.sum(axis=1, keepdims=True)
+    selected = better | (equal & (np.cumsum(equal, axis=1) <= places_left))
+
+    row_index, column_index = np.nonzero(selected)
+    order = np.lexsort((column_index, -scores[row_index, column_index], row_index))
+    return column_index[order].reshape(rows, k)
+
+class StreamingTopK:
+    # Keeps the k best (score, id) pairs while scores arrive in chunks, using a small heap
+    def __init__(self, k):
+        self.k = k
+        self._heap = []  # the weakest kept item is on top: lowest score, then highest id
+
+    def push(self, scores, ids):
+        # Only the chunk's own top k can make it into the overall top k
+        scores = np.asarray(scores)
+        ids = np.asarray(ids)
+        if self.k > 0 and len(self._heap) == self.k:
+            # Once k items are kept, only scores at least as good as the weakest of them can get in
+            keep = np.flatnonzero(scores >= self._heap[0][0])
+            scores, ids = scores[keep], ids[keep]
+        for position in top_k(scores, ids, self.k):
+            item = (float(scores[position]), -int(ids[position]))
+            if len(self._heap) < self.k:
+                heapq.heappush(self._heap, item)
+            elif item > self._heap[0]:
+                heapq.heapreplace(self._heap, item)
+
+    def result(self):
+        # (ids, scores) of the k best so far, in ranking order
+        best = sorted(self._heap, reverse=True)
+        ids = np.array([-item[1] for item in best], dtype=np.int64)
+        scores = np.array([item[0] for item in best], dtype=np.float64)
+        return ids, scores
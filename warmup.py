@@ -0,0 +1,123 @@
+# This file gets the movie data ready in a background thread while the login page is shown, so the first
+# page after signing in doesn't have to wait for it. app.py only imports pandas, the data and the
+# recommenders once someone is signed in; the warm-up thread is started after the login page has been
+# drawn and does the same imports and loading, once per process.
+# Settings (environment variables): APP_WARMUP (default 1, 0 = no warm-up thread)
+# Measure the startup times with: python warmup.py [--repo path/to/another/checkout]
+
+import importlib
+import os
+import threading
+import metrics
+
+_thread = None
+_lock = threading.Lock()
+
+def warm_up():
+    # Import the recommender and build what the main page and a first recommendation need. The dataset
+    # builds everything under its lock, so a page that needs something that is still being built just
+    # waits for it instead of building it a second time
+    try:
+        with metrics.span("warmup"):
+            from dataset import dataset
+            from movie_catalog import get_movie_catalog
+            from recommender import get_popularity_ranking, get_rating_aggregates, get_rating_matrix
+            from title_search import get_title_index
+            dataset.users
+            get_movie_catalog()
+            get_rating_matrix()
+            get_rating_aggregates()
+            get_popularity_ranking()
+            get_title_index()
+            # The libraries streamlit draws the tables and charts of the main page with (about 0.3 s to import)
+            importlib.import_module("altair")
+            importlib.import_module("pyarrow")
+    except Exception as e:
+        # Not a problem, the page loads whatever is missing when it needs it
+        print("Warm-up failed:", e)
+
+def start():
+    # Start the warm-up thread (once per process) unless APP_WARMUP=0
+    global _thread
+    if os.environ.get("APP_WARMUP", "1") == "0":
+        return None
+    with _lock:
+        if _thread is None:
+            _thread = threading.Thread(target=warm_up, name="warmup", daemon=True)
+            _thread.start()
+    return _thread
+
+def wait(timeout=None):
+    # Wait for the warm-up to finish (if it was started). Returns False if it is still running
+    if _thread is None:
+        return True
+    _thread.join(timeout)
+    return not _thread.is_alive()
+
+# Run in a new Python process for every measurement, with streamlit already imported (like in the
+# streamlit server): render the login page, then the page after signing in. With "wait" the second
+# page is only drawn once the warm-up thread (if there is one) has finished. Whether pandas was
+# imported for the login page only means something with the warm-up turned off (it imports pandas)
+MEASURE_SCRIPT = '''
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+wait_for_warmup = sys.argv[1] == "wait"
+app = AppTest.from_file("app.py", default_timeout=600)
+start = time.perf_counter()
+app.run()
+login_seconds = time.perf_counter() - start
+pandas_loaded = "pandas" in sys.modules
+if wait_for_warmup and "warmup" in sys.modules:
+    sys.modules["warmup"].wait()
+idle_seconds = time.perf_counter() - start - login_seconds
+app.session_state.logged_in = True
+app.session_state.username = "startup_check"
+start = time.perf_counter()
+app.run()
+print(json.dumps({"login_ms": login_seconds * 1000, "pandas_on_login": pandas_loaded,
+                  "warmup_ms": idle_seconds * 1000, "main_page_ms": (time.perf_counter() - start) * 1000,
+                  "errors": [str(error.value) for error in app.exception]}))
+'''
+
+# Ways of signing in that are measured: label, APP_WARMUP, wait for the warm-up before signing in
+SIGN_IN_MODES = [("no warm-up", "0", False), ("right away", "1", False), ("after warm-up", "1", True)]
+
+def measure(repo_dir, warmup_setting, wait_for_warmup, runs=3):
+    # Median times (ms) of runs fresh processes
+    import json
+    import statistics
+    import subprocess
+    import sys
+
+    results = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", MEASURE_SCRIPT, "wait" if wait_for_warmup else "now"],
+                                cwd=repo_dir, env=dict(os.environ, APP_WARMUP=warmup_setting),
+                                capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    if results[-1]["errors"]:
+        raise RuntimeError(f"The app failed in {repo_dir}: {results[-1]['errors']}")
+    return {
+        'login page ms': round(statistics.median(result['login_ms'] for result in results)),
+        'pandas on login page': results[-1]['pandas_on_login'] if warmup_setting == "0" else "",
+        'waited for warm-up ms': round(statistics.median(result['warmup_ms'] for result in results)),
+        'first main page ms': round(statistics.median(result['main_page_ms'] for result in results)),
+    }
+
+if __name__ == "__main__":
+    import argparse
+    import pandas as pd
+
+    parser = argparse.ArgumentParser(description="Time to the first login page and the first page after signing in")
+    parser.add_argument("--repo", action="append", default=[],
+                        help="another checkout of the app to compare with (e.g. an older version)")
+    parser.add_argument("--runs", type=int, default=3, help="fresh processes per measurement")
+    args = parser.parse_args()
+
+    rows = []
+    for repo_dir in args.repo + [os.path.dirname(os.path.abspath(__file__))]:
+        for label, warmup_setting, wait_for_warmup in SIGN_IN_MODES:
+            row = {'app': repo_dir, 'signed in': label}
+            row.update(measure(repo_dir, warmup_setting, wait_for_warmup, args.runs))
+            rows.append(row)
+    print(pd.DataFrame(rows).to_string(index=False))